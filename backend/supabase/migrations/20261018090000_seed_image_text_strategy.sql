@@ -0,0 +1,10 @@
+-- image and ocr text extraction of the same pages, reconciled per page
+INSERT INTO
+    strategies (id, strategy, name, description)
+VALUES
+    (
+        'c52e55ae-ca09-405a-89fe-2dd250193366',
+        'file_image_text_openai',
+        'OpenAI image and text extraction',
+        'Strategy for extracting structure from both page images and their OCR text using OpenAI, keeping the fuller rows of each page'
+    );
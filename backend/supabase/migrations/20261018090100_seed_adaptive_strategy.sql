@@ -0,0 +1,10 @@
+-- each page routed to text, ocr or vision extraction by its features
+INSERT INTO
+    strategies (id, strategy, name, description)
+VALUES
+    (
+        'c8bd9394-1da8-4614-bae7-58fac08bae7e',
+        'file_adaptive_openai',
+        'OpenAI adaptive extraction',
+        'Strategy routing each page to text, OCR or image extraction using OpenAI, whichever is cheapest for the page'
+    );
@@ -0,0 +1,10 @@
+-- page images extracted through the openai batch api
+INSERT INTO
+    strategies (id, strategy, name, description)
+VALUES
+    (
+        '95e76832-be5c-403b-8a19-8aac6b8d2b1d',
+        'file_image_openai_batch',
+        'OpenAI batch image extraction',
+        'Strategy for extracting page images through the OpenAI Batch API, cheaper but finishing within a day, for bulk runs'
+    );
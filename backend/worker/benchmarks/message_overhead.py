@@ -0,0 +1,136 @@
+"""
+benchmark for per-message overhead of the worker
+
+runs the supabase i/o a message performs (status update, strategy lookup,
+file download, output upload) against a local stand-in for supabase, once
+the way the worker used to (new event loop and new client per message) and
+once on the shared runtime with the pooled client
+
+usage (from backend/worker):
+    python -m benchmarks.message_overhead --messages 50 --handshake-ms 30
+
+`--handshake-ms` delays every new tcp connection on the stand-in, to mimic
+the tcp + tls handshake against a remote supabase instance
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+from supabase import AsyncClient, create_async_client
+from pipeline.runtime import WorkerRuntime
+
+# any jwt-shaped key passes supabase's client side validation
+STAND_IN_KEY = "stand.in.key"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    answers every postgrest / storage request with a small json body
+    """
+    protocol_version = "HTTP/1.1"
+    handshake_seconds = 0.0
+    connections = 0
+
+    def setup(self) -> None:
+        StandInHandler.connections += 1
+        time.sleep(self.handshake_seconds)
+        super().setup()
+
+    def _reply(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if self.path.startswith("/storage/v1/object/sources"):
+            body = b"%PDF-1.4 stand-in"
+            content_type = "application/pdf"
+        elif self.path.startswith("/storage/v1/object"):
+            body = json.dumps(
+                {"Key": "outputs/results/stand-in.json"}).encode()
+            content_type = "application/json"
+        else:
+            body = json.dumps([{"strategy": "file_image_openai"}]).encode()
+            content_type = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = do_PUT = _reply
+
+    def log_message(self, format, *args) -> None:
+        return
+
+
+async def message_io(client: AsyncClient) -> None:
+    """the supabase calls a single message makes, without the llm work"""
+    await client.from_("pipeline_runs").update({"status": "processing"}).eq("id", "stand-in").execute()
+    await client.from_("strategies").select("strategy").eq("id", "stand-in").execute()
+    await client.storage.from_("sources").download("stand-in/file.pdf")
+    await client.storage.from_("outputs").upload(
+        path="results/stand-in.json",
+        file=b"{}",
+        file_options={"cache-control": "3600", "upsert": "true"}
+    )
+    await client.from_("pipeline_runs").update({"status": "completed"}).eq("id", "stand-in").execute()
+
+
+def run_per_message_loop(url: str) -> None:
+    """previous behaviour: a new loop and client for every message"""
+    client = asyncio.run(create_async_client(url, STAND_IN_KEY))
+
+    async def process() -> None:
+        try:
+            await message_io(client)
+        finally:
+            await client.postgrest.aclose()
+    asyncio.run(process())
+
+
+def measure(label: str, messages: int, handle: Callable[[], None]) -> List[float]:
+    """times `handle` once per message and prints a summary"""
+    StandInHandler.connections = 0
+    timings: List[float] = []
+    for _ in range(messages):
+        started = time.perf_counter()
+        handle()
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f"{label:<22} median {statistics.median(timings):8.2f} ms  "
+          f"p95 {sorted(timings)[int(len(timings) * 0.95) - 1]:8.2f} ms  "
+          f"connections {StandInHandler.connections}")
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--handshake-ms", type=float, default=30.0)
+    args = parser.parse_args()
+
+    StandInHandler.handshake_seconds = args.handshake_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        before = measure("per-message loop", args.messages,
+                         lambda: run_per_message_loop(url))
+
+        with WorkerRuntime() as runtime:
+            client = runtime.run(create_async_client(url, STAND_IN_KEY))
+            after = measure("shared runtime", args.messages,
+                            lambda: runtime.run(message_io(client)))
+            runtime.run(client.postgrest.aclose())
+    finally:
+        server.shutdown()
+
+    saved = statistics.median(before) - statistics.median(after)
+    print(f"per-message overhead removed: {saved:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
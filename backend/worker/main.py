@@ -1,18 +1,26 @@
-import asyncio
 import json
 import ast
+from typing import Any, Dict, Optional
 from openai import AsyncClient
-from supabase import create_async_client
 from pipeline.processor.message_processor import MessageProcessor
-from pipeline.model.PipelineModel import PipelineRunResponse
 from pipeline.extractor.text.ocr_extractor import OCRExtractor
 from pipeline import Pipeline
-from pipeline.model.environ.Environ import Environ
+from pipeline.model.environ.Environ import ConsumerMode, Environ
 from pipeline.base.pipeline_step import StepData
+from pipeline.base.instrumentation import prometheus_hook, serve_metrics
 from pipeline.extractor.openai_extractor import OpenAIExtractor, OpenAIImageExtractor
 from pipeline.image.pdf_to_jpg_step import PDFToJPGStep
 from pipeline.file.gotenberg_step import GotenbergPipelineStep
-from pipeline.message.consumer import RabbitMQConsumer
+from pipeline.message.consumer import AsyncRabbitMQConsumer, RabbitMQConsumer
+from pipeline.message.lease import wait_with_heartbeat
+from pipeline.message.pgmq_consumer import PGMQConsumer
+from pipeline.message.publisher import MessagePublisher, PGMQPublisher, RabbitMQPublisher
+from pipeline.runtime import WorkerRuntime, shared_queue_client, shared_supabase_client
+
+# one event loop and one set of client connections for the whole process
+runtime = WorkerRuntime()
+# created on first use when runs are fanned out into per-file work items
+publisher: Optional[MessagePublisher] = None
 
 
 async def pdf_file_to_jpeg_to_image_to_row_openai(input_step: StepData) -> StepData:
@@ -99,16 +107,50 @@ async def file_to_pdf_to_jpeg_to_text_to_row_ollama(input_step: StepData) -> Ste
     return step_data
 
 
-def create_message_processor() -> MessageProcessor:
+async def create_message_processor() -> MessageProcessor:
     """
-    create async client
+    create message processor on the shared supabase client
     """
+    global publisher
     environ = Environ()
-    client = asyncio.run(create_async_client(
-        supabase_url=environ.supabase_url,
-        supabase_key=environ.supabase_key
-    ))
-    return MessageProcessor(client=client)
+    client = await shared_supabase_client()
+    if publisher is None and environ.fan_out_min_files is not None:
+        publisher = await create_publisher(environ)
+    return MessageProcessor(client=client,
+                            publisher=publisher,
+                            fan_out_min_files=environ.fan_out_min_files,
+                            shard_pages=environ.pdf_shard_pages,
+                            filter_pages=environ.filter_pages,
+                            consumer_mode=environ.consumer_mode)
+
+
+async def create_publisher(environ: Environ) -> MessagePublisher:
+    """
+    publisher for work items, on the same queue the worker consumes
+    """
+    if environ.consumer_mode == ConsumerMode.PGMQ:
+        return PGMQPublisher(client=await shared_queue_client(),
+                             queue_name='extraction')
+    return RabbitMQPublisher(host=environ.rabbitmq_host,
+                             port=environ.rabbitmq_port,
+                             queue_name='extraction')
+
+
+async def handle_message(body: bytes):
+    """decodes and runs a single extraction message on the runtime loop"""
+    str_message = body.decode()
+    print(str_message)
+
+    message = json.loads(str_message)
+    return await handle_payload(message)
+
+
+async def handle_payload(message: Dict[str, Any]):
+    """runs a single decoded extraction message on the runtime loop"""
+    print(message)
+    message_processor = await create_message_processor()
+
+    return await message_processor.process_payload(message)
 
 
 def process_message(ch, method, properties, body):
@@ -116,18 +158,11 @@ def process_message(ch, method, properties, body):
     try:
         # print(f"Received message: {body.decode()}")
         # Process the message here
-
-        str_message = body.decode()
-        print(str_message)
-        message_processor = create_message_processor()
-
-        message = json.loads(str_message)
-        print(message)
-
-        pipeline_message = PipelineRunResponse.model_validate(message)
-
-        response = asyncio.run(message_processor.process_message(
-            pipeline_message=pipeline_message))
+        # service the connection while waiting so heartbeats keep the
+        # delivery ours for the whole extraction
+        response = wait_with_heartbeat(
+            connection=ch.connection,
+            pending=runtime.submit(handle_message(body)))
 
         print(response)
 
@@ -141,6 +176,40 @@ def process_message(ch, method, properties, body):
         print(f"Error processing message: {str(e)}")
 
 
+async def consume_concurrently(environ: Environ) -> None:
+    """consumes extraction messages on the runtime loop, several at a time"""
+    async with AsyncRabbitMQConsumer(
+        host=environ.rabbitmq_host,
+        port=environ.rabbitmq_port,
+        queue_name='extraction',
+        max_in_flight=environ.worker_concurrency
+    ) as consumer:
+        await consumer.consume(handle_message)
+
+
+async def consume_pgmq(environ: Environ) -> None:
+    """long-polls the supabase pgmq extraction queue on the runtime loop"""
+    async with PGMQConsumer(
+        client=await shared_queue_client(),
+        queue_name='extraction',
+        batch_size=environ.pgmq_batch_size,
+        max_in_flight=environ.worker_concurrency,
+        visibility_timeout=environ.pgmq_visibility_timeout,
+        max_poll_seconds=environ.pgmq_max_poll_seconds,
+        max_attempts=environ.pgmq_max_attempts
+    ) as consumer:
+        await consumer.consume(handle_payload)
+
+
+def run_until_interrupted(coro) -> None:
+    """runs a long-lived consumer on the runtime until ctrl-c"""
+    consuming = runtime.submit(coro)
+    try:
+        consuming.result()
+    except KeyboardInterrupt:
+        consuming.cancel()
+
+
 if __name__ == "__main__":
     # response = asyncio.run(
     #     pdf_file_to_jpeg_to_image_to_row_openai(
@@ -184,12 +253,20 @@ if __name__ == "__main__":
     # )
     # pprint(response["event"]["rows"])
     environ = Environ()
-    with RabbitMQConsumer(
-        host=environ.rabbitmq_host,
-        port=environ.rabbitmq_port,
-        queue_name='extraction'
-    ) as consumer:
-        consumer.consume(process_message)
+    if environ.metrics_port is not None:
+        serve_metrics(prometheus_hook, environ.metrics_port)
+    with runtime:
+        if environ.consumer_mode == ConsumerMode.ASYNC:
+            run_until_interrupted(consume_concurrently(environ))
+        elif environ.consumer_mode == ConsumerMode.PGMQ:
+            run_until_interrupted(consume_pgmq(environ))
+        else:
+            with RabbitMQConsumer(
+                host=environ.rabbitmq_host,
+                port=environ.rabbitmq_port,
+                queue_name='extraction'
+            ) as consumer:
+                consumer.consume(process_message)
         # response_docx = asyncio.run(file_to_pdf_to_jpeg_to_image_to_row_openai(
         #     input_step=StepData(
         #         event={
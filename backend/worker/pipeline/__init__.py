@@ -1,8 +1,13 @@
-from .base import Pipeline, PipelineStep
+from .base import Pipeline, PipelineStep, StreamingPipelineStep, DAGPipeline, JoinStep, MergeEventsJoinStep, PipelineHook
 from .file import GotenbergPipelineStep
 
 __all__ = (
     "Pipeline",
     "PipelineStep",
+    "StreamingPipelineStep",
+    "DAGPipeline",
+    "JoinStep",
+    "MergeEventsJoinStep",
+    "PipelineHook",
     "GotenbergPipelineStep",
 )
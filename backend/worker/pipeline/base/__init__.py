@@ -1,8 +1,19 @@
 """exports for python"""
 from .pipeline_step import PipelineStep
+from .streaming import StreamingPipelineStep
 from .pipeline import Pipeline
+from .dag import DAGPipeline, JoinStep, MergeEventsJoinStep
+from .instrumentation import PipelineHook, PrometheusHook, StepMetrics, TimelineHook
 
 __all__ = (
     "PipelineStep",
+    "StreamingPipelineStep",
     "Pipeline",
+    "DAGPipeline",
+    "JoinStep",
+    "MergeEventsJoinStep",
+    "PipelineHook",
+    "PrometheusHook",
+    "StepMetrics",
+    "TimelineHook",
 )
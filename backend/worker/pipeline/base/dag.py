@@ -0,0 +1,118 @@
+"""
+dag pipeline, steps declare their inputs and independent branches run
+concurrently on the event loop
+"""
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from pipeline.model.StepDataModel import StepData
+from pipeline.base.pipeline_step import PipelineStep
+from pipeline.base.instrumentation import PipelineHook, hooks_for, instrumented
+
+
+class JoinStep(ABC):
+    """Abstract base class for a step merging the outputs of several upstream steps."""
+
+    @abstractmethod
+    async def join(self, inputs: Dict[str, StepData]) -> StepData:
+        """Merges upstream outputs, keyed by step name, into one output."""
+        return
+
+
+class MergeEventsJoinStep(JoinStep):
+    """
+    merges upstream events into one, later inputs win on clashing keys,
+    e.g. joining a converted file with its hash
+    """
+
+    async def join(self, inputs: Dict[str, StepData]) -> StepData:
+        event = {}
+        for data in inputs.values():
+            event.update(data["event"])
+        return {
+            "event": event,
+            "context": next(iter(inputs.values()))["context"]
+        }
+
+
+class DAGPipeline:
+    """Pipeline of steps wired by their declared inputs, run as a directed acyclic graph."""
+
+    # name under which the data passed to `execute` is available to steps
+    INPUT = "input"
+
+    def __init__(self, hooks: Optional[List[PipelineHook]] = None):
+        """
+        Args:
+            hooks: Hooks receiving each step's metrics, on top of the process wide
+                defaults and any listed under `pipeline_hooks` in the input context
+        """
+        self.hooks = hooks or []
+        self.nodes: Dict[str, Tuple[Union[PipelineStep, JoinStep], List[str]]] = {}
+
+    def add_step(self,
+                 name: str,
+                 step: Union[PipelineStep, JoinStep],
+                 inputs: Sequence[str] = (INPUT,)) -> None:
+        """
+        Adds a step reading from already added steps (or the pipeline input),
+        so steps are always added in dependency order and the graph stays acyclic.
+
+        Args:
+            name: Unique step name other steps refer to
+            step: Pipeline step taking one input, or join step taking several
+            inputs: Names of the steps this step reads from
+        """
+        if name == self.INPUT or name in self.nodes:
+            raise ValueError(f"step name {name} is already taken")
+        if not inputs:
+            raise ValueError(f"step {name} needs at least one input")
+        for input_name in inputs:
+            if input_name != self.INPUT and input_name not in self.nodes:
+                raise ValueError(f"""step {name} reads from {
+                                 input_name}, which has not been added""")
+        if isinstance(step, PipelineStep) and len(inputs) != 1:
+            raise ValueError(
+                f"step {name} takes one input, use a JoinStep to merge several")
+        self.nodes[name] = (step, list(inputs))
+
+    async def execute(self, data: StepData, output: Optional[str] = None) -> StepData:
+        """
+        Executes every step as soon as its inputs are ready and returns the
+        output of `output`, by default the last step added.
+        """
+        if not self.nodes:
+            return data
+        output = output or next(reversed(self.nodes))
+        ready = asyncio.get_running_loop().create_future()
+        ready.set_result(data)
+        hooks = hooks_for(data, self.hooks)
+        tasks: Dict[str, asyncio.Future] = {self.INPUT: ready}
+        for name, (step, inputs) in self.nodes.items():
+            tasks[name] = asyncio.create_task(
+                self._run_step(name, step, inputs, tasks, hooks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return tasks[output].result()
+
+    async def _run_step(self,
+                        name: str,
+                        step: Union[PipelineStep, JoinStep],
+                        inputs: List[str],
+                        tasks: Dict[str, asyncio.Future],
+                        hooks: List[PipelineHook]) -> StepData:
+        results = await asyncio.gather(*[tasks[input_name] for input_name in inputs])
+        if isinstance(step, JoinStep):
+            joined = dict(zip(inputs, results))
+            # joins are measured against all of their inputs at once
+            measured: StepData = {
+                "event": {input_name: result["event"]
+                          for input_name, result in joined.items()},
+                "context": results[0]["context"]
+            }
+            return await instrumented(name, lambda: step.join(joined), measured, hooks)
+        return await instrumented(name, lambda: step.process(results[0]), results[0], hooks)
@@ -0,0 +1,225 @@
+"""
+per-step instrumentation for pipelines, hooks receive the wall time, cpu
+time, payload sizes and page counts of every step
+"""
+import logging
+import threading
+import time
+from abc import ABC
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypedDict
+from pipeline.model.StepDataModel import StepData
+
+logger = logging.getLogger(__name__)
+
+# event keys holding one entry per page
+PAGE_KEYS = ("images", "texts", "rows")
+
+
+class StepMetrics(TypedDict):
+    """
+    measurements of one step execution
+    """
+    step: str
+    started_at: str
+    status: str
+    # process wide, overlapping steps each count the other's cpu time
+    wall_seconds: float
+    cpu_seconds: float
+    input_bytes: int
+    output_bytes: int
+    input_pages: Optional[int]
+    output_pages: Optional[int]
+    error: Optional[str]
+
+
+class PipelineHook(ABC):
+    """Base class for hooks observing pipeline steps, both callbacks are optional."""
+
+    def on_step_start(self, step: str, data: StepData) -> None:
+        """Called before a step runs."""
+        return
+
+    def on_step_end(self, metrics: StepMetrics) -> None:
+        """Called after a step finishes or fails."""
+        return
+
+
+def payload_bytes(value: Any) -> int:
+    """approximate size of a step payload, counting bytes and strings"""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(payload_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_bytes(item) for item in value)
+    return 0
+
+
+def page_count(data: Optional[StepData]) -> Optional[int]:
+    """number of pages in a step payload, `None` before pages exist"""
+    if not data:
+        return None
+    event = data.get("event") or {}
+    for key in PAGE_KEYS:
+        if isinstance(event.get(key), list):
+            return len(event[key])
+    return None
+
+
+def hooks_for(data: StepData, hooks: List[PipelineHook]) -> List[PipelineHook]:
+    """pipeline hooks, the process wide defaults, then any the run put in its context"""
+    return [*hooks, *default_hooks, *data["context"].get("pipeline_hooks", [])]
+
+
+async def instrumented(step: str,
+                       run: Callable[[], Awaitable[StepData]],
+                       data: StepData,
+                       hooks: List[PipelineHook]) -> StepData:
+    """
+    runs a step, reporting its metrics to every hook, also when it raises
+    """
+    for hook in hooks:
+        _safely(hook.on_step_start, step, data)
+    started_at = datetime.now(timezone.utc).isoformat()
+    wall, cpu = time.perf_counter(), time.process_time()
+    output: Optional[StepData] = None
+    error: Optional[BaseException] = None
+    try:
+        output = await run()
+        return output
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        metrics: StepMetrics = {
+            "step": step,
+            "started_at": started_at,
+            "status": "failed" if error is not None else "completed",
+            "wall_seconds": time.perf_counter() - wall,
+            "cpu_seconds": time.process_time() - cpu,
+            "input_bytes": payload_bytes(data["event"]),
+            "output_bytes": payload_bytes(output["event"]) if output else 0,
+            "input_pages": page_count(data),
+            "output_pages": page_count(output),
+            "error": repr(error) if error is not None else None
+        }
+        for hook in hooks:
+            _safely(hook.on_step_end, metrics)
+
+
+def _safely(callback: Callable[..., None], *args: Any) -> None:
+    # a broken hook must never fail the pipeline
+    try:
+        callback(*args)
+    except Exception as e:
+        logger.error(f"Error in pipeline hook: {str(e)}")
+
+
+class TimelineHook(PipelineHook):
+    """
+    records every step of a run in order, stored as json on the run
+    """
+
+    def __init__(self) -> None:
+        self.steps: List[StepMetrics] = []
+
+    def on_step_end(self, metrics: StepMetrics) -> None:
+        self.steps.append(metrics)
+
+    def timeline(self) -> List[StepMetrics]:
+        """steps ordered by start time"""
+        return sorted(self.steps, key=lambda metrics: metrics["started_at"])
+
+
+class PrometheusHook(PipelineHook):
+    """
+    aggregates step metrics into counters rendered in the prometheus text
+    exposition format
+    """
+
+    # metric name, help text, StepMetrics key or None for the call count
+    COUNTERS = (
+        ("pipeline_step_calls_total", "Step executions", None),
+        ("pipeline_step_wall_seconds_total", "Wall time spent in steps", "wall_seconds"),
+        ("pipeline_step_cpu_seconds_total", "Process cpu time spent in steps", "cpu_seconds"),
+        ("pipeline_step_input_bytes_total", "Bytes passed into steps", "input_bytes"),
+        ("pipeline_step_output_bytes_total", "Bytes returned by steps", "output_bytes"),
+        ("pipeline_step_output_pages_total", "Pages returned by steps", "output_pages"),
+    )
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, str, str], float] = {}
+        self._counters: Dict[str, float] = {}
+
+    def on_step_end(self, metrics: StepMetrics) -> None:
+        labels = (metrics["step"], metrics["status"])
+        with self._lock:
+            for name, _, key in self.COUNTERS:
+                value = 1 if key is None else metrics[key] or 0
+                self._values[(name, *labels)] = self._values.get(
+                    (name, *labels), 0) + value
+
+    def count(self, name: str, value: float = 1) -> None:
+        """adds to a free-form counter, exported as pipeline_<name>_total"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def render(self) -> str:
+        """current counters as prometheus text"""
+        with self._lock:
+            values = dict(self._values)
+            counters = dict(self._counters)
+        lines = []
+        for name, description, _ in self.COUNTERS:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for (metric, step, status), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(
+                        f'{name}{{step="{step}",status="{status}"}} {value:g}')
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE pipeline_{name}_total counter")
+            lines.append(f"pipeline_{name}_total {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def record(context: Dict[str, Any], name: str, value: float = 1) -> None:
+    """
+    adds to a counter of the run, kept under `metrics` in the step context
+    (and so in the run's messages) and exported process wide
+    """
+    metrics = context.setdefault("metrics", {})
+    metrics[name] = metrics.get(name, 0) + value
+    prometheus_hook.count(name, value)
+
+
+def serve_metrics(hook: PrometheusHook, port: int) -> ThreadingHTTPServer:
+    """
+    serves `hook` on http://0.0.0.0:`port`/metrics from a daemon thread
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = hook.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:
+            return
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# process wide exporter, every pipeline reports to it
+prometheus_hook = PrometheusHook()
+default_hooks: List[PipelineHook] = [prometheus_hook]
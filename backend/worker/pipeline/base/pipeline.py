@@ -1,16 +1,31 @@
 """
 base class for pipeline
 """
-from typing import List
+from typing import List, Optional
 from pipeline.model.StepDataModel import StepData
 from pipeline.base import PipelineStep
+from pipeline.base.instrumentation import PipelineHook, hooks_for, instrumented
+from pipeline.base.streaming import StreamingPipelineStep, run_streaming_steps
 
 
 class Pipeline:
     """Pipeline to manage and execute a series of processing steps."""
 
-    def __init__(self):
+    def __init__(self,
+                 streaming: bool = False,
+                 buffer_size: int = 4,
+                 hooks: Optional[List[PipelineHook]] = None):
+        """
+        Args:
+            streaming: Run consecutive streaming steps page by page so their work overlaps
+            buffer_size: Pages buffered between streaming steps
+            hooks: Hooks receiving each step's metrics, on top of the process wide
+                defaults and any listed under `pipeline_hooks` in the input context
+        """
         self.steps: List[PipelineStep] = []
+        self.streaming = streaming
+        self.buffer_size = buffer_size
+        self.hooks = hooks or []
 
     def add_step(self, step: PipelineStep) -> None:
         """Adds a step to the pipeline."""
@@ -18,6 +33,35 @@ class Pipeline:
 
     async def execute(self, data: StepData) -> StepData:
         """Executes the pipeline on the given data."""
+        hooks = hooks_for(data, self.hooks)
+        if self.streaming:
+            return await self._execute_streaming(data, hooks)
         for step in self.steps:
-            data = await step.process(data)
+            data = await instrumented(type(step).__name__,
+                                      lambda: step.process(data), data, hooks)
+        return data
+
+    async def _execute_streaming(self, data: StepData, hooks: List[PipelineHook]) -> StepData:
+        """
+        runs each stretch of consecutive streaming steps as one page stream,
+        other steps run on whole documents in between
+
+        steps of a stream overlap, so they are measured together as one step
+        """
+        index = 0
+        while index < len(self.steps):
+            step = self.steps[index]
+            if not isinstance(step, StreamingPipelineStep):
+                data = await instrumented(type(step).__name__,
+                                          lambda: step.process(data), data, hooks)
+                index += 1
+                continue
+            segment: List[StreamingPipelineStep] = []
+            while index < len(self.steps) and isinstance(self.steps[index], StreamingPipelineStep):
+                segment.append(self.steps[index])
+                index += 1
+            data = await instrumented(
+                "+".join(type(step).__name__ for step in segment),
+                lambda: run_streaming_steps(segment, data, self.buffer_size),
+                data, hooks)
         return data
@@ -2,12 +2,24 @@
 base class for pipeline step
 """
 from abc import ABC, abstractmethod
+from typing import Any, Callable, TypeVar
 from pipeline.model.StepDataModel import StepData
+from pipeline.runtime.executor import ExecutionMode, run_blocking
+
+T = TypeVar("T")
 
 
 class PipelineStep(ABC):
     """Abstract base class for a pipeline step."""
 
+    # where `offload` runs the step's blocking work, cpu-bound steps
+    # declare PROCESS and steps calling gil-releasing code THREAD
+    execution_mode: ExecutionMode = ExecutionMode.ASYNC
+
+    async def offload(self, fn: Callable[..., T], *args: Any) -> T:
+        """runs blocking work on the shared executor for `execution_mode`"""
+        return await run_blocking(self.execution_mode, fn, *args)
+
     @abstractmethod
     async def process(self, data: StepData) -> StepData:
         """Processes the input data and returns the output data."""
@@ -0,0 +1,111 @@
+"""
+streaming step protocol, steps consume and produce pages one at a time so
+rasterization, ocr and llm calls overlap instead of running stage by stage
+"""
+import asyncio
+from abc import abstractmethod
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List
+from pipeline.model.StepDataModel import StepData
+from pipeline.model.PageItemModel import PageItem
+from pipeline.base.pipeline_step import PipelineStep
+
+
+class StreamingPipelineStep(PipelineStep):
+    """
+    pipeline step that can also run page by page
+
+    `process` keeps working on whole documents, a `Pipeline` created with
+    `streaming=True` uses `stream` for runs of consecutive streaming steps
+    """
+
+    @abstractmethod
+    def pages_from(self, data: StepData) -> AsyncIterator[PageItem]:
+        """splits batch shaped input into the pages this step consumes"""
+
+    @abstractmethod
+    def stream(self, pages: AsyncIterator[PageItem], context: Dict[str, Any]) -> AsyncIterator[PageItem]:
+        """consumes pages as they arrive and yields processed pages"""
+
+    @abstractmethod
+    def collect(self, pages: List[PageItem], context: Dict[str, Any]) -> StepData:
+        """aggregates pages in page order into the same shape `process` returns"""
+
+
+async def iterate(items: List[PageItem]) -> AsyncIterator[PageItem]:
+    """async iterator over already materialised pages"""
+    for item in items:
+        yield item
+
+
+async def map_concurrently(pages: AsyncIterator[PageItem],
+                           fn: Callable[[PageItem], Awaitable[PageItem]],
+                           limit: int) -> AsyncIterator[PageItem]:
+    """
+    applies `fn` to up to `limit` pages at once, yielding results as they
+    complete, so pages can come out of order
+    """
+    pending = set()
+    try:
+        async for page in pages:
+            pending.add(asyncio.create_task(fn(page)))
+            if len(pending) >= limit:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+_DONE = object()
+
+
+async def buffered(pages: AsyncIterator[PageItem], size: int) -> AsyncIterator[PageItem]:
+    """
+    runs `pages` ahead of its consumer into a bounded queue, so a stage keeps
+    producing while the next stage is busy
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+
+    async def produce() -> None:
+        try:
+            async for page in pages:
+                await queue.put(page)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(_DONE)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
+
+async def run_streaming_steps(steps: List[StreamingPipelineStep],
+                              data: StepData,
+                              buffer_size: int) -> StepData:
+    """
+    chains streaming steps with bounded buffers between them and aggregates
+    the final pages into StepData
+    """
+    context = data["context"]
+    pages = steps[0].pages_from(data)
+    for step in steps:
+        pages = buffered(step.stream(pages, context), buffer_size)
+    collected = [page async for page in pages]
+    collected.sort(key=lambda page: page.get("page_number", 0))
+    return steps[-1].collect(collected, context)
@@ -0,0 +1,350 @@
+"""
+extraction through the openai batch api, for runs that can wait
+
+every page of a step becomes one line of a batch input file, split into
+several batches beyond the provider's size limits, each batch is polled
+until it ends and the output lines are mapped back to the pages by custom
+id, at a lower price and outside the synchronous rate limits
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from openai import AsyncClient
+from openai.types import Batch
+from openai.types.chat import ChatCompletion
+from pipeline.base.instrumentation import record
+from pipeline.base.pipeline_step import PipelineStep
+from pipeline.extractor.cache import cache_key, shared_extraction_cache
+from pipeline.extractor.openai_extractor import (TEMPERATURE, cache_provider, chat_completion_request,
+                                                 image_content, tool_call_arguments, tool_call_openai_model)
+from pipeline.extractor.rate_limiter import parse_duration
+from pipeline.model import StepData
+from pipeline.model.ImageInputModel import image_types_of
+from pipeline.model.SchemaModel import SchemaConfiguration, generate_tool_schema_json
+from pipeline.model.environ.Environ import get_environ
+from pipeline.runtime.clients import shared_openai_client
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# statuses after which a batch changes no more
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# metadata key holding the digest of a batch's input file
+DIGEST_METADATA = "forenaide_digest"
+# requests the provider accepts in one batch input file
+MAX_BATCH_LINES = 50000
+# batches created longer than this before their completion window ended
+# are too old to resume, also the window assumed when it does not parse
+RESUME_GRACE_SECONDS = 24 * 60 * 60
+
+
+def batch_input_line(custom_id: str,
+                     content: str | List[Dict[str, Any]],
+                     extraction_config: SchemaConfiguration,
+                     model: str,
+                     tool: Dict[str, Any]) -> Dict[str, Any]:
+    """one request of a batch input file, the same body as a synchronous call"""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": chat_completion_request(content, extraction_config, model, tool)
+    }
+
+
+def parse_output_line(line: Dict[str, Any], extraction_config: SchemaConfiguration) -> Dict[str, Any]:
+    """
+    tool call arguments of one batch output line, a failed request or a
+    missing or malformed tool call raises a ValueError
+    """
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        raise ValueError(f"batch request failed: {line.get('error') or response.get('body')}")
+    return tool_call_arguments(ChatCompletion.model_validate(response["body"]), extraction_config)
+
+
+def input_files(lines: List[Dict[str, Any]],
+                max_bytes: int,
+                max_lines: int = MAX_BATCH_LINES) -> List[bytes]:
+    """
+    batch input files holding `lines` in order, each of at most `max_bytes`
+    bytes and `max_lines` lines, a line over the budget on its own gets a
+    file to itself
+    """
+    files: List[List[bytes]] = []
+    file_bytes = 0
+    for line in lines:
+        data = (json.dumps(line) + "\n").encode("utf-8")
+        full = files and (file_bytes + len(data) > max_bytes or len(files[-1]) >= max_lines)
+        if not files or full:
+            files.append([])
+            file_bytes = 0
+        files[-1].append(data)
+        file_bytes += len(data)
+    return [b"".join(file) for file in files]
+
+
+def _jsonl(text: str) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+class OpenAIBatchExecutor:
+    """
+    runs the extractions of many pages as one batch, pages the batch fails
+    to answer are extracted synchronously instead
+    """
+
+    def __init__(self,
+                 client: Optional[AsyncClient] = None,
+                 model: str = "gpt-4o-mini",
+                 poll_seconds: Optional[float] = None,
+                 completion_window: Optional[str] = None,
+                 max_file_bytes: Optional[int] = None) -> None:
+        """
+        Args:
+            client: Openai client, the shared one by default
+            model: Model every request is sent to
+            poll_seconds: Seconds between batch status checks,
+                `BATCH_API_POLL_SECONDS` by default
+            completion_window: Time the provider has to finish the batch,
+                `BATCH_API_COMPLETION_WINDOW` by default
+            max_file_bytes: Size of one batch input file, larger inputs
+                are split into several batches, `BATCH_API_MAX_FILE_MB`
+                by default
+        """
+        environ = get_environ()
+        self.client = client or shared_openai_client()
+        self.model = model
+        self.poll_seconds = environ.batch_api_poll_seconds if poll_seconds is None else poll_seconds
+        self.completion_window = completion_window or environ.batch_api_completion_window
+        self.max_file_bytes = max_file_bytes or int(environ.batch_api_max_file_mb * 1024 * 1024)
+
+    async def extract(self,
+                      contents: List[str | List[Dict[str, Any]]],
+                      extraction_config: SchemaConfiguration,
+                      contexts: Optional[Sequence[Optional[Dict[str, Any]]]] = None) -> List[Dict[str, Any]]:
+        """
+        tool call arguments for every page content, cached pages are read
+        back and only the rest are submitted, `contexts` holds the context
+        each page's requests and fallbacks are recorded in
+        """
+        contexts = contexts or [None] * len(contents)
+        tool = generate_tool_schema_json(extraction_config)
+        cache = shared_extraction_cache()
+        provider = cache_provider(self.client)
+        keys = [cache_key(provider, self.model, tool, content, TEMPERATURE) for content in contents]
+        results: List[Optional[Dict[str, Any]]] = [None] * len(contents)
+        if cache is not None:
+            results = list(await asyncio.gather(*map(cache.get, keys)))
+        pending = [index for index, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+
+        lines = [batch_input_line(f"page-{index}", contents[index], extraction_config, self.model, tool)
+                 for index in pending]
+        files = input_files(lines, self.max_file_bytes)
+        batches = await asyncio.gather(*(self.run(data) for data in files))
+        outputs = {custom_id: line for batch_outputs in batches for custom_id, line in batch_outputs.items()}
+        for index in pending:
+            if contexts[index] is not None:
+                record(contexts[index], "batch_api_requests")
+
+        async def resolve(index: int) -> None:
+            try:
+                results[index] = parse_output_line(outputs[f"page-{index}"], extraction_config)
+            except (KeyError, ValueError) as e:
+                # expired, failed or malformed, the page is not lost for it
+                logger.warning(f"Batch api did not answer page {index}: {str(e)}")
+                if contexts[index] is not None:
+                    record(contexts[index], "batch_api_fallbacks")
+                results[index] = await tool_call_openai_model(
+                    self.client, contents[index], extraction_config, model=self.model)
+                return
+            if cache is not None:
+                await cache.set(keys[index], results[index])
+
+        await asyncio.gather(*map(resolve, pending))
+        return results
+
+    async def run(self, data: bytes) -> Dict[str, Dict[str, Any]]:
+        """output lines by custom id of the batch of one input file"""
+        return await self.outputs(await self.wait(await self.submit(data)))
+
+    async def submit(self, data: bytes) -> Batch:
+        """
+        uploads an input file and creates its batch, a batch already
+        submitted for the same input (e.g. before a worker restart) is
+        resumed instead of paid for twice
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if (batch := await self.resumable(digest)) is not None:
+            logger.info(f"Resuming batch {batch.id}")
+            return batch
+        input_file = await self.client.files.create(file=(f"{digest}.jsonl", data), purpose="batch")
+        return await self.client.batches.create(input_file_id=input_file.id,
+                                                endpoint=BATCH_ENDPOINT,
+                                                completion_window=self.completion_window,
+                                                metadata={DIGEST_METADATA: digest})
+
+    async def resumable(self, digest: str) -> Optional[Batch]:
+        """
+        live batch submitted for the input file with `digest`, the batches
+        are listed newest first, page by page, back to the oldest one that
+        could still be running
+        """
+        window = parse_duration(self.completion_window) or RESUME_GRACE_SECONDS
+        oldest = time.time() - window - RESUME_GRACE_SECONDS
+        async for batch in self.client.batches.list(limit=100):
+            if batch.created_at < oldest:
+                return None
+            if (batch.metadata or {}).get(DIGEST_METADATA) == digest and \
+                    batch.status not in ("failed", "expired", "cancelled"):
+                return batch
+        return None
+
+    async def wait(self, batch: Batch) -> Batch:
+        """
+        polls `batch` until it is completed, failed, expired or cancelled,
+        which can take the whole completion window, so the message must be
+        consumed with `CONSUMER_MODE=pgmq`, whose lease is extended while it
+        is processed, rabbitmq's `consumer_timeout` (30 minutes by default)
+        would close the channel first, `MessageProcessor` fails such runs
+        from any other consumer
+        """
+        while batch.status not in FINAL_STATUSES:
+            await asyncio.sleep(self.poll_seconds)
+            batch = await self.client.batches.retrieve(batch.id)
+        if batch.status != "completed":
+            logger.warning(f"Batch {batch.id} ended {batch.status}")
+        return batch
+
+    async def outputs(self, batch: Batch) -> Dict[str, Dict[str, Any]]:
+        """output and error lines of a finished batch by custom id"""
+        lines: Dict[str, Dict[str, Any]] = {}
+        # expired and cancelled batches still hold the requests they finished
+        for file_id in (batch.error_file_id, batch.output_file_id):
+            if file_id:
+                content = await self.client.files.content(file_id)
+                lines.update((line["custom_id"], line) for line in _jsonl(content.text))
+        return lines
+
+
+class RunBatch:
+    """
+    collects the pages of every file of a run into one submission, made
+    once each file has handed its pages in or left without any
+    """
+
+    def __init__(self, executor: OpenAIBatchExecutor, members: int) -> None:
+        """
+        Args:
+            executor: Executor the run's pages are extracted with
+            members: Files expected to hand pages in
+        """
+        self.executor = executor
+        self._expected = members
+        self._requests: List[Tuple[List[str | List[Dict[str, Any]]],
+                                   Dict[str, Any],
+                                   asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def member(self) -> "RunBatchMember":
+        """handle of one file on the run's batch"""
+        return RunBatchMember(self)
+
+    def _arrive(self, contents: List[str | List[Dict[str, Any]]], context: Dict[str, Any]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._requests.append((contents, context, future))
+        self._flush_when_ready()
+        return future
+
+    def _leave(self) -> None:
+        self._expected -= 1
+        self._flush_when_ready()
+
+    def _flush_when_ready(self) -> None:
+        if self._flush_task is None and len(self._requests) >= self._expected:
+            self._flush_task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self) -> None:
+        if not self._requests:
+            return
+        try:
+            contents = [content for request_contents, _, _ in self._requests for content in request_contents]
+            contexts = [context for request_contents, context, _ in self._requests for _ in request_contents]
+            # every file of a run is extracted with the run's template
+            config = self._requests[0][1]["extraction_config"]
+            results = await self.executor.extract(contents, config, contexts)
+        except Exception as e:
+            for _, _, future in self._requests:
+                future.set_exception(e)
+                # waiters may be gone, the error must not go unretrieved
+                future.exception()
+            return
+        offset = 0
+        for request_contents, _, future in self._requests:
+            future.set_result(results[offset:offset + len(request_contents)])
+            offset += len(request_contents)
+
+
+class RunBatchMember:
+    """
+    one file's handle on its run's batch, released when the file is done
+    so a file that never reaches extraction does not hold the batch back
+    """
+
+    def __init__(self, batch: RunBatch) -> None:
+        self.batch = batch
+        self._done = False
+
+    async def extract(self,
+                      contents: List[str | List[Dict[str, Any]]],
+                      context: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        tool call arguments of the file's pages, from the run's batch, a
+        later call (e.g. a page filter fallback) gets a batch of its own
+        """
+        if self._done:
+            return await self.batch.executor.extract(contents, context["extraction_config"],
+                                                     [context] * len(contents))
+        self._done = True
+        return await asyncio.shield(self.batch._arrive(contents, context))
+
+    def release(self) -> None:
+        """leaves the run's batch if the file never handed pages in"""
+        if not self._done:
+            self._done = True
+            self.batch._leave()
+
+
+class OpenAIBatchExtractor(PipelineStep):
+    """
+    extracts the rows of page images or texts through the batch api, the
+    pages join their run's batch when the context holds a `run_batch`
+    member, otherwise they get a batch of their own
+    """
+
+    def __init__(self, client: Optional[AsyncClient] = None, model: str = "gpt-4o-mini") -> None:
+        self.executor = OpenAIBatchExecutor(client=client, model=model)
+
+    async def process(self, data: StepData) -> StepData:
+        event = data["event"]
+        context = data["context"]
+        if "images" in event:
+            contents = [image_content(image, image_type)
+                        for image, image_type in zip(event["images"], image_types_of(event))]
+        else:
+            contents = list(event["texts"])
+        if context.get("run_batch") is not None:
+            results = await context["run_batch"].extract(contents, context)
+        else:
+            results = await self.executor.extract(contents,
+                                                  context["extraction_config"],
+                                                  [context] * len(contents))
+        return {
+            "event": {"rows": [result["instances"] for result in results]},
+            "context": context
+        }
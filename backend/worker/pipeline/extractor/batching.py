@@ -0,0 +1,112 @@
+"""
+packs consecutive pages into one llm request under a token and image
+budget, instances carry the page they came from so rows are attributed
+back to their pages
+"""
+import asyncio
+import copy
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+from pipeline.base.instrumentation import record
+from pipeline.extractor.rate_limiter import CHARS_PER_TOKEN
+from pipeline.model.ImageInputModel import image_data_uri
+from pipeline.model.SchemaModel import SchemaConfiguration
+
+# field added to the tool schema of batched requests
+SOURCE_PAGE_FIELD = "source_page"
+BATCH_INSTRUCTION = ("extract the relevant content of every page using extractor_tool, "
+                     f"setting {SOURCE_PAGE_FIELD} to the page each instance comes from")
+
+
+def text_tokens(text: str) -> int:
+    """rough tokens of a page's text"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def plan_batches(page_tokens: Sequence[int],
+                 max_tokens: int,
+                 max_pages: Optional[int] = None) -> List[List[int]]:
+    """
+    indexes of consecutive pages packed greedily into batches of at most
+    `max_tokens` tokens and `max_pages` pages, a page over the budget on
+    its own gets a batch to itself
+    """
+    batches: List[List[int]] = []
+    batch_tokens = 0
+    for index, tokens in enumerate(page_tokens):
+        full = batches and (batch_tokens + tokens > max_tokens or
+                            (max_pages is not None and len(batches[-1]) >= max_pages))
+        if not batches or full:
+            batches.append([])
+            batch_tokens = 0
+        batches[-1].append(index)
+        batch_tokens += tokens
+    return batches
+
+
+def batched_config(config: SchemaConfiguration) -> SchemaConfiguration:
+    """the extraction config with a required `source_page` field"""
+    config = copy.deepcopy(config)
+    config["extraction_config"]["schema"].append({
+        "name": SOURCE_PAGE_FIELD,
+        "type": "number",
+        "description": "Number of the page, as labelled in the request, the instance was extracted from"
+    })
+    return config
+
+
+def batch_text_content(texts: Sequence[str]) -> str:
+    """page texts of a batch, each under a page label counted from 1"""
+    pages = "\n\n".join(f"--- page {number} ---\n{text}"
+                        for number, text in enumerate(texts, start=1))
+    return f"{BATCH_INSTRUCTION}\n\n{pages}"
+
+
+def batch_image_content(images: Sequence[bytes], image_types: Sequence[str]) -> List[Dict[str, Any]]:
+    """message parts of a batch of page images, each after its page label"""
+    content: List[Dict[str, Any]] = [{"type": "text", "text": BATCH_INSTRUCTION}]
+    for number, (image, image_type) in enumerate(zip(images, image_types), start=1):
+        content.append({"type": "text", "text": f"page {number}"})
+        content.append({"type": "image_url", "image_url": {"url": image_data_uri(image, image_type)}})
+    return content
+
+
+def split_rows(instances: List[Dict[str, Any]], page_count: int) -> List[List[Dict[str, Any]]]:
+    """
+    instances of a batch split back into rows per page by their
+    `source_page`, which is removed, instances with no valid page are kept
+    on the batch's first page rather than dropped
+    """
+    rows: List[List[Dict[str, Any]]] = [[] for _ in range(page_count)]
+    for instance in instances:
+        instance = dict(instance)
+        page = instance.pop(SOURCE_PAGE_FIELD, None)
+        if isinstance(page, (int, float)) and not isinstance(page, bool) and 1 <= page <= page_count:
+            rows[int(page) - 1].append(instance)
+        else:
+            rows[0].append(instance)
+    return rows
+
+
+async def extract_in_batches(page_tokens: Sequence[int],
+                             max_tokens: int,
+                             max_pages: Optional[int],
+                             extract_page: Callable[[int], Awaitable[Dict[str, Any]]],
+                             extract_batch: Callable[[List[int]], Awaitable[Dict[str, Any]]],
+                             context: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+    """
+    rows of every page, pages packed into batches extracted concurrently
+    with `extract_batch`, a batch of one page goes through `extract_page` so
+    it keeps its unbatched request (and cache key), requests saved are
+    recorded as llm_requests_batched_away
+    """
+    batches = plan_batches(page_tokens, max_tokens, max_pages)
+
+    async def extract(batch: List[int]) -> List[List[Dict[str, Any]]]:
+        if len(batch) == 1:
+            return [(await extract_page(batch[0]))["instances"]]
+        return split_rows((await extract_batch(batch))["instances"], len(batch))
+
+    results = await asyncio.gather(*map(extract, batches))
+    if context is not None:
+        record(context, "llm_requests_batched_away", len(page_tokens) - len(batches))
+    return [rows for batch_rows in results for rows in batch_rows]
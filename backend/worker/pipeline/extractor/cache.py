@@ -0,0 +1,261 @@
+"""
+content-addressed cache of llm extractions, a rerun on the same pages with
+the same template reads its rows back instead of paying for them again
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+from storage3.exceptions import StorageApiError
+from pipeline.base.instrumentation import prometheus_hook
+from pipeline.model.environ.Environ import CacheBackend, get_environ
+from pipeline.runtime.clients import shared_supabase_client
+from pipeline.runtime.executor import ExecutionMode, run_blocking
+
+logger = logging.getLogger(__name__)
+
+# objects listed per storage request while evicting
+LIST_PAGE_SIZE = 1000
+
+_cache: Optional["ExtractionCache"] = None
+_cache_lock = threading.Lock()
+
+
+def _digest(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def cache_key(provider: str,
+              model: str,
+              tool: Dict[str, Any],
+              content: str | List[Dict[str, Any]],
+              temperature: float) -> str:
+    """
+    key of one extraction, the compiled tool schema and the page content
+    are hashed so any change to either misses
+    """
+    return _digest([provider, model, _digest(tool), _digest(content), temperature])
+
+
+class ExtractionCache(ABC):
+    """
+    base class for extraction caches, entries older than `ttl_seconds` are
+    never returned
+    """
+
+    def __init__(self, ttl_seconds: Optional[float] = None) -> None:
+        self.ttl_seconds = ttl_seconds
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """cached extraction for `key`, counted as a hit or a miss"""
+        try:
+            value = await self._get(key)
+        except Exception as e:
+            # a broken cache must never fail an extraction
+            logger.error(f"Error reading extraction cache: {str(e)}")
+            value = None
+        prometheus_hook.count("extraction_cache_hits" if value is not None
+                              else "extraction_cache_misses")
+        return value
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        """stores an extraction"""
+        try:
+            await self._set(key, value)
+        except Exception as e:
+            logger.error(f"Error writing extraction cache: {str(e)}")
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    @abstractmethod
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def _set(self, key: str, value: Dict[str, Any]) -> None:
+        ...
+
+
+class SQLiteExtractionCache(ExtractionCache):
+    """
+    cache in a sqlite file, the least recently read entries are evicted
+    once it holds more than `max_bytes`
+    """
+
+    def __init__(self, path: str, ttl_seconds: Optional[float] = None, max_bytes: Optional[int] = None) -> None:
+        super().__init__(ttl_seconds)
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("pragma journal_mode=wal")
+        self._connection.execute(
+            "create table if not exists extractions ("
+            "key text primary key, value text not null, size integer not null, "
+            "created_at real not null, accessed_at real not null)")
+        self._connection.execute(
+            "create index if not exists extractions_accessed_at on extractions (accessed_at)")
+
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await run_blocking(ExecutionMode.THREAD, self._read, key)
+
+    async def _set(self, key: str, value: Dict[str, Any]) -> None:
+        await run_blocking(ExecutionMode.THREAD, self._write, key, json.dumps(value))
+
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection.execute(
+                "select value, created_at from extractions where key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self._expired(row[1]):
+                self._connection.execute("delete from extractions where key = ?", (key,))
+                return None
+            self._connection.execute(
+                "update extractions set accessed_at = ? where key = ?", (time.time(), key))
+            return json.loads(row[0])
+
+    def _write(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "insert or replace into extractions values (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now))
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        if self.ttl_seconds is not None:
+            self._connection.execute(
+                "delete from extractions where created_at < ?", (now - self.ttl_seconds,))
+        if self.max_bytes is None:
+            return
+        total = self._connection.execute(
+            "select coalesce(sum(size), 0) from extractions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._connection.execute(
+                "select key, size from extractions order by accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._connection.execute("delete from extractions where key = ?", (key,))
+            total -= size
+
+
+class SupabaseExtractionCache(ExtractionCache):
+    """
+    cache in supabase storage, shared by every worker, expired entries and
+    the oldest ones beyond `max_bytes` are removed every `evict_every` writes
+    """
+
+    def __init__(self,
+                 bucket: str = "outputs",
+                 prefix: str = "cache",
+                 ttl_seconds: Optional[float] = None,
+                 max_bytes: Optional[int] = None,
+                 evict_every: int = 100) -> None:
+        super().__init__(ttl_seconds)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._writes = 0
+
+    def _path(self, key: str) -> str:
+        return f"{self.prefix}/{key}.json"
+
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        client = await shared_supabase_client()
+        try:
+            content = await client.storage.from_(self.bucket).download(self._path(key))
+        except StorageApiError as e:
+            # any other storage error is logged by `get`
+            if _not_found(e):
+                return None
+            raise
+        entry = json.loads(content)
+        if self._expired(entry["created_at"]):
+            return None
+        return entry["value"]
+
+    async def _set(self, key: str, value: Dict[str, Any]) -> None:
+        client = await shared_supabase_client()
+        await client.storage.from_(self.bucket).upload(
+            path=self._path(key),
+            file=json.dumps({"created_at": time.time(), "value": value}).encode("utf-8"),
+            file_options={"content-type": "application/json", "upsert": "true"})
+        self._writes += 1
+        if self._writes % self.evict_every == 0:
+            await self.evict()
+
+    async def evict(self) -> None:
+        """removes expired entries, then the oldest until under `max_bytes`"""
+        client = await shared_supabase_client()
+        storage = client.storage.from_(self.bucket)
+        keep_bytes = 0
+        expired: List[str] = []
+        async for item in _list_all(storage, self.prefix):
+            size = (item.get("metadata") or {}).get("size", 0)
+            too_old = self.ttl_seconds is not None and item.get("created_at") and \
+                time.time() - _timestamp(item["created_at"]) > self.ttl_seconds
+            if too_old or (self.max_bytes is not None and keep_bytes + size > self.max_bytes):
+                expired.append(f"{self.prefix}/{item['name']}")
+            else:
+                keep_bytes += size
+        if expired:
+            await storage.remove(expired)
+
+
+async def _list_all(storage: Any, prefix: str) -> AsyncIterator[Dict[str, Any]]:
+    """every object under `prefix`, newest first, one page of the listing at a time"""
+    offset = 0
+    while True:
+        objects = await storage.list(prefix, {
+            "limit": LIST_PAGE_SIZE, "offset": offset,
+            "sortBy": {"column": "created_at", "order": "desc"}})
+        for item in objects:
+            yield item
+        if len(objects) < LIST_PAGE_SIZE:
+            return
+        offset += len(objects)
+
+
+def _not_found(error: StorageApiError) -> bool:
+    # storage answers a missing object with a 400 or a 404 depending on its version
+    if str(error.status) == "404":
+        return True
+    return str(error.status) == "400" and \
+        ("not_found" in str(error.code).lower() or "not found" in str(error.message).lower())
+
+
+def _timestamp(value: str) -> float:
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def shared_extraction_cache() -> Optional[ExtractionCache]:
+    """
+    cache configured by `EXTRACTION_CACHE`, `None` when caching is off
+    """
+    global _cache
+    environ = get_environ()
+    if environ.extraction_cache is None:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            max_bytes = environ.extraction_cache_max_mb * 1024 * 1024 \
+                if environ.extraction_cache_max_mb is not None else None
+            if environ.extraction_cache == CacheBackend.SQLITE:
+                _cache = SQLiteExtractionCache(environ.extraction_cache_path,
+                                               ttl_seconds=environ.extraction_cache_ttl_seconds,
+                                               max_bytes=max_bytes)
+            else:
+                _cache = SupabaseExtractionCache(ttl_seconds=environ.extraction_cache_ttl_seconds,
+                                                 max_bytes=max_bytes)
+        return _cache
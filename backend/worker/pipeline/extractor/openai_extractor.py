@@ -1,31 +1,61 @@
 import asyncio
 import json
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 from pipeline.model.TextInputModel import TextInputModel
+from pipeline.model.PageItemModel import PageItem
 from pipeline.model.SchemaModel import SchemaConfiguration, generate_tool_schema_json
-from pipeline import PipelineStep
+from pipeline.base.streaming import StreamingPipelineStep, iterate, map_concurrently
 from pipeline.model import StepData, PagesImageInputModel
+from pipeline.model.ImageInputModel import ImageType, image_data_uri, image_types_of
+from pipeline.extractor.batching import (batch_image_content, batch_text_content, batched_config,
+                                         extract_in_batches, text_tokens)
+from pipeline.extractor.cache import cache_key, shared_extraction_cache
+from pipeline.extractor.rate_limiter import estimate_tokens, rate_limiter_for
+from pipeline.extractor.retry import MalformedToolCall, RetryPolicy, call_with_retry
+from pipeline.extractor.vision_tokens import image_tokens
+from pipeline.model.environ.Environ import get_environ
+from pipeline.runtime.clients import shared_openai_client
 from openai import AsyncClient
+from openai.types.chat import ChatCompletion
 
+TEMPERATURE = 0
 
-class OpenAIExtractor(PipelineStep):
+
+class OpenAIExtractor(StreamingPipelineStep):
     """
     base class for open ai text to format extractor
     """
 
-    def __init__(self, client: Optional[AsyncClient] = None, model: str = "gpt-4o-mini") -> None:
+    def __init__(self,
+                 client: Optional[AsyncClient] = None,
+                 model: str = "gpt-4o-mini",
+                 stream_concurrency: int = 8,
+                 batch_max_tokens: Optional[int] = None) -> None:
+        """
+        Args:
+            batch_max_tokens: Page tokens packed into one request, 0 sends
+                one request per page, `LLM_BATCH_MAX_TOKENS` by default
+        """
         if client:
             self.client = client
         else:
-            self.client = AsyncClient()
+            self.client = shared_openai_client()
 
         self.model = model
+        self.stream_concurrency = stream_concurrency
+        self.batch_max_tokens = get_environ().llm_batch_max_tokens \
+            if batch_max_tokens is None else batch_max_tokens
 
     async def process(self, data: StepData) -> StepData:
         texts_data = data["event"]
         extraction_config = data["context"]["extraction_config"]
-        response = await self.extract_format_from_all_texts(data=texts_data,
-                                                            extraction_config=extraction_config)
+        if self.batch_max_tokens:
+            response = await self.extract_format_from_text_batches(data=texts_data,
+                                                                   extraction_config=extraction_config,
+                                                                   context=data["context"])
+        else:
+            response = await self.extract_format_from_all_texts(data=texts_data,
+                                                                extraction_config=extraction_config)
         return {
             "event": {"rows": response},
             "context": data["context"]
@@ -43,6 +73,42 @@ class OpenAIExtractor(PipelineStep):
 
         return [*map(lambda result: result["instances"], results)]
 
+    async def extract_format_from_text_batches(self,
+                                               data: TextInputModel,
+                                               extraction_config: SchemaConfiguration,
+                                               context: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        extract format from texts, consecutive pages sharing requests
+        """
+        texts = data["texts"]
+        config = batched_config(extraction_config)
+        return await extract_in_batches(
+            [text_tokens(text) for text in texts],
+            self.batch_max_tokens,
+            None,
+            lambda index: self._extract_format_from_text(texts[index], extraction_config),
+            lambda batch: self._extract_format_from_text(
+                batch_text_content([texts[index] for index in batch]), config),
+            context)
+
+    def pages_from(self, data: StepData) -> AsyncIterator[PageItem]:
+        return iterate([
+            {"page_number": page_number, "text": text}
+            for page_number, text in enumerate(data["event"]["texts"], start=1)])
+
+    def stream(self, pages: AsyncIterator[PageItem], context: Dict[str, Any]) -> AsyncIterator[PageItem]:
+        async def extract(page: PageItem) -> PageItem:
+            result = await self._extract_format_from_text(
+                page["text"], context["extraction_config"])
+            return {"page_number": page["page_number"], "rows": result["instances"]}
+        return map_concurrently(pages, extract, self.stream_concurrency)
+
+    def collect(self, pages: List[PageItem], context: Dict[str, Any]) -> StepData:
+        return {
+            "event": {"rows": [page["rows"] for page in pages]},
+            "context": context
+        }
+
     async def _extract_format_from_text(self, text: bytes, extraction_config: SchemaConfiguration) -> Dict[str, Any]:
         return await tool_call_openai_model(
             client=self.client,
@@ -52,20 +118,45 @@ class OpenAIExtractor(PipelineStep):
         )
 
 
-class OpenAIImageExtractor(PipelineStep):
+class OpenAIImageExtractor(StreamingPipelineStep):
     """
     base class for openai image to format extractor
     """
 
-    def __init__(self) -> None:
-        self.client = AsyncClient()
+    def __init__(self,
+                 client: Optional[AsyncClient] = None,
+                 stream_concurrency: int = 8,
+                 batch_max_tokens: Optional[int] = None,
+                 batch_max_images: Optional[int] = None) -> None:
+        """
+        Args:
+            batch_max_tokens: Page tokens packed into one request, 0 sends
+                one request per page, `LLM_BATCH_MAX_TOKENS` by default
+            batch_max_images: Page images packed into one request,
+                `LLM_BATCH_MAX_IMAGES` by default
+        """
+        if client:
+            self.client = client
+        else:
+            self.client = shared_openai_client()
+        self.stream_concurrency = stream_concurrency
+        environ = get_environ()
+        self.batch_max_tokens = environ.llm_batch_max_tokens \
+            if batch_max_tokens is None else batch_max_tokens
+        self.batch_max_images = environ.llm_batch_max_images \
+            if batch_max_images is None else batch_max_images
 
     async def process(self, data: StepData) -> StepData:
         pages_data = {**data["event"]}
         extraction_config = {
             **data["context"]["extraction_config"]}
-        response = await self.extract_format_from_all_images(data=pages_data,
-                                                             extraction_config=extraction_config)
+        if self.batch_max_tokens:
+            response = await self.extract_format_from_image_batches(data=pages_data,
+                                                                    extraction_config=extraction_config,
+                                                                    context=data["context"])
+        else:
+            response = await self.extract_format_from_all_images(data=pages_data,
+                                                                 extraction_config=extraction_config)
         return {
             "event": {"rows": response},
             "context": data["context"]
@@ -78,63 +169,166 @@ class OpenAIImageExtractor(PipelineStep):
         extracts data from all images
         """
         tasks = [
-            self._extract_format_from_image(image, extraction_config)
-            for image in data["images"]
+            self._extract_format_from_image(image, extraction_config, image_type)
+            for image, image_type in zip(data["images"], image_types_of(data))
         ]
         results = await asyncio.gather(*tasks)
 
         return [*map(lambda result: result["instances"], results)]
 
-    async def _extract_format_from_image(self, image: str, extraction_config: SchemaConfiguration) -> Dict[str, Any]:
+    async def extract_format_from_image_batches(self,
+                                                data: PagesImageInputModel,
+                                                extraction_config: SchemaConfiguration,
+                                                context: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        extracts data from all images, consecutive pages sharing requests
+        """
+        images = data["images"]
+        image_types = image_types_of(data)
+        config = batched_config(extraction_config)
+        return await extract_in_batches(
+            [image_tokens(image) for image in images],
+            self.batch_max_tokens,
+            self.batch_max_images,
+            lambda index: self._extract_format_from_image(images[index], extraction_config, image_types[index]),
+            lambda batch: tool_call_openai_model(
+                client=self.client,
+                content=batch_image_content([images[index] for index in batch],
+                                            [image_types[index] for index in batch]),
+                extraction_config=config),
+            context)
+
+    def pages_from(self, data: StepData) -> AsyncIterator[PageItem]:
+        return iterate([
+            {"page_number": page_number, "image": image, "image_type": image_type}
+            for page_number, (image, image_type)
+            in enumerate(zip(data["event"]["images"], image_types_of(data["event"])), start=1)])
+
+    def stream(self, pages: AsyncIterator[PageItem], context: Dict[str, Any]) -> AsyncIterator[PageItem]:
+        async def extract(page: PageItem) -> PageItem:
+            result = await self._extract_format_from_image(
+                page["image"], context["extraction_config"], page.get("image_type", ImageType.JPEG))
+            return {"page_number": page["page_number"], "rows": result["instances"]}
+        return map_concurrently(pages, extract, self.stream_concurrency)
+
+    def collect(self, pages: List[PageItem], context: Dict[str, Any]) -> StepData:
+        return {
+            "event": {"rows": [page["rows"] for page in pages]},
+            "context": context
+        }
+
+    async def _extract_format_from_image(self,
+                                         image: bytes,
+                                         extraction_config: SchemaConfiguration,
+                                         image_type: str = ImageType.JPEG) -> Dict[str, Any]:
 
         return await tool_call_openai_model(
             client=self.client,
-            content=[
-                {"type": "text", "text": "extract the relevant content using extractor_tool"},
-                {
-                    "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{image}"},
-                },
-            ],
+            content=image_content(image, image_type),
             extraction_config=extraction_config
         )
 
 
+def image_content(image: bytes, image_type: str = ImageType.JPEG) -> List[Dict[str, Any]]:
+    """message content asking for the fields of one page image"""
+    return [
+        {"type": "text", "text": "extract the relevant content using extractor_tool"},
+        {
+            "type": "image_url",
+            "image_url": {"url": image_data_uri(image, image_type)},
+        },
+    ]
+
+
+def cache_provider(client: AsyncClient) -> str:
+    """
+    provider part of a cache key, the client's base url so the same model
+    name behind another endpoint (e.g. a compatible gateway) never shares
+    entries
+    """
+    return str(client.base_url)
+
+
 async def tool_call_openai_model(client: AsyncClient,
                                  content: str | List[Dict[str, Any]],
                                  extraction_config: SchemaConfiguration,
-                                 model: str = "gpt-4o-mini"
+                                 model: str = "gpt-4o-mini",
+                                 policy: Optional[RetryPolicy] = None
                                  ) -> Dict[str, Any]:
     """
-    extracts defined fields
+    extracts defined fields, retried under `policy` (the configured one by
+    default) with every attempt going through the worker's rate limiter
+    for `model`, answered from the extraction cache when it is enabled
     """
-    response = await client.chat.completions.create(
-        temperature=0,
-        model=model,
-        tools=[
+    tool = generate_tool_schema_json(extraction_config)
+    cache = shared_extraction_cache()
+    if cache is not None:
+        key = cache_key(cache_provider(client), model, tool, content, TEMPERATURE)
+        if (cached := await cache.get(key)) is not None:
+            return cached
+    generated_json = await call_with_retry(
+        lambda: _tool_call_attempt(client, content, extraction_config, model, tool),
+        policy)
+    if cache is not None:
+        await cache.set(key, generated_json)
+    return generated_json
+
+
+def chat_completion_request(content: str | List[Dict[str, Any]],
+                            extraction_config: SchemaConfiguration,
+                            model: str,
+                            tool: Dict[str, Any]) -> Dict[str, Any]:
+    """body of the chat completion forcing a call to the extraction tool"""
+    return {
+        "temperature": TEMPERATURE,
+        "model": model,
+        "tools": [
             {
                 "type": "function",
-                "function": generate_tool_schema_json(extraction_config)
+                "function": tool
             }
         ],
-        tool_choice={
+        "tool_choice": {
             "type": "function",
             "function":
                 {"name": extraction_config["extraction_config"]["name"]}
         },
-        messages=[
+        "messages": [
             {
                 "role": "user",
                 "content": content,
             }
         ]
-    )
+    }
+
+
+def tool_call_arguments(response: ChatCompletion, extraction_config: SchemaConfiguration) -> Dict[str, Any]:
+    """
+    arguments of the extraction tool call in `response`, a missing or
+    malformed call raises a MalformedToolCall
+    """
     if len(response.choices) == 0:
-        raise ValueError("there was no corrected json given")
-    if len(response.choices[0].message.tool_calls) == 0:
-        raise ValueError("there were no tool calls made")
+        raise MalformedToolCall("there was no corrected json given")
+    if not response.choices[0].message.tool_calls:
+        raise MalformedToolCall("there were no tool calls made")
     if response.choices[0].message.tool_calls[0].function.name != extraction_config["extraction_config"]["name"]:
-        raise ValueError("tool use is incorrect")
-    generated_json = json.loads(
-        response.choices[0].message.tool_calls[0].function.arguments)
-    return generated_json
+        raise MalformedToolCall("tool use is incorrect")
+    try:
+        return json.loads(
+            response.choices[0].message.tool_calls[0].function.arguments)
+    except json.JSONDecodeError as e:
+        raise MalformedToolCall(f"tool call arguments are not json: {str(e)}") from e
+
+
+async def _tool_call_attempt(client: AsyncClient,
+                             content: str | List[Dict[str, Any]],
+                             extraction_config: SchemaConfiguration,
+                             model: str,
+                             tool: Dict[str, Any]) -> Dict[str, Any]:
+    limiter = rate_limiter_for(model)
+    async with limiter.limit(estimate_tokens(content, tool)):
+        raw_response = await client.chat.completions.with_raw_response.create(
+            **chat_completion_request(content, extraction_config, model, tool))
+        limiter.observe(raw_response.headers)
+    # malformed arguments raise a MalformedToolCall too, and are retried
+    return tool_call_arguments(raw_response.parse(), extraction_config)
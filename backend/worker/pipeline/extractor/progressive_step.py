@@ -0,0 +1,141 @@
+"""
+progressive resolution extraction, pages are rendered small first and only
+re-rendered larger when their extraction looks wrong
+"""
+import asyncio
+import math
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from openai import AsyncClient
+from pdf2image import pdfinfo_from_bytes
+from pipeline.base import PipelineStep
+from pipeline.base.instrumentation import record
+from pipeline.extractor.openai_extractor import OpenAIExtractor, OpenAIImageExtractor
+from pipeline.extractor.retry import MalformedToolCall
+from pipeline.extractor.text.ocr_extractor import OCRExtractor
+from pipeline.image.pdf_to_jpg_step import page_runs, render_page_range, split_page_range
+from pipeline.model.SchemaModel import SchemaConfiguration, validate_instances
+from pipeline.model.StepDataModel import StepData
+from pipeline.model.environ.Environ import get_environ
+from pipeline.runtime.executor import ExecutionMode, cpu_worker_count, run_blocking
+
+
+class ProgressiveImageExtractor(PipelineStep):
+    """
+    renders every page of a pdf at the lowest of `dpis` and extracts it,
+    a page is re-rendered at the next resolution and extracted again only
+    when its rows fail schema validation, come back empty or, in ocr mode,
+    were read with low confidence
+
+    each resolution is rendered as one wave of page-range chunks, one per
+    process of the shared pool, only the escalated pages are rendered again
+
+    outputs `rows` in page order and `page_dpis`, the resolution each
+    page's rows were extracted at
+    """
+
+    def __init__(self,
+                 dpis: Sequence[int] = (100, 200, 300),
+                 ocr: bool = False,
+                 min_ocr_confidence: float = 60.0,
+                 min_chunk_pages: int = 4,
+                 client: Optional[AsyncClient] = None) -> None:
+        """
+        Args:
+            dpis: Resolutions to try, lowest first
+            ocr: Read pages with tesseract and extract from the text instead
+                of sending the images to the vision model
+            min_ocr_confidence: Mean word confidence (0-100) below which an
+                ocr'd page is escalated
+            min_chunk_pages: Smallest chunk worth its own poppler call
+        """
+        self.dpis = sorted(dpis)
+        self.ocr = ocr
+        self.min_ocr_confidence = min_ocr_confidence
+        self.min_chunk_pages = min_chunk_pages
+        self.ocr_extractor = OCRExtractor(layout=get_environ().ocr_layout)
+        self.text_extractor = OpenAIExtractor(client=client)
+        self.image_extractor = OpenAIImageExtractor(client=client)
+
+    async def process(self, data: StepData) -> StepData:
+        event = data["event"]
+        pdf_bytes = event["file_bytes"]
+        page_numbers = await self._page_numbers(event)
+        extracted: Dict[int, Tuple[List[Dict[str, Any]], int]] = {}
+        pending = sorted(set(page_numbers))
+        for attempt, dpi in enumerate(self.dpis):
+            last = attempt == len(self.dpis) - 1
+            images = await self._render(pdf_bytes, pending, dpi)
+            results = await asyncio.gather(*[
+                self._extract_page(image, data["context"], last)
+                for image in images])
+            escalated: List[int] = []
+            for page_number, rows in zip(pending, results):
+                if rows is None:
+                    escalated.append(page_number)
+                else:
+                    extracted[page_number] = (rows, dpi)
+            pending = escalated
+            if not pending:
+                break
+        return {
+            "event": {
+                "rows": [extracted[page_number][0] for page_number in page_numbers],
+                "page_dpis": [extracted[page_number][1] for page_number in page_numbers]
+            },
+            "context": data["context"]
+        }
+
+    async def _render(self, pdf_bytes: bytes, page_numbers: List[int], dpi: int) -> List[bytes]:
+        """
+        images of `page_numbers` (in ascending order) at `dpi`, consecutive
+        pages are rendered together in chunks spread over the process pool
+        """
+        runs = page_runs(page_numbers)
+        chunk_pages = max(self.min_chunk_pages, math.ceil(len(page_numbers) / cpu_worker_count()))
+        chunks = [chunk for run in runs for chunk in split_page_range(run, chunk_pages)]
+        rendered: List[List[bytes]] = await asyncio.gather(*[
+            run_blocking(ExecutionMode.PROCESS, render_page_range,
+                         pdf_bytes, chunk["first_page"], chunk["last_page"], dpi)
+            for chunk in chunks])
+        return [image for images in rendered for image in images]
+
+    async def _extract_page(self,
+                            image: bytes,
+                            context: Dict[str, Any],
+                            last: bool) -> Optional[List[Dict[str, Any]]]:
+        """rows of one page image, `None` when the page should be escalated"""
+        config: SchemaConfiguration = context["extraction_config"]
+        try:
+            rows, confident = await self._extract_image(image, config)
+        except MalformedToolCall:
+            # the model made no usable tool call, a sharper page may help
+            if last:
+                raise
+            record(context, "progressive_escalations")
+            return None
+        if last or (confident and rows and not validate_instances(rows, config)):
+            return rows
+        record(context, "progressive_escalations")
+        return None
+
+    async def _extract_image(self,
+                             image: bytes,
+                             config: SchemaConfiguration) -> Tuple[List[Dict[str, Any]], bool]:
+        """rows of one page image and whether the page was read confidently"""
+        if not self.ocr:
+            [rows] = await self.image_extractor.extract_format_from_all_images(
+                {"images": [image]}, config)
+            return rows, True
+        text, confidence = await self.ocr_extractor.recognise_with_confidence(image)
+        [rows] = await self.text_extractor.extract_format_from_all_texts(
+            {"texts": [text]}, config)
+        return rows, confidence >= self.min_ocr_confidence
+
+    async def _page_numbers(self, event: Dict[str, Any]) -> List[int]:
+        if event.get("pages") is not None:
+            return list(event["pages"])
+        page_range = event.get("page_range")
+        if not page_range:
+            info = await run_blocking(ExecutionMode.THREAD, pdfinfo_from_bytes, event["file_bytes"])
+            page_range = {"first_page": 1, "last_page": info["Pages"]}
+        return list(range(page_range["first_page"], page_range["last_page"] + 1))
@@ -0,0 +1,237 @@
+"""
+worker-wide rate limiting of llm calls, per model
+
+every request waits for a concurrency slot and for room in a requests and
+a tokens per minute bucket, the buckets follow the provider's
+x-ratelimit-* headers and the concurrency adapts additively on success and
+multiplicatively on 429s, so the worker sits at the provider limit rather
+than over it
+"""
+import asyncio
+import math
+import re
+import threading
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional
+from openai import RateLimitError
+from pipeline.extractor.vision_tokens import image_url_tokens
+from pipeline.model.environ.Environ import get_environ
+
+# provider durations, e.g. 1s, 6m0s, 20ms
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+# back off for this long when a 429 carries no retry hint
+DEFAULT_RETRY_AFTER = 1.0
+# characters per token when estimating a prompt
+CHARS_PER_TOKEN = 4
+
+_limiters: Dict[str, "ModelRateLimiter"] = {}
+_limiters_lock = threading.Lock()
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """seconds of a provider reset duration, `None` when missing or malformed"""
+    if not value:
+        return None
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_SECONDS[unit] for amount, unit in parts)
+
+
+def retry_after(headers: Mapping[str, str]) -> float:
+    """seconds a rate limited response asks to wait"""
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return parse_duration(headers.get("x-ratelimit-reset-requests")) or DEFAULT_RETRY_AFTER
+
+
+def estimate_tokens(content: str | List[Dict[str, Any]], tool: Dict[str, Any]) -> int:
+    """rough prompt tokens of a request, counted against the tokens bucket"""
+    tokens = len(json.dumps(tool)) // CHARS_PER_TOKEN
+    if isinstance(content, str):
+        return tokens + len(content) // CHARS_PER_TOKEN
+    for part in content:
+        if part.get("type") == "image_url":
+            tokens += image_url_tokens(part["image_url"]["url"])
+        else:
+            tokens += len(part.get("text", "")) // CHARS_PER_TOKEN
+    return tokens
+
+
+def _header_int(headers: Mapping[str, str], name: str) -> Optional[int]:
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    bucket refilled continuously up to `capacity` per minute, unlimited
+    while the capacity is unknown
+    """
+
+    def __init__(self, per_minute: Optional[int] = None) -> None:
+        self.capacity: Optional[float] = per_minute
+        self.available: float = per_minute or 0
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.available = min(self.capacity,
+                                 self.available + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """seconds until `amount` is available, 0 when it can be taken now"""
+        self._refill()
+        if self.capacity is None:
+            return 0.0
+        # a request larger than the bucket waits for a full bucket only
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing * 60 / self.capacity)
+
+    def take(self, amount: float) -> None:
+        """takes `amount`, the bucket may go negative to be repaid by refills"""
+        self._refill()
+        if self.capacity is not None:
+            self.available -= amount
+
+    def update(self, limit: Optional[int], remaining: Optional[int], reset: Optional[float]) -> None:
+        """
+        aligns the bucket with the provider's view, `remaining` lags the
+        requests still in flight so it only ever lowers the level, unless the
+        provider's window has just reset
+        """
+        self._refill()
+        learned = self.capacity is None
+        if limit is not None:
+            self.capacity = limit
+        if remaining is not None:
+            if learned or reset == 0:
+                self.available = remaining
+            else:
+                self.available = min(self.available, remaining)
+        elif learned and self.capacity is not None:
+            self.available = self.capacity
+
+    def pause(self, seconds: float) -> None:
+        """empties the bucket so it takes `seconds` to allow requests again"""
+        self._refill()
+        if self.capacity is not None:
+            self.available = min(self.available, -seconds * self.capacity / 60)
+
+
+class AIMDConcurrency:
+    """
+    concurrency limit raised by one per window of successful requests and
+    halved on every rate limited one, other failures leave it as it is
+    """
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1) -> None:
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.in_flight = 0
+        self._changed = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        """waits for a free slot"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_flight < math.floor(self.limit))
+            self.in_flight += 1
+
+    async def release(self, succeeded: bool, rate_limited: bool = False) -> None:
+        """frees a slot and adapts the limit to the request's outcome"""
+        async with self._changed:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._changed.notify_all()
+
+
+class ModelRateLimiter:
+    """
+    limits the requests one worker sends to one model
+    """
+
+    def __init__(self,
+                 requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None,
+                 initial_concurrency: int = 8,
+                 max_concurrency: int = 64) -> None:
+        """
+        Args:
+            requests_per_minute: Known request limit, otherwise learned from headers
+            tokens_per_minute: Known token limit, otherwise learned from headers
+            initial_concurrency: Requests in flight before any feedback
+            max_concurrency: Requests in flight the limit may grow to
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AIMDConcurrency(initial_concurrency, max_concurrency)
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def limit(self, tokens: int) -> AsyncIterator["ModelRateLimiter"]:
+        """
+        holds a slot for one request of about `tokens` tokens, a request
+        failing with a 429 halves the concurrency and pauses the buckets
+        for as long as the provider asks
+        """
+        await self.concurrency.acquire()
+        succeeded = rate_limited = False
+        try:
+            await self._reserve(tokens)
+            yield self
+            succeeded = True
+        except RateLimitError as e:
+            rate_limited = True
+            self.observe(e.response.headers)
+            wait = retry_after(e.response.headers)
+            self.requests.pause(wait)
+            self.tokens.pause(wait)
+            raise
+        finally:
+            await self.concurrency.release(succeeded, rate_limited)
+
+    async def _reserve(self, tokens: int) -> None:
+        # one waiter at a time, so requests are admitted in order
+        async with self._lock:
+            while (wait := max(self.requests.wait_time(1), self.tokens.wait_time(tokens))) > 0:
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+    def observe(self, headers: Mapping[str, str]) -> None:
+        """updates the buckets from a response's x-ratelimit-* headers"""
+        self.requests.update(_header_int(headers, "x-ratelimit-limit-requests"),
+                             _header_int(headers, "x-ratelimit-remaining-requests"),
+                             parse_duration(headers.get("x-ratelimit-reset-requests")))
+        self.tokens.update(_header_int(headers, "x-ratelimit-limit-tokens"),
+                           _header_int(headers, "x-ratelimit-remaining-tokens"),
+                           parse_duration(headers.get("x-ratelimit-reset-tokens")))
+
+
+def rate_limiter_for(model: str) -> ModelRateLimiter:
+    """
+    limiter shared by every extractor calling `model` in this worker
+    """
+    with _limiters_lock:
+        if model not in _limiters:
+            environ = get_environ()
+            _limiters[model] = ModelRateLimiter(
+                requests_per_minute=environ.llm_requests_per_minute,
+                tokens_per_minute=environ.llm_tokens_per_minute,
+                initial_concurrency=environ.llm_initial_concurrency,
+                max_concurrency=environ.llm_max_concurrency)
+        return _limiters[model]
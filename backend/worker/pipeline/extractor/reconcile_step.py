@@ -0,0 +1,43 @@
+"""
+reconciles rows extracted from the same pages by different branches
+"""
+from typing import Any, Dict, List
+from pipeline.base.dag import JoinStep
+from pipeline.model.StepDataModel import StepData
+
+
+class ReconcileRowsStep(JoinStep):
+    """
+    join step picking, page by page, the rows of whichever branch filled in
+    the most fields, e.g. ocr text extraction against image extraction of the
+    same rasterized pages
+    """
+
+    def __init__(self, primary: str) -> None:
+        """
+        Args:
+            primary: Input whose rows win ties
+        """
+        self.primary = primary
+
+    async def join(self, inputs: Dict[str, StepData]) -> StepData:
+        ordered = [self.primary] + \
+            [name for name in inputs if name != self.primary]
+        branches = [inputs[name]["event"]["rows"] for name in ordered]
+        page_count = max(len(rows) for rows in branches)
+        rows = []
+        for page_index in range(page_count):
+            candidates = [branch[page_index]
+                          for branch in branches if page_index < len(branch)]
+            # max keeps the first (primary) candidate on ties
+            rows.append(max(candidates, key=self._filled_fields))
+        return {
+            "event": {"rows": rows},
+            "context": inputs[self.primary]["context"]
+        }
+
+    def _filled_fields(self, instances: List[Dict[str, Any]]) -> int:
+        return sum(1
+                   for instance in instances
+                   for value in instance.values()
+                   if value not in (None, "", []))
@@ -0,0 +1,127 @@
+"""
+retries, deadlines and hedging for single llm calls, a failing page is
+retried on its own instead of failing its document
+"""
+import asyncio
+import random
+from typing import Awaitable, Callable, Optional, Set, TypeVar
+from openai import APIConnectionError, APIStatusError, APITimeoutError, InternalServerError, RateLimitError
+from pipeline.base.instrumentation import prometheus_hook
+from pipeline.extractor.rate_limiter import retry_after
+from pipeline.model.environ.Environ import get_environ
+
+T = TypeVar("T")
+
+
+class MalformedToolCall(ValueError):
+    """
+    the model answered without a usable tool call, raised from
+    `tool_call_arguments` and retried since another sample may be fine
+    """
+
+
+class RetryPolicy:
+    """
+    how often and how patiently a call is attempted
+    """
+
+    def __init__(self,
+                 max_attempts: int = 4,
+                 base_delay: float = 0.5,
+                 max_delay: float = 30.0,
+                 attempt_timeout: Optional[float] = 120.0,
+                 hedge_after: Optional[float] = None) -> None:
+        """
+        Args:
+            max_attempts: Attempts before the last error is raised
+            base_delay: Backoff ceiling of the first retry, doubled per retry
+            max_delay: Largest backoff ceiling
+            attempt_timeout: Seconds an attempt, hedges included, may take
+            hedge_after: Seconds after which a slow attempt gets a duplicate
+                request racing it, `None` never hedges
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.hedge_after = hedge_after
+
+
+def default_retry_policy() -> RetryPolicy:
+    """policy configured by the `LLM_*` settings"""
+    environ = get_environ()
+    return RetryPolicy(max_attempts=environ.llm_max_attempts,
+                       attempt_timeout=environ.llm_attempt_timeout,
+                       hedge_after=environ.llm_hedge_after)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    rate limits, server errors, timeouts, dropped connections and malformed
+    tool calls may succeed on another attempt, any other error (e.g. a
+    validation error from a bug) would fail every attempt the same way
+    """
+    return isinstance(error, (RateLimitError, InternalServerError, APITimeoutError,
+                              APIConnectionError, asyncio.TimeoutError, MalformedToolCall))
+
+
+def backoff_delay(attempt: int, error: BaseException, policy: RetryPolicy) -> float:
+    """
+    seconds to wait before retry `attempt` (1-indexed), the provider's
+    retry-after when it sent one, full jitter exponential backoff otherwise,
+    a 429 only gets the jitter since the rate limiter already paused its
+    buckets for the retry-after
+    """
+    if isinstance(error, APIStatusError) and not isinstance(error, RateLimitError) and \
+            any(name in error.response.headers for name in ("retry-after", "retry-after-ms")):
+        return retry_after(error.response.headers)
+    return random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1)))
+
+
+async def _hedged(attempt: Callable[[], Awaitable[T]], hedge_after: Optional[float]) -> T:
+    first = asyncio.ensure_future(attempt())
+    pending: Set[asyncio.Future] = {first}
+    try:
+        if hedge_after is None:
+            return await first
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if done:
+            return first.result()
+        prometheus_hook.count("llm_hedges")
+        second = asyncio.ensure_future(attempt())
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        prometheus_hook.count("llm_hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_with_retry(attempt: Callable[[], Awaitable[T]],
+                          policy: Optional[RetryPolicy] = None) -> T:
+    """
+    awaits `attempt()` until it succeeds, retrying retryable errors with
+    backoff, every attempt has its own deadline and may be hedged, counted
+    as llm_attempts, llm_retries, llm_hedges, llm_hedge_wins and
+    llm_failures in the process metrics
+    """
+    policy = policy or default_retry_policy()
+    for attempt_number in range(1, policy.max_attempts + 1):
+        prometheus_hook.count("llm_attempts")
+        try:
+            return await asyncio.wait_for(_hedged(attempt, policy.hedge_after),
+                                          timeout=policy.attempt_timeout)
+        except Exception as e:
+            if attempt_number == policy.max_attempts or not is_retryable(e):
+                prometheus_hook.count("llm_failures")
+                raise
+            prometheus_hook.count("llm_retries")
+            await asyncio.sleep(backoff_delay(attempt_number, e, policy))
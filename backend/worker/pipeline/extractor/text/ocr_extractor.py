@@ -1,28 +1,104 @@
 """
 ocr extraction
 """
-import base64
+import asyncio
 from io import BytesIO
+from typing import Any, AsyncIterator, Dict, List, Tuple
 from PIL import Image
-from pytesseract import image_to_string
+from pytesseract import Output, image_to_data, image_to_string
 from pipeline.model.ImageInputModel import PagesImageInputModel
+from pipeline.model.PageItemModel import PageItem
 from pipeline.model.StepDataModel import StepData
-from pipeline.base.pipeline_step import PipelineStep
+from pipeline.base.streaming import StreamingPipelineStep, iterate, map_concurrently
+from pipeline.ocr.layout import layout_text, parse_tsv
+from pipeline.ocr.tesseract_pool import shared_tesseract_pool, tesserocr_available
+from pipeline.runtime.executor import ExecutionMode
 
 
-class OCRExtractor(PipelineStep):
+class OCRExtractor(StreamingPipelineStep):
     """
     base class for extracting text from images
+
+    pages go to warm engines in the shared tesseract pool when tesserocr is
+    installed, otherwise each page spawns a tesseract subprocess, in layout
+    mode rows and columns are rebuilt from word boxes and tables come out as
+    markdown tables
     """
+    # without tesserocr, tesseract runs as a subprocess, threads only wait on it
+    execution_mode = ExecutionMode.THREAD
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, stream_concurrency: int = 4, layout: bool = False) -> None:
+        """
+        Args:
+            stream_concurrency: Pages recognised at once when streaming
+            layout: Rebuild the page layout from word boxes instead of
+                returning tesseract's plain text
+        """
+        self.stream_concurrency = stream_concurrency
+        self.layout = layout
 
     async def process(self, data: StepData) -> StepData:
         pages_data: PagesImageInputModel = {**data["event"]}
         images = pages_data["images"]
-        texts = [image_to_string(Image.open(BytesIO(base64.b64decode(image))))
-                 for image in images]
+        texts = await asyncio.gather(*[self.recognise(image) for image in images])
         return {"event": {
             "texts": texts
         }, "context": data["context"]}
+
+    def pages_from(self, data: StepData) -> AsyncIterator[PageItem]:
+        return iterate([
+            {"page_number": page_number, "image": image}
+            for page_number, image in enumerate(data["event"]["images"], start=1)])
+
+    def stream(self, pages: AsyncIterator[PageItem], context: Dict[str, Any]) -> AsyncIterator[PageItem]:
+        async def recognise(page: PageItem) -> PageItem:
+            text = await self.recognise(page["image"])
+            return {"page_number": page["page_number"], "text": text}
+        return map_concurrently(pages, recognise, self.stream_concurrency)
+
+    def collect(self, pages: List[PageItem], context: Dict[str, Any]) -> StepData:
+        return {"event": {
+            "texts": [page["text"] for page in pages]
+        }, "context": context}
+
+    async def recognise(self, image: bytes) -> str:
+        """text of an encoded page"""
+        if self.layout:
+            if tesserocr_available():
+                tsv = await shared_tesseract_pool().recognise_tsv(image)
+            else:
+                tsv = await self.offload(self._recognise_tsv, image)
+            return layout_text(parse_tsv(tsv))
+        if tesserocr_available():
+            return await shared_tesseract_pool().recognise(image)
+        return await self.offload(self._recognise, image)
+
+    async def recognise_with_confidence(self, image: bytes) -> Tuple[str, float]:
+        """
+        text of a page and tesseract's mean word confidence (0-100), low
+        confidence usually means the page was rendered too small
+        """
+        if tesserocr_available():
+            return await shared_tesseract_pool().recognise_with_confidence(image)
+        return await self.offload(self._recognise_with_confidence, image)
+
+    def _recognise(self, image: bytes) -> str:
+        return image_to_string(Image.open(BytesIO(image)))
+
+    def _recognise_tsv(self, image: bytes) -> str:
+        return image_to_data(Image.open(BytesIO(image)))
+
+    def _recognise_with_confidence(self, image: bytes) -> Tuple[str, float]:
+        data = image_to_data(Image.open(BytesIO(image)),
+                             output_type=Output.DICT)
+        lines: Dict[Tuple[int, int, int], List[str]] = {}
+        confidences: List[float] = []
+        for index, word in enumerate(data["text"]):
+            confidence = float(data["conf"][index])
+            if confidence < 0 or not word.strip():
+                continue
+            line = (data["block_num"][index], data["par_num"][index], data["line_num"][index])
+            lines.setdefault(line, []).append(word)
+            confidences.append(confidence)
+        text = "\n".join(" ".join(words) for words in lines.values())
+        return text, sum(confidences) / len(confidences) if confidences else 0.0
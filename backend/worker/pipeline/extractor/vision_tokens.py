@@ -0,0 +1,54 @@
+"""
+estimates of the tokens openai vision models bill for an image
+"""
+import base64
+import binascii
+import math
+from io import BytesIO
+from PIL import Image
+
+# high detail images are scaled to fit this square, then their shortest
+# side down to TILE_SHORT_SIDE, and billed per 512px tile
+FIT_SIDE = 2048
+TILE_SHORT_SIDE = 768
+TILE_SIDE = 512
+BASE_TOKENS = 85
+TILE_TOKENS = 170
+# size assumed for images that cannot be read, a page rendered at 200 dpi
+DEFAULT_SIZE = (1700, 2200)
+
+
+def estimate_vision_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    tokens billed for a width x height image at the given detail
+    """
+    if detail == "low":
+        return BASE_TOKENS
+    scale = min(1.0, FIT_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, TILE_SHORT_SIDE / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / TILE_SIDE) * math.ceil(height / TILE_SIDE)
+    return BASE_TOKENS + TILE_TOKENS * tiles
+
+
+def image_tokens(image: bytes) -> int:
+    """
+    tokens billed for an encoded image at high detail, only its header is
+    read for the size
+    """
+    try:
+        size = Image.open(BytesIO(image)).size
+    except Exception:
+        size = DEFAULT_SIZE
+    return estimate_vision_tokens(*size)
+
+
+def image_url_tokens(url: str) -> int:
+    """tokens billed for an image_url part, a data uri or a link"""
+    if not url.startswith("data:"):
+        return estimate_vision_tokens(*DEFAULT_SIZE)
+    try:
+        return image_tokens(base64.b64decode(url.partition(",")[2]))
+    except (binascii.Error, ValueError):
+        return estimate_vision_tokens(*DEFAULT_SIZE)
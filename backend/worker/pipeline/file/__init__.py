@@ -1,6 +1,11 @@
 """exports file"""
 from .gotenberg_step import GotenbergPipelineStep
+from .hash_step import FileHashStep
+from .text_layer_step import TextLayerStep, MergeTextLayerRowsStep
 
 __all__ = (
     "GotenbergPipelineStep",
+    "FileHashStep",
+    "TextLayerStep",
+    "MergeTextLayerRowsStep",
 )
@@ -2,7 +2,7 @@
 from typing import Dict, Tuple, TypedDict
 from pipeline.model.StepDataModel import StepData
 from pipeline.base import PipelineStep
-from httpx import AsyncClient, AsyncHTTPTransport
+from pipeline.runtime.clients import shared_http_client
 
 
 class FileInputModel(TypedDict):
@@ -149,17 +149,14 @@ class GotenbergPipelineStep(PipelineStep):
     pipeline step to convert incoming files to pdf
     """
 
+    # using gotenberg's default url
+    base_url = "https://demo.gotenberg.dev/forms"
+
     def __init__(self) -> None:
         """
         initialise file handler
         """
-        self.client = AsyncClient(
-            # using gotenberg's default url
-            base_url="https://demo.gotenberg.dev/forms",
-            transport=AsyncHTTPTransport(
-                retries=5
-            )
-        )
+        self.client = shared_http_client()
 
     async def process(self, data: StepData) -> StepData:
         """
@@ -196,7 +193,7 @@ class GotenbergPipelineStep(PipelineStep):
             filename = file["filename"]
 
         response = await self.client.post(
-            url=gotenberg_path,
+            url=f"{self.base_url}{gotenberg_path}",
             files={
                 "files": (filename, file["file_bytes"], file["mimetype"])
             },
@@ -0,0 +1,29 @@
+"""pipeline step hashing incoming files"""
+import hashlib
+from pipeline.model.StepDataModel import StepData
+from pipeline.base import PipelineStep
+from pipeline.runtime.executor import ExecutionMode
+
+
+class FileHashStep(PipelineStep):
+    """
+    pipeline step computing the sha256 of the incoming file bytes, can run
+    alongside conversion in a DAGPipeline
+    """
+    # hashlib releases the gil on large inputs
+    execution_mode = ExecutionMode.THREAD
+
+    async def process(self, data: StepData) -> StepData:
+        """
+        hashes file bytes off the event loop
+        """
+        file_bytes: bytes = data["event"]["file_bytes"]
+        digest = await self.offload(
+            lambda: hashlib.sha256(file_bytes).hexdigest())
+        return {
+            "event": {
+                "sha256": digest,
+                "size": len(file_bytes)
+            },
+            "context": data["context"]
+        }
@@ -0,0 +1,114 @@
+"""
+text layer detection, born-digital pages skip rasterization and ocr
+"""
+from typing import Dict, List, Optional
+import pymupdf
+from pipeline.base import PipelineStep
+from pipeline.base.dag import JoinStep
+from pipeline.model.StepDataModel import StepData
+from pipeline.model.WorkItemModel import PageRange
+from pipeline.runtime.executor import ExecutionMode
+
+# share of characters that may be undecodable glyphs before a page's text
+# layer is treated as unusable, e.g. fonts without a unicode mapping
+MAX_UNDECODABLE_RATIO = 0.1
+
+
+def read_text_layer(pdf_bytes: bytes,
+                    first_page: Optional[int] = None,
+                    last_page: Optional[int] = None) -> List[str]:
+    """
+    extracts the embedded text of a page range, module level so it can run
+    in the shared process pool
+    """
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as document:
+        first_page = first_page or 1
+        last_page = last_page or document.page_count
+        return [document[page_index].get_text()
+                for page_index in range(first_page - 1, last_page)]
+
+
+def is_usable_text(text: str, min_chars: int) -> bool:
+    """whether a page's text layer carries enough real text to extract from"""
+    characters = [character for character in text if not character.isspace()]
+    if len(characters) < min_chars:
+        return False
+    undecodable = sum(1 for character in characters if character == "\ufffd")
+    return undecodable / len(characters) <= MAX_UNDECODABLE_RATIO
+
+
+class TextLayerStep(PipelineStep):
+    """
+    splits a pdf's pages by whether their text layer is usable
+
+    keeps the incoming event and adds `texts` / `text_pages` for pages with
+    usable text, which go straight to a text extractor, and `pages` for the
+    rest, the only pages `PDFToJPGStep` then renders
+    """
+    # parsing the pdf is cpu-bound
+    execution_mode = ExecutionMode.PROCESS
+
+    def __init__(self, min_chars: int = 200) -> None:
+        """
+        Args:
+            min_chars: Non-whitespace characters a page needs to be extracted from its text
+        """
+        self.min_chars = min_chars
+
+    async def process(self, data: StepData) -> StepData:
+        page_range: PageRange = data["event"].get("page_range") or {}
+        first_page = page_range.get("first_page") or 1
+        texts: List[str] = await self.offload(read_text_layer,
+                                              data["event"]["file_bytes"],
+                                              page_range.get("first_page"),
+                                              page_range.get("last_page"))
+        text_pages: Dict[int, str] = {}
+        image_pages: List[int] = []
+        for page_number, text in enumerate(texts, start=first_page):
+            if is_usable_text(text, self.min_chars):
+                text_pages[page_number] = text
+            else:
+                image_pages.append(page_number)
+        return {
+            "event": {
+                **data["event"],
+                "texts": list(text_pages.values()),
+                "text_pages": list(text_pages.keys()),
+                "pages": image_pages
+            },
+            "context": data["context"]
+        }
+
+
+class MergeTextLayerRowsStep(JoinStep):
+    """
+    merges rows extracted from text layer pages and from rendered pages back
+    into page order, using the page split made by `TextLayerStep`
+    """
+
+    def __init__(self,
+                 layer: str = "layer",
+                 text_rows: str = "text_rows",
+                 image_rows: str = "image_rows") -> None:
+        """
+        Args:
+            layer: Input holding the `TextLayerStep` output
+            text_rows: Input holding rows of the text layer pages
+            image_rows: Input holding rows of the rendered pages
+        """
+        self.layer = layer
+        self.text_rows = text_rows
+        self.image_rows = image_rows
+
+    async def join(self, inputs: Dict[str, StepData]) -> StepData:
+        layer = inputs[self.layer]["event"]
+        rows_by_page = {
+            **dict(zip(layer["text_pages"], inputs[self.text_rows]["event"]["rows"])),
+            **dict(zip(layer["pages"], inputs[self.image_rows]["event"]["rows"]))
+        }
+        return {
+            "event": {
+                "rows": [rows_by_page[page_number] for page_number in sorted(rows_by_page)]
+            },
+            "context": inputs[self.layer]["context"]
+        }
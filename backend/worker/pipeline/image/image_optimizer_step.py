@@ -0,0 +1,218 @@
+"""
+shrinks rendered pages before they are sent to a vision model
+"""
+import asyncio
+import math
+from io import BytesIO
+from typing import Any, AsyncIterator, Dict, List, Sequence, Tuple, TypedDict
+import numpy as np
+from PIL import Image
+from pipeline.base.instrumentation import record
+from pipeline.base.streaming import StreamingPipelineStep, iterate, map_concurrently
+from pipeline.extractor.vision_tokens import FIT_SIDE, TILE_SHORT_SIDE, estimate_vision_tokens
+from pipeline.model.ImageInputModel import ImageType, image_types_of
+from pipeline.model.PageItemModel import PageItem
+from pipeline.model.StepDataModel import StepData
+from pipeline.runtime.executor import ExecutionMode
+
+# channel spread above which a pixel counts as coloured
+CHROMA_THRESHOLD = 24
+# pages with fewer coloured pixels than this share are sent as grayscale
+MAX_COLOURED_RATIO = 0.005
+PIL_FORMATS = {
+    ImageType.JPEG: "JPEG",
+    ImageType.WEBP: "WEBP",
+    ImageType.PNG: "PNG",
+}
+
+
+class OptimizedImage(TypedDict):
+    """
+    one page after optimization, with its size and token cost before and after
+    """
+    image: bytes
+    image_type: ImageType
+    bytes_before: int
+    bytes_after: int
+    tokens_before: int
+    tokens_after: int
+
+
+def fit_for_vision(width: int, height: int,
+                   fit_side: int = FIT_SIDE,
+                   short_side: int = TILE_SHORT_SIDE) -> Tuple[int, int]:
+    """
+    size the provider scales an image down to anyway, pixels beyond it only
+    cost upload time, a smaller `short_side` also saves tokens
+    """
+    scale = min(1.0, fit_side / max(width, height), short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def is_monochrome(image: Image.Image) -> bool:
+    """whether a page carries next to no colour, e.g. a scanned letter"""
+    pixels = np.asarray(image.convert("RGB"), dtype=np.int16)
+    chroma = pixels.max(axis=2) - pixels.min(axis=2)
+    return float((chroma > CHROMA_THRESHOLD).mean()) < MAX_COLOURED_RATIO
+
+
+def psnr(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """peak signal to noise ratio in db, higher is closer to the reference"""
+    mse = float(np.mean((reference.astype(np.float32) - candidate.astype(np.float32)) ** 2))
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def _encode(image: Image.Image, image_type: ImageType, quality: int) -> bytes:
+    with BytesIO() as output:
+        if image_type == ImageType.PNG:
+            image.save(output, format="PNG", optimize=True)
+        else:
+            image.save(output, format=PIL_FORMATS[image_type], quality=quality)
+        return output.getvalue()
+
+
+def _smallest_encoding(image: Image.Image,
+                       image_type: ImageType,
+                       min_psnr: float,
+                       qualities: Tuple[int, int]) -> bytes:
+    """lowest quality of a lossy format still meeting `min_psnr`, by bisection"""
+    reference = np.asarray(image)
+    low, high = qualities
+    best = _encode(image, image_type, high)
+    while low <= high:
+        quality = (low + high) // 2
+        encoded = _encode(image, image_type, quality)
+        decoded = np.asarray(Image.open(BytesIO(encoded)).convert(image.mode))
+        if psnr(reference, decoded) >= min_psnr:
+            best, high = encoded, quality - 1
+        else:
+            low = quality + 1
+    return best
+
+
+def optimize_image(image: bytes,
+                   image_type: str = ImageType.JPEG,
+                   min_psnr: float = 32.0,
+                   formats: Sequence[ImageType] = (ImageType.WEBP, ImageType.JPEG, ImageType.PNG),
+                   qualities: Tuple[int, int] = (30, 95),
+                   short_side: int = TILE_SHORT_SIDE) -> OptimizedImage:
+    """
+    resizes an encoded page to what the vision model actually sees, drops
+    colour from monochrome pages and re-encodes it in the smallest of
+    `formats` that stays within `min_psnr` of the resized page, module
+    level so it can run in the shared process pool
+    """
+    page = Image.open(BytesIO(image))
+    page.load()
+    tokens_before = estimate_vision_tokens(*page.size)
+    page = page.convert("L" if is_monochrome(page) else "RGB")
+    size = fit_for_vision(*page.size, short_side=short_side)
+    if size != page.size:
+        page = page.resize(size, Image.LANCZOS)
+
+    candidates = [(ImageType(image_type), image)]
+    for candidate_type in formats:
+        if candidate_type == ImageType.PNG:
+            candidates.append((candidate_type, _encode(page, candidate_type, 100)))
+        else:
+            candidates.append((candidate_type, _smallest_encoding(
+                page, candidate_type, min_psnr, qualities)))
+    # the original stays in the running, it may already be the smallest
+    best_type, best = min(candidates, key=lambda candidate: len(candidate[1]))
+    if best is image:
+        size = Image.open(BytesIO(image)).size
+    return {
+        "image": best,
+        "image_type": best_type,
+        "bytes_before": len(image),
+        "bytes_after": len(best),
+        "tokens_before": tokens_before,
+        "tokens_after": estimate_vision_tokens(*size)
+    }
+
+
+class ImageOptimizerStep(StreamingPipelineStep):
+    """
+    optimizes rendered pages between rasterization and a vision extractor
+
+    pages are resized to the provider's effective resolution, converted to
+    grayscale when they carry no colour and re-encoded in the smallest
+    format and quality meeting a legibility target, measured as psnr
+    against the resized page, bytes and tokens saved are recorded
+    """
+    # decoding and re-encoding are cpu-bound
+    execution_mode = ExecutionMode.PROCESS
+
+    def __init__(self,
+                 min_psnr: float = 32.0,
+                 formats: Sequence[ImageType] = (ImageType.WEBP, ImageType.JPEG, ImageType.PNG),
+                 short_side: int = TILE_SHORT_SIDE,
+                 stream_concurrency: int = 4) -> None:
+        """
+        Args:
+            min_psnr: Legibility target in db, text stays crisp above ~30
+            formats: Formats the vision model accepts, tried for every page
+            short_side: Shortest side pages are scaled down to, below the
+                provider's 768 fewer tiles are billed
+            stream_concurrency: Pages optimized at once when streaming
+        """
+        self.min_psnr = min_psnr
+        self.formats = tuple(formats)
+        self.short_side = short_side
+        self.stream_concurrency = stream_concurrency
+
+    async def process(self, data: StepData) -> StepData:
+        event = data["event"]
+        image_types = image_types_of(event)
+        pages: List[OptimizedImage] = await asyncio.gather(*[
+            self._optimize(image, image_type, data["context"])
+            for image, image_type in zip(event["images"], image_types)])
+        return {
+            "event": {
+                **event,
+                "images": [page["image"] for page in pages],
+                "image_types": [page["image_type"] for page in pages]
+            },
+            "context": data["context"]
+        }
+
+    def pages_from(self, data: StepData) -> AsyncIterator[PageItem]:
+        event = data["event"]
+        image_types = image_types_of(event)
+        return iterate([
+            {"page_number": page_number, "image": image, "image_type": image_type}
+            for page_number, (image, image_type)
+            in enumerate(zip(event["images"], image_types), start=1)])
+
+    def stream(self, pages: AsyncIterator[PageItem], context: Dict[str, Any]) -> AsyncIterator[PageItem]:
+        async def optimize(page: PageItem) -> PageItem:
+            optimized = await self._optimize(page["image"],
+                                             page.get("image_type", ImageType.JPEG),
+                                             context)
+            return {**page, "image": optimized["image"], "image_type": optimized["image_type"]}
+        return map_concurrently(pages, optimize, self.stream_concurrency)
+
+    def collect(self, pages: List[PageItem], context: Dict[str, Any]) -> StepData:
+        return {
+            "event": {
+                "images": [page["image"] for page in pages],
+                "image_types": [page["image_type"] for page in pages]
+            },
+            "context": context
+        }
+
+    async def _optimize(self, image: bytes, image_type: str, context: Dict[str, Any]) -> OptimizedImage:
+        optimized: OptimizedImage = await self.offload(optimize_image,
+                                                       image,
+                                                       image_type,
+                                                       self.min_psnr,
+                                                       self.formats,
+                                                       (30, 95),
+                                                       self.short_side)
+        record(context, "image_bytes_saved",
+               optimized["bytes_before"] - optimized["bytes_after"])
+        record(context, "image_tokens_saved",
+               optimized["tokens_before"] - optimized["tokens_after"])
+        return optimized
@@ -0,0 +1,285 @@
+"""
+blank and duplicate page detection, skipped pages never reach the model
+"""
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+import numpy as np
+from PIL import Image
+from pipeline.base import PipelineStep
+from pipeline.base.dag import JoinStep
+from pipeline.base.instrumentation import record
+from pipeline.model.ImageInputModel import image_types_of
+from pipeline.model.StepDataModel import StepData
+from pipeline.runtime.executor import ExecutionMode
+
+# grey level below which a pixel counts as ink
+INK_LEVEL = 160
+# ink coverage is measured at this size
+SAMPLE_SIDE = 512
+# run indexes kept per worker process, oldest runs are dropped first
+MAX_RUN_INDEXES = 32
+
+
+class PageSignature(TypedDict):
+    """
+    fingerprint of a page image
+    """
+    # sha256 of the decoded full resolution pixels, only identical pages
+    # share it, same-template forms with different values never do
+    digest: str
+    # share of the page covered by ink
+    ink: float
+
+
+class FilteredPage(TypedDict):
+    """
+    what became of one page, in page order
+    """
+    # blank, extract, duplicate (of a page in the same file) or indexed (of
+    # a page claimed by another file of the run)
+    kind: str
+    # position among the extracted images, for extract and duplicate pages
+    index: Optional[int]
+    signature: PageSignature
+    # kept for indexed pages, extracted after all if their file fails
+    image: Optional[bytes]
+    image_type: Optional[str]
+
+
+def page_signature(image: bytes) -> PageSignature:
+    """
+    hashes the pixels of an encoded page and measures its ink coverage,
+    module level so it can run in the shared process pool
+    """
+    page = Image.open(BytesIO(image))
+    page.load()
+    digest = hashlib.sha256(f"{page.mode} {page.size}".encode())
+    digest.update(page.tobytes())
+    sample = page.convert("L")
+    sample.thumbnail((SAMPLE_SIDE, SAMPLE_SIDE))
+    return {
+        "digest": digest.hexdigest(),
+        "ink": float((np.asarray(sample) < INK_LEVEL).mean())
+    }
+
+
+class PageNotExtracted(Exception):
+    """the file that claimed a page finished without extracting it"""
+
+
+class PageIndex:
+    """
+    rows of the pages of a run by digest, as futures so a page repeated
+    across files extracted concurrently (e.g. terms and conditions) is
+    extracted by the first file to claim it and awaited by the others,
+    used from the worker runtime's event loop
+    """
+
+    def __init__(self, max_pages: int = 10000) -> None:
+        self.max_pages = max_pages
+        self._rows: Dict[str, asyncio.Future] = {}
+
+    def claim(self, digest: str) -> Tuple[asyncio.Future, bool]:
+        """
+        future of the page's rows, and whether the caller claimed the page
+        and must extract it, pages beyond `max_pages` are never indexed
+        """
+        if (future := self._rows.get(digest)) is not None:
+            return future, False
+        future = asyncio.get_running_loop().create_future()
+        if len(self._rows) < self.max_pages:
+            self._rows[digest] = future
+        return future, True
+
+    def rows(self, digest: str) -> Optional[asyncio.Future]:
+        """future of a claimed page's rows, `None` once it was released"""
+        return self._rows.get(digest)
+
+    def release(self, digest: str, future: asyncio.Future) -> None:
+        """
+        drops a claim left unresolved, files waiting on it extract the
+        page themselves and the next file to see it claims it again
+        """
+        if not future.done():
+            future.set_exception(PageNotExtracted(digest))
+            # nobody may be waiting, the exception is not worth logging
+            future.exception()
+        if self._rows.get(digest) is future:
+            del self._rows[digest]
+
+
+class PageClaims:
+    """
+    one file's handle on its run's index, remembers the pages the file
+    claimed so the ones it never extracted are released when it finishes
+    """
+
+    def __init__(self, index: PageIndex) -> None:
+        self.index = index
+        self._claimed: Dict[str, asyncio.Future] = {}
+
+    def claim(self, digest: str) -> bool:
+        """whether this file must extract the page, or another file does"""
+        if digest in self._claimed:
+            return True
+        future, claimed = self.index.claim(digest)
+        if claimed:
+            self._claimed[digest] = future
+        return claimed
+
+    def resolve(self, digest: str, rows: List[Dict[str, Any]]) -> None:
+        """hands the rows of a claimed page to the files waiting on it"""
+        future = self._claimed.pop(digest, None)
+        if future is not None and not future.done():
+            future.set_result(rows)
+
+    async def rows(self, digest: str) -> Optional[List[Dict[str, Any]]]:
+        """rows extracted by the file that claimed the page, `None` if it failed"""
+        future = self.index.rows(digest)
+        if future is None:
+            return None
+        try:
+            return await asyncio.shield(future)
+        except PageNotExtracted:
+            return None
+
+    def release(self) -> None:
+        """releases every claim left unresolved, e.g. when the file failed"""
+        for digest, future in self._claimed.items():
+            self.index.release(digest, future)
+        self._claimed.clear()
+
+
+_run_indexes: "OrderedDict[str, PageIndex]" = OrderedDict()
+_run_indexes_lock = threading.Lock()
+
+
+def run_page_index(run_id: str) -> PageIndex:
+    """
+    index shared by every file of a run handled by this worker process
+    """
+    with _run_indexes_lock:
+        if run_id not in _run_indexes:
+            _run_indexes[run_id] = PageIndex()
+            while len(_run_indexes) > MAX_RUN_INDEXES:
+                _run_indexes.popitem(last=False)
+        _run_indexes.move_to_end(run_id)
+        return _run_indexes[run_id]
+
+
+class PageFilterStep(PipelineStep):
+    """
+    drops blank pages and duplicates before a vision extractor
+
+    a page with almost no ink is blank, a page identical to an earlier page
+    of the file is extracted once, and a page identical to one claimed by
+    another file of the run, through the `page_claims` in the context, waits
+    for that file's rows, `images` keeps only the pages still to extract
+    and `filtered_pages` records what became of every page for
+    `RestoreFilteredRowsStep`
+    """
+    # decoding and hashing are cpu-bound
+    execution_mode = ExecutionMode.PROCESS
+
+    def __init__(self, max_blank_ink: float = 0.002) -> None:
+        """
+        Args:
+            max_blank_ink: Ink coverage up to which a page is blank
+        """
+        self.max_blank_ink = max_blank_ink
+
+    async def process(self, data: StepData) -> StepData:
+        event = data["event"]
+        context = data["context"]
+        claims: Optional[PageClaims] = context.get("page_claims")
+        signatures: List[PageSignature] = await asyncio.gather(*[
+            self.offload(page_signature, image) for image in event["images"]])
+
+        kept: List[Tuple[bytes, str]] = []
+        kept_digests: Dict[str, int] = {}
+        filtered: List[FilteredPage] = []
+        for image, image_type, signature in zip(event["images"], image_types_of(event), signatures):
+            page: FilteredPage = {"kind": "extract", "index": None, "signature": signature,
+                                  "image": None, "image_type": None}
+            if signature["ink"] <= self.max_blank_ink:
+                page["kind"] = "blank"
+                record(context, "blank_pages_skipped")
+            elif signature["digest"] in kept_digests:
+                page["kind"], page["index"] = "duplicate", kept_digests[signature["digest"]]
+                record(context, "duplicate_pages_skipped")
+            elif claims is not None and not claims.claim(signature["digest"]):
+                page["kind"], page["image"], page["image_type"] = "indexed", image, image_type
+            else:
+                page["index"] = kept_digests[signature["digest"]] = len(kept)
+                kept.append((image, image_type))
+            filtered.append(page)
+        record(context, "extraction_calls_avoided",
+               sum(1 for page in filtered if page["kind"] in ("blank", "duplicate")))
+        return {
+            "event": {
+                **event,
+                "images": [image for image, _ in kept],
+                "image_types": [image_type for _, image_type in kept],
+                "filtered_pages": filtered
+            },
+            "context": context
+        }
+
+
+class RestoreFilteredRowsStep(JoinStep):
+    """
+    expands rows of the extracted pages back to every page filtered by
+    `PageFilterStep`, blank pages get no rows, pages claimed by another file
+    get that file's rows, and the file's own claims are resolved first so
+    files waiting on each other never deadlock
+    """
+
+    def __init__(self,
+                 pages: str = "filter",
+                 rows: str = "filtered_rows",
+                 extractor: Optional[PipelineStep] = None) -> None:
+        """
+        Args:
+            pages: Input holding the `PageFilterStep` output
+            rows: Input holding rows of the extracted pages
+            extractor: Extracts pages whose claiming file failed, without
+                one such a page fails this file too
+        """
+        self.pages = pages
+        self.rows = rows
+        self.extractor = extractor
+
+    async def join(self, inputs: Dict[str, StepData]) -> StepData:
+        context = inputs[self.pages]["context"]
+        claims: Optional[PageClaims] = context.get("page_claims")
+        extracted = inputs[self.rows]["event"]["rows"]
+        pages: List[FilteredPage] = inputs[self.pages]["event"]["filtered_pages"]
+        if claims is not None:
+            for page in pages:
+                if page["kind"] == "extract":
+                    claims.resolve(page["signature"]["digest"], extracted[page["index"]])
+
+        async def restore(page: FilteredPage) -> List[Dict[str, Any]]:
+            if page["kind"] == "blank":
+                return []
+            if page["kind"] != "indexed":
+                return extracted[page["index"]]
+            if (rows := await claims.rows(page["signature"]["digest"])) is not None:
+                record(context, "duplicate_pages_skipped")
+                record(context, "extraction_calls_avoided")
+                return rows
+            if self.extractor is None:
+                raise RuntimeError("a page claimed by another file of the run was not extracted")
+            result = await self.extractor.process({
+                "event": {"images": [page["image"]], "image_types": [page["image_type"]]},
+                "context": context})
+            return result["event"]["rows"][0]
+
+        return {
+            "event": {"rows": list(await asyncio.gather(*map(restore, pages)))},
+            "context": context
+        }
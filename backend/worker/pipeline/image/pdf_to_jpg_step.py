@@ -1,34 +1,140 @@
-import base64
+import asyncio
+import math
+import os
+import tempfile
 from io import BytesIO
 from PIL import Image
-from typing import List
-from pdf2image import convert_from_bytes
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from pdf2image import convert_from_bytes, convert_from_path, pdfinfo_from_bytes, pdfinfo_from_path
 from pipeline.model.StepDataModel import StepData
-from pipeline import PipelineStep
+from pipeline.model.PageItemModel import PageItem
+from pipeline.model.WorkItemModel import PageRange
+from pipeline import StreamingPipelineStep
 from pipeline.file.gotenberg_step import FileOutputModel
 from pipeline.model.ImageInputModel import PagesImageInputModel
+from pipeline.model.environ.Environ import get_environ
+from pipeline.runtime.executor import ExecutionMode, cpu_worker_count, run_blocking
 
 
-class PDFToJPGStep(PipelineStep):
+def render_page_range(pdf_bytes: bytes,
+                      first_page: Optional[int] = None,
+                      last_page: Optional[int] = None,
+                      dpi: int = 200) -> List[bytes]:
+    """
+    rasterizes a page range to jpeg bytes, module level so it can run in
+    the shared process pool
+    """
+    images_bytes: List[bytes] = []
+    images: List[Image.Image] = convert_from_bytes(
+        pdf_file=pdf_bytes,
+        dpi=dpi,
+        first_page=first_page,
+        last_page=last_page)
+    for image in images:
+        with BytesIO() as output:
+            image.save(output, format="JPEG")
+            images_bytes.append(output.getvalue())
+    return images_bytes
+
+
+def render_page_range_to_folder(pdf_path: str,
+                                first_page: int,
+                                last_page: int,
+                                output_folder: str,
+                                dpi: int = 200) -> List[str]:
+    """
+    has poppler write a page range straight to jpeg files, returning their
+    paths in page order, nothing is decoded into memory
+    """
+    return convert_from_path(
+        pdf_path=pdf_path,
+        dpi=dpi,
+        output_folder=output_folder,
+        first_page=first_page,
+        last_page=last_page,
+        fmt="jpeg",
+        paths_only=True)
+
+
+def split_page_range(page_range: PageRange, chunk_pages: int) -> List[PageRange]:
+    """
+    splits an inclusive page range into consecutive chunks of at most chunk_pages
+    """
+    return [
+        {"first_page": first_page,
+         "last_page": min(first_page + chunk_pages - 1, page_range["last_page"])}
+        for first_page in range(page_range["first_page"],
+                                page_range["last_page"] + 1,
+                                chunk_pages)
+    ]
+
+
+def page_runs(pages: List[int]) -> List[PageRange]:
+    """
+    groups page numbers into ranges of consecutive pages
+    """
+    runs: List[PageRange] = []
+    for page_number in sorted(pages):
+        if runs and runs[-1]["last_page"] == page_number - 1:
+            runs[-1]["last_page"] = page_number
+        else:
+            runs.append({"first_page": page_number, "last_page": page_number})
+    return runs
+
+
+class PDFToJPGStep(StreamingPipelineStep):
     """
     base class for converting pdf to jpg
+
+    renders the event's `pages` when set (e.g. only the pages without a
+    text layer), its `page_range` when sharded, otherwise every page
     """
+    # poppler and jpeg encoding are cpu-bound
+    execution_mode = ExecutionMode.PROCESS
 
-    def __init__(self):
-        pass
+    def __init__(self,
+                 stream_chunk_pages: int = 4,
+                 parallel: bool = True,
+                 min_chunk_pages: int = 4,
+                 dpi: int = 200):
+        """
+        Args:
+            stream_chunk_pages: Pages rendered per poppler call when streaming
+            parallel: Split the page range into chunks rendered and encoded on
+                every process of the shared pool at once
+            min_chunk_pages: Smallest chunk worth its own poppler call, short
+                documents are rendered in fewer chunks
+            dpi: Resolution pages are rendered at
+        """
+        self.dpi = dpi
+        self.stream_chunk_pages = stream_chunk_pages
+        self.parallel = parallel
+        self.min_chunk_pages = min_chunk_pages
 
     async def process(self, data: StepData) -> StepData:
         incoming_pdf_file = {
             **data["event"]
         }
-        images_bytes: List[str] = []
-        images: List[Image.Image] = convert_from_bytes(
-            pdf_file=incoming_pdf_file["file_bytes"])
-        for image in images:
-            with BytesIO() as output:
-                image.save(output, format="JPEG")
-                byte = output.getvalue()
-                images_bytes.append(self.convert_bytes_to_base64(byte))
+        pdf_bytes: bytes = incoming_pdf_file["file_bytes"]
+        page_ranges = await self._page_ranges(incoming_pdf_file,
+                                              lambda: self._full_range(pdf_bytes))
+        if self.parallel:
+            page_count = sum(page_range["last_page"] - page_range["first_page"] + 1
+                             for page_range in page_ranges)
+            chunk_pages = max(self.min_chunk_pages,
+                              math.ceil(page_count / cpu_worker_count()))
+            page_ranges = [chunk
+                           for page_range in page_ranges
+                           for chunk in split_page_range(page_range, chunk_pages)]
+        # one poppler process per chunk, encoded where it was rendered
+        chunks: List[List[bytes]] = await asyncio.gather(*[
+            self.offload(render_page_range,
+                         pdf_bytes,
+                         chunk["first_page"],
+                         chunk["last_page"],
+                         self.dpi)
+            for chunk in page_ranges])
+        images_bytes: List[bytes] = [image for chunk in chunks for image in chunk]
         return {
             "event": {
                 "image_type": "jpeg",
@@ -37,6 +143,99 @@ class PDFToJPGStep(PipelineStep):
             "context": data["context"]
         }
 
-    def convert_bytes_to_base64(self, image_bytes: bytes) -> str:
-        """converts image to base64"""
-        return base64.b64encode(image_bytes).decode('utf-8')
+    async def pages_from(self, data: StepData) -> AsyncIterator[PageItem]:
+        document: PageItem = {"file_bytes": data["event"]["file_bytes"]}
+        if data["event"].get("page_range"):
+            document["page_range"] = data["event"]["page_range"]
+        if data["event"].get("pages") is not None:
+            document["pages"] = data["event"]["pages"]
+        yield document
+
+    async def stream(self, pages: AsyncIterator[PageItem], context: Dict[str, Any]) -> AsyncIterator[PageItem]:
+        """
+        renders each incoming document a few pages at a time into a temporary
+        folder (`RENDER_DIR`, e.g. a tmpfs), so the first pages reach the
+        next step before the last ones are rendered
+
+        only the chunk being handed downstream and the one rendering ahead
+        of it exist at once, each page's file is removed as it is read, so
+        memory stays flat however long the document is
+        """
+        async for document in pages:
+            # a cancelled render can still be writing into the folder on exit
+            with tempfile.TemporaryDirectory(prefix="pdf-to-jpg-",
+                                             dir=get_environ().render_dir,
+                                             ignore_cleanup_errors=True) as folder:
+                pdf_path = os.path.join(folder, "document.pdf")
+                await run_blocking(ExecutionMode.THREAD, self._write_file,
+                                   pdf_path, document["file_bytes"])
+                page_ranges = await self._page_ranges(document,
+                                                      lambda: self._full_range_of_path(pdf_path))
+                chunks = [chunk
+                          for page_range in page_ranges
+                          for chunk in split_page_range(page_range, self.stream_chunk_pages)]
+                if not chunks:
+                    continue
+                rendering = asyncio.ensure_future(self._render_chunk(pdf_path, chunks[0], folder))
+                try:
+                    for index, chunk in enumerate(chunks):
+                        paths = await rendering
+                        if index + 1 < len(chunks):
+                            # render ahead while this chunk moves downstream
+                            rendering = asyncio.ensure_future(
+                                self._render_chunk(pdf_path, chunks[index + 1], folder))
+                        for offset, path in enumerate(paths):
+                            image = await run_blocking(ExecutionMode.THREAD, self._take_file, path)
+                            yield {
+                                "page_number": chunk["first_page"] + offset,
+                                "image": image,
+                                "image_type": "jpeg"
+                            }
+                finally:
+                    rendering.cancel()
+
+    def collect(self, pages: List[PageItem], context: Dict[str, Any]) -> StepData:
+        return {
+            "event": {
+                "image_type": "jpeg",
+                "images": [page["image"] for page in pages]
+            },
+            "context": context
+        }
+
+    async def _page_ranges(self,
+                           document: Dict[str, Any],
+                           full_range: Callable[[], Awaitable[PageRange]]) -> List[PageRange]:
+        if document.get("pages") is not None:
+            return page_runs(document["pages"])
+        # set when the pdf has been sharded into page ranges
+        if document.get("page_range"):
+            return [document["page_range"]]
+        return [await full_range()]
+
+    async def _render_chunk(self, pdf_path: str, chunk: PageRange, folder: str) -> List[str]:
+        return await self.offload(render_page_range_to_folder,
+                                  pdf_path,
+                                  chunk["first_page"],
+                                  chunk["last_page"],
+                                  folder,
+                                  self.dpi)
+
+    def _write_file(self, path: str, content: bytes) -> None:
+        with open(path, "wb") as file:
+            file.write(content)
+
+    def _take_file(self, path: str) -> bytes:
+        """reads a rendered page and removes it from disk"""
+        with open(path, "rb") as file:
+            content = file.read()
+        os.remove(path)
+        return content
+
+    async def _full_range_of_path(self, pdf_path: str) -> PageRange:
+        info = await run_blocking(ExecutionMode.THREAD, pdfinfo_from_path, pdf_path)
+        return {"first_page": 1, "last_page": info["Pages"]}
+
+    async def _full_range(self, pdf_bytes: bytes) -> PageRange:
+        info = await run_blocking(ExecutionMode.THREAD, pdfinfo_from_bytes, pdf_bytes)
+        return {"first_page": 1, "last_page": info["Pages"]}
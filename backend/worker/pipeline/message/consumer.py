@@ -1,5 +1,7 @@
+import asyncio
+import aio_pika
 import pika
-from typing import Optional, Callable
+from typing import Any, Awaitable, Optional, Callable, Set
 import logging
 
 
@@ -18,7 +20,8 @@ class RabbitMQConsumer:
         routing_key: Optional[str] = None,
         exchange_type: str = 'direct',
         prefetch_count: int = 1,
-        durable: bool = True
+        durable: bool = True,
+        heartbeat: int = 60
     ):
         """
         Initialize the RabbitMQ consumer with connection parameters.
@@ -35,6 +38,8 @@ class RabbitMQConsumer:
             exchange_type: Type of exchange ('direct', 'fanout', 'topic', 'headers')
             prefetch_count: Number of messages to prefetch
             durable: Whether the queue should survive broker restarts
+            heartbeat: AMQP heartbeat interval in seconds, callbacks should wait on
+                long work with `wait_with_heartbeat` so heartbeats keep flowing
         """
         self.credentials = pika.PlainCredentials(username, password)
         self.parameters = pika.ConnectionParameters(
@@ -43,7 +48,8 @@ class RabbitMQConsumer:
             virtual_host=virtual_host,
             credentials=self.credentials,
             connection_attempts=3,
-            retry_delay=5
+            retry_delay=5,
+            heartbeat=heartbeat
         )
         self.queue_name = queue_name
         self.exchange_name = exchange_name
@@ -130,6 +136,128 @@ class RabbitMQConsumer:
             self.logger.error(f"Error during consumption: {str(e)}")
             raise
 
+
+class AsyncRabbitMQConsumer:
+    """An async context manager consuming RabbitMQ messages concurrently on the worker's event loop using aio-pika."""
+
+    def __init__(
+        self,
+        host: str = 'localhost',
+        port: int = 5672,
+        virtual_host: str = '/',
+        username: str = 'guest',
+        password: str = 'guest',
+        queue_name: Optional[str] = None,
+        max_in_flight: int = 1,
+        durable: bool = True,
+        heartbeat: int = 60
+    ):
+        """
+        Initialize the async RabbitMQ consumer with connection parameters.
+
+        Args:
+            host: RabbitMQ server hostname
+            port: RabbitMQ server port
+            virtual_host: Virtual host to connect to
+            username: RabbitMQ username
+            password: RabbitMQ password
+            queue_name: Name of the queue to consume from
+            max_in_flight: Number of messages processed at once, also used as the prefetch count
+            durable: Whether the queue should survive broker restarts
+            heartbeat: AMQP heartbeat interval in seconds
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.host = host
+        self.port = port
+        self.virtual_host = virtual_host
+        self.username = username
+        self.password = password
+        self.queue_name = queue_name
+        self.max_in_flight = max_in_flight
+        self.durable = durable
+        self.heartbeat = heartbeat
+        self.connection: Optional[aio_pika.abc.AbstractRobustConnection] = None
+        self.channel: Optional[aio_pika.abc.AbstractChannel] = None
+        self.queue: Optional[aio_pika.abc.AbstractQueue] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self.logger = logging.getLogger(__name__)
+
+    async def __aenter__(self):
+        """Establish connection, channel and queue when entering context."""
+        try:
+            self.connection = await aio_pika.connect_robust(
+                host=self.host,
+                port=self.port,
+                login=self.username,
+                password=self.password,
+                virtualhost=self.virtual_host,
+                heartbeat=self.heartbeat
+            )
+            self.channel = await self.connection.channel()
+
+            # broker never hands out more messages than we process at once
+            await self.channel.set_qos(prefetch_count=self.max_in_flight)
+
+            self.queue = await self.channel.declare_queue(
+                self.queue_name,
+                durable=self.durable
+            )
+
+            self.logger.info("Successfully connected to RabbitMQ")
+            return self
+        except Exception as e:
+            self.logger.error(f"Error setting up RabbitMQ consumer: {str(e)}")
+            await self.__aexit__(type(e), e, e.__traceback__)
+            raise
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Wait for in-flight messages and clean up resources when exiting context."""
+        try:
+            if self._in_flight:
+                await asyncio.gather(*self._in_flight, return_exceptions=True)
+            if self.connection and not self.connection.is_closed:
+                await self.connection.close()
+        except Exception as e:
+            self.logger.error(f"Error cleaning up RabbitMQ consumer: {str(e)}")
+
+    async def consume(self, callback: Callable[[bytes], Awaitable[Any]]):
+        """
+        Start consuming messages, running up to `max_in_flight` callbacks at once.
+
+        Each message is acked when its callback returns and nacked (without
+        requeue) when it raises, independently of the other messages.
+
+        Args:
+            callback: Coroutine function receiving the message body
+        """
+        if not self.queue:
+            raise RuntimeError("Queue is not declared")
+
+        slots = asyncio.Semaphore(self.max_in_flight)
+        self.logger.info(f"""Starting to consume from queue: {
+                         self.queue_name} with {self.max_in_flight} in flight""")
+        async with self.queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                await slots.acquire()
+                task = asyncio.create_task(
+                    self._handle(message, callback, slots))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+
+    async def _handle(self,
+                      message: aio_pika.abc.AbstractIncomingMessage,
+                      callback: Callable[[bytes], Awaitable[Any]],
+                      slots: asyncio.Semaphore):
+        try:
+            await callback(message.body)
+            await message.ack()
+        except Exception as e:
+            self.logger.error(f"Error processing message: {str(e)}")
+            await message.nack(requeue=False)
+        finally:
+            slots.release()
+
 # Example usage:
 
 
@@ -0,0 +1,74 @@
+"""
+leases that keep long-running messages from being redelivered
+"""
+import asyncio
+import logging
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Optional
+import pika
+
+logger = logging.getLogger(__name__)
+
+
+class MessageLease:
+    """
+    async context manager that renews a message's lease on an interval
+    until the block exits, e.g. extending a pgmq visibility timeout while
+    the message is being processed
+    """
+
+    def __init__(self, renew: Callable[[], Awaitable[Any]], interval: float) -> None:
+        """
+        Args:
+            renew: Coroutine function extending the lease
+            interval: Seconds between renewals, well below the lease length
+        """
+        if interval <= 0:
+            raise ValueError("lease interval must be positive")
+        self.renew = renew
+        self.interval = interval
+        self.renewals = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "MessageLease":
+        self._task = asyncio.create_task(self._keep_alive())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _keep_alive(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.renew()
+                self.renewals += 1
+            except Exception as e:
+                # keep trying, the lease is only lost once it fully expires
+                logger.error(f"Error renewing message lease: {str(e)}")
+
+
+def wait_with_heartbeat(connection: pika.BlockingConnection,
+                        pending: Future,
+                        interval: float = 1.0) -> Any:
+    """
+    waits for `pending` from inside a pika consumer callback while keeping
+    the connection serviced, so broker heartbeats are answered and a long
+    extraction does not get the connection dropped and the message
+    redelivered to another worker
+
+    Args:
+        connection: Blocking connection the message was delivered on
+        pending: Future of the message's processing on the worker runtime
+        interval: Longest time between checks of the connection
+    """
+    # wake the pika loop as soon as processing finishes
+    pending.add_done_callback(
+        lambda _: connection.add_callback_threadsafe(lambda: None))
+    while not pending.done():
+        connection.process_data_events(time_limit=interval)
+    return pending.result()
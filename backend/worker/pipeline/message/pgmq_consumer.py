@@ -0,0 +1,160 @@
+"""
+pgmq consumer for the supabase extraction queue
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, TypedDict
+from supabase import AsyncClient
+from pipeline.message.lease import MessageLease
+
+
+class PGMQMessage(TypedDict):
+    """
+    row returned by pgmq.read / pgmq.read_with_poll
+    """
+    msg_id: int
+    read_ct: int
+    enqueued_at: str
+    vt: str
+    message: Dict[str, Any]
+
+
+class PGMQConsumer:
+    """An async context manager consuming a pgmq queue through supabase with batched long-poll reads."""
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        queue_name: str = "extraction",
+        batch_size: int = 5,
+        max_in_flight: int = 5,
+        visibility_timeout: int = 300,
+        max_poll_seconds: int = 5,
+        poll_interval_ms: int = 100,
+        max_attempts: int = 3,
+        archive: bool = True,
+        lease_interval: Optional[float] = None
+    ):
+        """
+        Initialize the pgmq consumer.
+
+        Args:
+            client: Supabase client bound to the pgmq schema
+            queue_name: Name of the pgmq queue to consume from
+            batch_size: Maximum number of messages pulled per read
+            max_in_flight: Number of messages processed at once
+            visibility_timeout: Seconds a read message stays hidden from other consumers
+            max_poll_seconds: Seconds a read waits on an empty queue before returning
+            poll_interval_ms: Interval at which pgmq re-checks the queue while polling
+            max_attempts: Reads after which a failing message is archived instead of retried
+            archive: Archive processed messages instead of deleting them
+            lease_interval: Seconds between visibility timeout extensions while a
+                message is processed, defaults to a third of the visibility timeout
+        """
+        if max_in_flight < 1 or batch_size < 1:
+            raise ValueError("batch_size and max_in_flight must be at least 1")
+        self.client = client
+        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.visibility_timeout = visibility_timeout
+        self.max_poll_seconds = max_poll_seconds
+        self.poll_interval_ms = poll_interval_ms
+        self.max_attempts = max_attempts
+        self.archive = archive
+        self.lease_interval = lease_interval or visibility_timeout / 3
+        self._in_flight: Set[asyncio.Task] = set()
+        self.logger = logging.getLogger(__name__)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Wait for in-flight messages when exiting context."""
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    async def consume(self, callback: Callable[[Dict[str, Any]], Awaitable[Any]]):
+        """
+        Start consuming messages, reading only as many as there are free slots.
+
+        While a callback runs, the message's visibility timeout is extended
+        every `lease_interval` seconds, so long extractions are never picked
+        up by a second worker. A message is archived (or deleted) once its
+        callback returns. When the callback raises, the lease is dropped so
+        pgmq redelivers the message straight away, until it has been read
+        `max_attempts` times.
+
+        Args:
+            callback: Coroutine function receiving the decoded message payload
+        """
+        self.logger.info(f"""Starting to consume from pgmq queue: {
+                         self.queue_name} with {self.max_in_flight} in flight""")
+        while True:
+            free_slots = self.max_in_flight - len(self._in_flight)
+            if free_slots == 0:
+                await asyncio.wait(self._in_flight,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                messages = await self.read(min(self.batch_size, free_slots))
+            except Exception as e:
+                self.logger.error(f"Error reading from pgmq: {str(e)}")
+                await asyncio.sleep(self.max_poll_seconds)
+                continue
+            for message in messages:
+                task = asyncio.create_task(self._handle(message, callback))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+
+    async def read(self, qty: int) -> List[PGMQMessage]:
+        """long-polls the queue for up to `qty` messages"""
+        response = await self._rpc("read_with_poll", {
+            "queue_name": self.queue_name,
+            "vt": self.visibility_timeout,
+            "qty": qty,
+            "max_poll_seconds": self.max_poll_seconds,
+            "poll_interval_ms": self.poll_interval_ms
+        })
+        return response.data or []
+
+    async def extend(self, msg_id: int, vt: Optional[int] = None) -> None:
+        """hides a message for another `vt` seconds from now"""
+        await self._rpc("set_vt", {
+            "queue_name": self.queue_name,
+            "msg_id": msg_id,
+            "vt": self.visibility_timeout if vt is None else vt
+        })
+
+    async def release(self, msg_id: int) -> None:
+        """removes a finished message from the queue"""
+        await self._rpc("archive" if self.archive else "delete", {
+            "queue_name": self.queue_name,
+            "msg_id": msg_id
+        })
+
+    async def _handle(self,
+                      message: PGMQMessage,
+                      callback: Callable[[Dict[str, Any]], Awaitable[Any]]):
+        msg_id = message["msg_id"]
+        try:
+            async with MessageLease(renew=lambda: self.extend(msg_id),
+                                    interval=self.lease_interval):
+                await callback(message["message"])
+        except Exception as e:
+            self.logger.error(f"""Error processing pgmq message {
+                              msg_id}: {str(e)}""")
+            if message["read_ct"] < self.max_attempts:
+                await self._safely(self.extend(msg_id, vt=0), msg_id)
+                return
+        await self._safely(self.release(msg_id), msg_id)
+
+    async def _safely(self, operation: Awaitable[Any], msg_id: int) -> None:
+        try:
+            await operation
+        except Exception as e:
+            self.logger.error(f"""Error updating pgmq message {
+                              msg_id}: {str(e)}""")
+
+    async def _rpc(self, fn: str, params: Optional[Dict[str, Any]] = None):
+        return await self.client.rpc(fn, params).execute()
@@ -0,0 +1,86 @@
+"""
+publishers for putting work items back on the extraction queue
+"""
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+import aio_pika
+from supabase import AsyncClient
+
+
+class MessagePublisher(ABC):
+    """Abstract base class for publishing messages to the extraction queue."""
+
+    @abstractmethod
+    async def publish(self, messages: List[Dict[str, Any]]) -> None:
+        """Publishes json messages to the queue."""
+        return
+
+
+class PGMQPublisher(MessagePublisher):
+    """Publishes to a pgmq queue through a supabase client bound to the pgmq schema."""
+
+    def __init__(self, client: AsyncClient, queue_name: str = "extraction"):
+        self.client = client
+        self.queue_name = queue_name
+
+    async def publish(self, messages: List[Dict[str, Any]]) -> None:
+        if not messages:
+            return
+        await self.client.rpc("send_batch", {
+            "queue_name": self.queue_name,
+            "msgs": messages
+        }).execute()
+
+
+class RabbitMQPublisher(MessagePublisher):
+    """Publishes persistent messages to a RabbitMQ queue with aio-pika, connecting lazily on the runtime loop."""
+
+    def __init__(
+        self,
+        host: str = 'localhost',
+        port: int = 5672,
+        virtual_host: str = '/',
+        username: str = 'guest',
+        password: str = 'guest',
+        queue_name: str = "extraction"
+    ):
+        self.host = host
+        self.port = port
+        self.virtual_host = virtual_host
+        self.username = username
+        self.password = password
+        self.queue_name = queue_name
+        self.connection: Optional[aio_pika.abc.AbstractRobustConnection] = None
+        self.channel: Optional[aio_pika.abc.AbstractChannel] = None
+        self.logger = logging.getLogger(__name__)
+
+    async def publish(self, messages: List[Dict[str, Any]]) -> None:
+        channel = await self._get_channel()
+        for message in messages:
+            await channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=json.dumps(message).encode(),
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+                ),
+                routing_key=self.queue_name
+            )
+
+    async def close(self) -> None:
+        """closes the publishing connection"""
+        if self.connection and not self.connection.is_closed:
+            await self.connection.close()
+
+    async def _get_channel(self) -> aio_pika.abc.AbstractChannel:
+        if self.channel is None or self.channel.is_closed:
+            self.connection = await aio_pika.connect_robust(
+                host=self.host,
+                port=self.port,
+                login=self.username,
+                password=self.password,
+                virtualhost=self.virtual_host
+            )
+            self.channel = await self.connection.channel()
+            self.logger.info("Publisher connected to RabbitMQ")
+        return self.channel
@@ -1,7 +1,8 @@
 """
 models for transferring images
 """
-from typing import List, TypedDict
+import base64
+from typing import Any, Dict, List, TypedDict
 from enum import Enum
 
 
@@ -20,4 +21,23 @@ class PagesImageInputModel(TypedDict):
     base model for page input model, one image per page
     """
     image_type: ImageType = ImageType.JPG
+    # encoded image files, base64 only when a request is built
     images: List[bytes]
+    # per page types once pages are re-encoded, overrides image_type
+    image_types: List[ImageType]
+
+
+def image_types_of(event: Dict[str, Any]) -> List[str]:
+    """type of every page image in an event"""
+    return event.get("image_types") or \
+        [event.get("image_type", ImageType.JPEG)] * len(event["images"])
+
+
+def image_mime_subtype(image_type: str) -> str:
+    """subtype of the image's data uri, e.g. jpeg for image/jpeg"""
+    return ImageType.JPEG.value if image_type == ImageType.JPG else ImageType(image_type).value
+
+
+def image_data_uri(image: bytes, image_type: str) -> str:
+    """data uri of a page image, the only place pages are base64 encoded"""
+    return f"data:image/{image_mime_subtype(image_type)};base64,{base64.b64encode(image).decode('utf-8')}"
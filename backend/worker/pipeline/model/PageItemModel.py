@@ -0,0 +1,28 @@
+"""
+model for pages flowing through a streaming pipeline
+"""
+from typing import Any, Dict, List
+from typing import TypedDict
+from pipeline.model.WorkItemModel import PageRange
+
+
+class PageItem(TypedDict, total=False):
+    """
+    one page (or, before rasterization, one whole document) as it moves
+    between streaming steps, each step fills in the fields it produces
+
+    - page_number: 1-indexed page number, used to restore page order
+    - file_bytes / page_range / pages: the source document and the pages to
+      render, before rasterization
+    - image / image_type: the rendered page
+    - text: text extracted from the page
+    - rows: instances extracted from the page
+    """
+    page_number: int
+    file_bytes: bytes
+    page_range: PageRange
+    pages: List[int]
+    image: bytes
+    image_type: str
+    text: str
+    rows: List[Dict[str, Any]]
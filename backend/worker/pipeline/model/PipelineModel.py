@@ -44,15 +44,19 @@ class CreatePipelineRun(BaseModel):
 class PipelineRunResponse(BaseModel):
     """
     base model for pipeline response
+
+    also validates the payload the api sends to the pgmq extraction queue,
+    which carries the created run rather than the stored row, so the columns
+    filled in by the database are optional
     """
     id: UUID
     name: str
-    description: str
-    schema: Dict[str, Any]
+    description: Optional[str] = None
+    extraction_schema: Dict[str, Any] = Field(alias="schema")
     status: PipelineStatus
     strategy_id: UUID
-    started_at: str
-    completed_at: str
+    started_at: Optional[str] = None
+    completed_at: Optional[str] = None
     file_paths: List[PipelineFilePath] = []
 
 # test = {'name': 'test pipeline run',
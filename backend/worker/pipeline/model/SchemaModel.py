@@ -89,3 +89,40 @@ def generate_tool_schema_json(config: SchemaConfiguration) -> Dict[str, Any]:
 
     print(88, schema)
     return schema
+
+
+def _matches_type(value: Any, field_type: str) -> bool:
+    if field_type == "string":
+        return isinstance(value, str)
+    if field_type == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if field_type == "boolean":
+        return isinstance(value, bool)
+    return True
+
+
+def validate_instances(instances: Any, config: SchemaConfiguration) -> List[str]:
+    """
+    checks extracted instances against the configured fields, returns the
+    problems found, empty when the instances are valid
+    """
+    if not isinstance(instances, list):
+        return ["instances is not a list"]
+    errors = []
+    fields = config["extraction_config"]["schema"]
+    for index, instance in enumerate(instances):
+        if not isinstance(instance, dict):
+            errors.append(f"instance {index} is not an object")
+            continue
+        for field in fields:
+            name, field_type = field["name"], field["type"]
+            if name not in instance:
+                errors.append(f"instance {index} is missing {name}")
+            elif field_type.startswith("array"):
+                item_type = field_type.split("_")[1]
+                if not isinstance(instance[name], list) or \
+                        not all(_matches_type(item, item_type) for item in instance[name]):
+                    errors.append(f"instance {index} has an invalid {name}")
+            elif not _matches_type(instance[name], field_type):
+                errors.append(f"instance {index} has an invalid {name}")
+    return errors
@@ -17,6 +17,12 @@ class ExtractionStrategies(StrEnum):
     FILE_IMAGE_OPENAI = "file_image_openai"
     FILE_TEXT_OPENAI = "file_text_openai"
     FILE_TEXT_OLLAMA = "file_text_ollama"
+    # image and ocr text extraction of the same pages, reconciled per page
+    FILE_IMAGE_TEXT_OPENAI = "file_image_text_openai"
+    # each page routed to text, ocr or vision extraction by its features
+    FILE_ADAPTIVE_OPENAI = "file_adaptive_openai"
+    # image extraction through the openai batch api, for runs that can wait
+    FILE_IMAGE_OPENAI_BATCH = "file_image_openai_batch"
     # IMAGE_IMAGE_OPENAI = "image_image_openai"
     # IMAGE_TEXT_OPENAI = "image_text_openai"
     # anthropic
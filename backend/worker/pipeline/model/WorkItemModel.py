@@ -0,0 +1,63 @@
+"""
+models for work items a pipeline run is fanned out into
+"""
+from enum import StrEnum
+from typing import Any, Dict, List, Literal, Optional, TypedDict
+from pydantic import BaseModel
+from pipeline.base.instrumentation import StepMetrics
+from pipeline.model.PipelineModel import PipelineRunResponse
+
+
+class WorkItemKind(StrEnum):
+    """
+    kind of queue message, run messages carry no kind
+    """
+    FILE = "file"
+    SHARD = "shard"
+
+
+class PageRange(TypedDict):
+    """
+    inclusive, 1-indexed page range of a pdf
+    """
+    first_page: int
+    last_page: int
+
+
+class FileWorkItem(BaseModel):
+    """
+    one file of a fanned out pipeline run, any worker can take it
+    """
+    kind: Literal[WorkItemKind.FILE] = WorkItemKind.FILE
+    run: PipelineRunResponse
+    file_index: int
+    file_count: int
+
+    def to_message(self) -> Dict[str, Any]:
+        """json payload published to the queue"""
+        return self.model_dump(mode="json", by_alias=True)
+
+
+class PageShardWorkItem(FileWorkItem):
+    """
+    one page range of a large pdf in a fanned out run
+    """
+    kind: Literal[WorkItemKind.SHARD] = WorkItemKind.SHARD
+    page_range: PageRange
+    shard_index: int
+    shard_count: int
+
+
+class FileResult(TypedDict):
+    """
+    per-file result persisted as soon as the file finishes
+    """
+    file_index: int
+    filename: str
+    status: Literal["completed", "failed"]
+    instances: List[Dict[str, Any]]
+    error: Optional[str]
+    # step metrics of the file's pipeline, written to the run's messages
+    timeline: List[StepMetrics]
+    # counters the file's steps recorded, e.g. bytes saved
+    metrics: Dict[str, float]
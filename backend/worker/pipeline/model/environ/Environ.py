@@ -1,14 +1,124 @@
 """
 environ variables
 """
+from enum import StrEnum
+from functools import lru_cache
+from typing import List, Optional
 from pydantic_settings import BaseSettings
 
 
+class ConsumerMode(StrEnum):
+    """
+    how the worker pulls messages off the extraction queue
+    """
+    # pika blocking connection, one message at a time
+    BLOCKING = "blocking"
+    # aio-pika on the runtime loop, up to `worker_concurrency` messages at once
+    ASYNC = "async"
+    # supabase pgmq queue with batched long-poll reads
+    PGMQ = "pgmq"
+
+
+class CacheBackend(StrEnum):
+    """
+    where cached llm extractions are kept
+    """
+    # sqlite file on the worker's disk
+    SQLITE = "sqlite"
+    # supabase storage, shared by every worker
+    SUPABASE = "supabase"
+
+
 class Environ(BaseSettings):
     """
     base settings for environment variables
     """
     supabase_url: str
     supabase_key: str
-    rabbitmq_host: str
-    rabbitmq_port: int
+    rabbitmq_host: str = "localhost"
+    rabbitmq_port: int = 5672
+    consumer_mode: ConsumerMode = ConsumerMode.BLOCKING
+    # number of messages a worker process handles at once in async mode
+    worker_concurrency: int = 4
+    # pgmq mode, messages stay hidden from other workers for the visibility timeout
+    pgmq_batch_size: int = 5
+    pgmq_visibility_timeout: int = 300
+    pgmq_max_poll_seconds: int = 5
+    pgmq_max_attempts: int = 3
+    # runs with at least this many files are split into per-file work items
+    # that any worker can take, unset keeps every run on one worker
+    fan_out_min_files: Optional[int] = None
+    # pdfs with more pages are extracted in page-range shards of this size,
+    # on different workers when the run is fanned out
+    pdf_shard_pages: Optional[int] = None
+    # run rasterization, ocr and llm steps page by page so they overlap
+    streaming_pipelines: bool = False
+    # llm calls of the worker, per model, known limits are optional and
+    # learned from the provider's x-ratelimit-* headers otherwise
+    llm_requests_per_minute: Optional[int] = None
+    llm_tokens_per_minute: Optional[int] = None
+    # requests in flight per model, adapted between 1 and the maximum
+    llm_initial_concurrency: int = 8
+    llm_max_concurrency: int = 64
+    # attempts per llm call, seconds each may take, and seconds after which
+    # a slow call gets a hedged duplicate request, unset never hedges
+    llm_max_attempts: int = 4
+    llm_attempt_timeout: Optional[float] = 120.0
+    llm_hedge_after: Optional[float] = None
+    # consecutive pages packed into one llm request up to this many page
+    # tokens and page images, unset sends one request per page
+    llm_batch_max_tokens: Optional[int] = None
+    llm_batch_max_images: int = 8
+    # batch api strategies, seconds between status checks of a batch, the
+    # time the provider has to finish it and the size of one input file
+    # (the provider accepts up to 200 mb), larger inputs are split
+    batch_api_poll_seconds: float = 30.0
+    batch_api_completion_window: str = "24h"
+    batch_api_max_file_mb: float = 100.0
+    # cache of llm extractions keyed by model, template and page content,
+    # unset calls the model every time
+    extraction_cache: Optional[CacheBackend] = None
+    extraction_cache_path: str = ".cache/extractions.sqlite"
+    # entries expire after the ttl, the least recently used are evicted
+    # beyond the size
+    extraction_cache_ttl_seconds: Optional[int] = 30 * 24 * 3600
+    extraction_cache_max_mb: Optional[int] = 1024
+    # connection pool shared by every message in the worker process
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    # processes for cpu-bound steps, unset uses every core
+    cpu_workers: Optional[int] = None
+    # threads for blocking steps that release the gil, e.g. tesseract
+    thread_workers: int = 8
+    # warm tesseract engines when tesserocr is installed, unset uses one per
+    # cpu worker, and the traineddata they load
+    ocr_workers: Optional[int] = None
+    ocr_language: str = "eng"
+    # ocr pages to text with rows and columns rebuilt from word boxes,
+    # tables become markdown tables
+    ocr_layout: bool = False
+    # pdf pages whose text layer has at least this many characters are
+    # extracted from their text, only the rest are rendered for the vision
+    # model, unset renders every page
+    text_layer_min_chars: Optional[int] = None
+    # resize and re-encode pages before they are sent to a vision model
+    optimize_images: bool = False
+    # skip blank pages and reuse rows of pages repeated within a run
+    filter_pages: bool = False
+    # render pages at the first of these resolutions and re-render only pages
+    # whose extraction fails validation at the next, e.g. [100, 200, 300],
+    # unset renders every page once
+    progressive_dpis: Optional[List[int]] = None
+    # folder streamed pages are rendered into, e.g. /dev/shm, unset uses the
+    # system temporary folder
+    render_dir: Optional[str] = None
+    # serves per-step pipeline metrics on :port/metrics, unset disables it
+    metrics_port: Optional[int] = None
+
+
+@lru_cache
+def get_environ() -> Environ:
+    """
+    environment settings, read once per process
+    """
+    return Environ()
@@ -0,0 +1,153 @@
+"""
+page layout from tesseract word boxes, rows and columns are rebuilt from
+word coordinates so tables reach the text model as markdown tables
+"""
+from typing import List, TypedDict
+import numpy as np
+
+# tesseract tsv columns
+TSV_COLUMNS = ("level", "page_num", "block_num", "par_num", "line_num", "word_num",
+               "left", "top", "width", "height", "conf", "text")
+
+
+class Word(TypedDict):
+    """
+    one recognised word and its box in pixels
+    """
+    text: str
+    left: int
+    top: int
+    width: int
+    height: int
+    conf: float
+
+
+class Cell(TypedDict):
+    """
+    words of a row standing close together, a table cell or a run of text
+    """
+    text: str
+    left: int
+    right: int
+
+
+def parse_tsv(tsv: str) -> List[Word]:
+    """
+    words of tesseract tsv output, with or without the header line, boxes
+    without text (pages, blocks, lines) are dropped
+    """
+    words: List[Word] = []
+    for line in tsv.splitlines():
+        fields = line.split("\t")
+        if len(fields) < len(TSV_COLUMNS) or fields[0] == "level":
+            continue
+        values = dict(zip(TSV_COLUMNS, fields))
+        text = values["text"].strip()
+        if not text or float(values["conf"]) < 0:
+            continue
+        words.append({
+            "text": text,
+            "left": int(values["left"]),
+            "top": int(values["top"]),
+            "width": int(values["width"]),
+            "height": int(values["height"]),
+            "conf": float(values["conf"])
+        })
+    return words
+
+
+def _split_points(values: np.ndarray, gap: float) -> np.ndarray:
+    """indexes at which sorted `values` jump by more than `gap`"""
+    return np.flatnonzero(np.diff(values) > gap) + 1
+
+
+def group_rows(words: List[Word], row_gap: float = 0.5) -> List[List[Word]]:
+    """
+    words grouped into visual rows by the vertical centre of their boxes,
+    rows top to bottom and words left to right, `row_gap` is in word heights
+    """
+    if not words:
+        return []
+    centres = np.array([word["top"] + word["height"] / 2 for word in words])
+    height = float(np.median([word["height"] for word in words]))
+    order = np.argsort(centres, kind="stable")
+    rows = np.split(order, _split_points(centres[order], row_gap * height))
+    return [sorted((words[index] for index in row), key=lambda word: word["left"])
+            for row in rows]
+
+
+def group_cells(row: List[Word], height: float, cell_gap: float = 1.2) -> List[Cell]:
+    """
+    words of a row joined into cells, a gap wider than `cell_gap` word
+    heights starts a new cell, ordinary spaces are about a third of one
+    """
+    cells: List[Cell] = []
+    for word in row:
+        right = word["left"] + word["width"]
+        if cells and word["left"] - cells[-1]["right"] <= cell_gap * height:
+            cells[-1]["text"] += " " + word["text"]
+            cells[-1]["right"] = right
+        else:
+            cells.append({"text": word["text"], "left": word["left"], "right": right})
+    return cells
+
+
+def column_starts(rows: List[List[Cell]], height: float, column_gap: float = 1.5) -> np.ndarray:
+    """
+    left edges of the columns shared by `rows`, found by clustering the left
+    edges of all their cells
+    """
+    lefts = np.sort(np.array([cell["left"] for row in rows for cell in row]))
+    return np.array([cluster[0] for cluster in
+                     np.split(lefts, _split_points(lefts, column_gap * height))])
+
+
+def _markdown_table(rows: List[List[Cell]], starts: np.ndarray) -> str:
+    table: List[List[str]] = []
+    for row in rows:
+        cells = [""] * len(starts)
+        for cell in row:
+            column = int(np.searchsorted(starts, cell["left"], side="right")) - 1
+            text = cell["text"].replace("|", "\\|")
+            cells[column] = f"{cells[column]} {text}".strip()
+        table.append(cells)
+    lines = ["| " + " | ".join(cells) + " |" for cells in table]
+    lines.insert(1, "| " + " | ".join(["---"] * len(starts)) + " |")
+    return "\n".join(lines)
+
+
+def layout_text(words: List[Word], min_table_rows: int = 3) -> str:
+    """
+    page text in reading order, runs of at least `min_table_rows` rows that
+    split into two or more cells are rendered as markdown tables, the first
+    row as their header
+    """
+    if not words:
+        return ""
+    height = float(np.median([word["height"] for word in words]))
+    rows = [group_cells(row, height) for row in group_rows(words)]
+
+    blocks: List[str] = []
+    lines: List[str] = []
+    index = 0
+    while index < len(rows):
+        end = index
+        while end < len(rows) and len(rows[end]) > 1:
+            end += 1
+        if end - index >= min_table_rows:
+            table = rows[index:end]
+            starts = column_starts(table, height)
+            if len(starts) > 1:
+                if lines:
+                    blocks.append("\n".join(lines))
+                    lines = []
+                blocks.append(_markdown_table(table, starts))
+                index = end
+                continue
+        # a plain row, or too few multi-cell rows for a table
+        end = max(end, index + 1)
+        lines.extend(" ".join(cell["text"] for cell in row) for row in rows[index:end])
+        index = end
+    if lines:
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
@@ -0,0 +1,116 @@
+"""
+warm tesseract engines, one per worker process, pages are recognised
+without spawning tesseract or reloading its traineddata each time
+"""
+import asyncio
+import importlib.util
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from typing import Any, Optional, Tuple
+from PIL import Image
+from pipeline.model.environ.Environ import get_environ
+from pipeline.runtime.executor import cpu_worker_count, on_shutdown
+
+# engine of the current pool process, set by its initializer
+_engine: Any = None
+
+_pool: Optional["TesseractPool"] = None
+_pool_lock = threading.Lock()
+
+
+@lru_cache
+def tesserocr_available() -> bool:
+    """
+    whether the tesserocr bindings are installed, checked without loading
+    libtesseract into the worker itself
+    """
+    return importlib.util.find_spec("tesserocr") is not None
+
+
+def _start_engine(language: str) -> None:
+    global _engine
+    import tesserocr
+    _engine = tesserocr.PyTessBaseAPI(lang=language)
+
+
+def recognise_page(image: bytes) -> str:
+    """text of an encoded page, run by a pool process on its warm engine"""
+    _engine.SetImage(Image.open(BytesIO(image)))
+    return _engine.GetUTF8Text()
+
+
+def recognise_page_tsv(image: bytes) -> str:
+    """word boxes of an encoded page as tesseract tsv"""
+    _engine.SetImage(Image.open(BytesIO(image)))
+    return _engine.GetTSVText(0)
+
+
+def recognise_page_with_confidence(image: bytes) -> Tuple[str, float]:
+    """text of an encoded page and its mean word confidence (0-100)"""
+    _engine.SetImage(Image.open(BytesIO(image)))
+    return _engine.GetUTF8Text(), float(_engine.MeanTextConf())
+
+
+class TesseractPool:
+    """
+    process pool whose processes each hold a loaded tesseract engine, pages
+    queue up for the next free engine while the event loop carries on
+    """
+
+    def __init__(self, workers: int, language: str = "eng") -> None:
+        """
+        Args:
+            workers: Engines, one per process, usually one per core
+            language: Traineddata every engine loads, e.g. eng+deu
+        """
+        # forkserver, see shared_process_pool
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_start_engine,
+            initargs=(language,))
+
+    async def recognise(self, image: bytes) -> str:
+        """text of an encoded page"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, recognise_page, image)
+
+    async def recognise_tsv(self, image: bytes) -> str:
+        """word boxes of an encoded page as tesseract tsv"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, recognise_page_tsv, image)
+
+    async def recognise_with_confidence(self, image: bytes) -> Tuple[str, float]:
+        """text of an encoded page and its mean word confidence (0-100)"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, recognise_page_with_confidence, image)
+
+    def shutdown(self) -> None:
+        """cancels queued pages, waits for those in progress and stops the engines"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def shared_tesseract_pool() -> TesseractPool:
+    """
+    pool of `OCR_WORKERS` engines (one per cpu worker by default) loading
+    `OCR_LANGUAGE`
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = TesseractPool(workers=get_environ().ocr_workers or cpu_worker_count(),
+                                  language=get_environ().ocr_language)
+            on_shutdown(shutdown_tesseract_pool)
+        return _pool
+
+
+def shutdown_tesseract_pool() -> None:
+    """stops the shared engines, if they were started"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = None
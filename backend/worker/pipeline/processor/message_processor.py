@@ -3,12 +3,18 @@ import asyncio
 import io
 import json
 from supabase import AsyncClient
-from typing import Any, Coroutine, Dict, List
-from pipeline.router.file_strategy_router import route_files_to_pipeline
-from pipeline.model.StrategyModel import StrategyResponseModel
+from typing import Any, Coroutine, Dict, List, Optional
+from pipeline.base.instrumentation import StepMetrics, TimelineHook
+from pipeline.extractor.batch_api import OpenAIBatchExecutor, RunBatch, RunBatchMember
+from pipeline.image.page_filter_step import PageClaims, PageIndex, run_page_index
+from pipeline.message.publisher import MessagePublisher
+from pipeline.router.file_strategy_router import route_file_to_shards, route_files_to_pipeline
+from pipeline.model.StrategyModel import ExtractionStrategies, StrategyResponseModel
+from pipeline.model.environ.Environ import ConsumerMode
 from pipeline.model.SchemaModel import SchemaConfiguration
 from pipeline.model.StepDataModel import StepData
-from pipeline.model.PipelineModel import CreatePipelineRun, PipelineRunResponse
+from pipeline.model.PipelineModel import CreatePipelineRun, PipelineRunResponse, PipelineStatus
+from pipeline.model.WorkItemModel import FileResult, FileWorkItem, PageRange, PageShardWorkItem, WorkItemKind
 
 
 class MessageProcessor:
@@ -21,23 +27,82 @@ class MessageProcessor:
     pipeline_runs_table_name = "pipeline_runs"
     strategies_table_name = "strategies"
 
-    def __init__(self, client: AsyncClient) -> None:
+    def __init__(self,
+                 client: AsyncClient,
+                 publisher: Optional[MessagePublisher] = None,
+                 fan_out_min_files: Optional[int] = None,
+                 shard_pages: Optional[int] = None,
+                 filter_pages: bool = False,
+                 consumer_mode: Optional[ConsumerMode] = None) -> None:
+        """
+        Args:
+            client: Supabase client
+            publisher: Queue publisher used to fan runs out into per-file work items
+            fan_out_min_files: Runs with at least this many files are fanned out,
+                `None` processes every run on the worker that received it
+            shard_pages: PDFs with more pages are extracted in page-range shards of
+                this size, published as work items when the run is fanned out
+            filter_pages: Share a page index between the files of a run, read
+                by the page filter
+            consumer_mode: Consumer the messages come from, runs of the batch
+                api strategy hold their message for hours and are only
+                accepted from pgmq, which extends its lease meanwhile
+        """
         self.client = client
+        self.publisher = publisher
+        self.fan_out_min_files = fan_out_min_files
+        self.shard_pages = shard_pages
+        self.filter_pages = filter_pages
+        self.consumer_mode = consumer_mode
+
+    async def process_payload(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        process any decoded queue message, a pipeline run or one of its work items
+        """
+        if message.get("kind") == WorkItemKind.FILE:
+            return await self.process_file_item(FileWorkItem.model_validate(message))
+        if message.get("kind") == WorkItemKind.SHARD:
+            return await self.process_shard_item(PageShardWorkItem.model_validate(message))
+        pipeline_message = PipelineRunResponse.model_validate(message)
+        batch_run = await self._is_batch_run(pipeline_message)
+        if batch_run and self.consumer_mode != ConsumerMode.PGMQ:
+            # rabbitmq's consumer_timeout would close the channel mid batch
+            # and redeliver the run to another worker
+            await self.client.from_(self.pipeline_runs_table_name).update({
+                "status": "failed",
+                "error_message": (f"The {ExtractionStrategies.FILE_IMAGE_OPENAI_BATCH} strategy "
+                                  "waits on its batch for hours and needs CONSUMER_MODE=pgmq")
+            }).eq("id", str(pipeline_message.id)).execute()
+            return None
+        # a batch run's pages all go into one submission on this worker
+        if not batch_run and self._should_fan_out(pipeline_message):
+            return await self.fan_out(pipeline_message)
+        return await self.process_message(pipeline_message=pipeline_message)
 
     async def process_message(self, pipeline_message: PipelineRunResponse) -> List[StepData]:
         """
         process incoming rabbitmq message
+
+        a failed run is marked failed and the error re-raised, so the
+        consumer nacks it (rabbitmq) or lets pgmq redeliver it until its
+        attempts run out
         """
+        timelines = [TimelineHook() for _ in pipeline_message.file_paths]
         try:
             strategy_id = str(pipeline_message.strategy_id)
             await self.client.from_(self.pipeline_runs_table_name).update({"status": "processing"}).eq("id", str(pipeline_message.id)).execute()
+            run_batch = RunBatch(OpenAIBatchExecutor(), len(pipeline_message.file_paths)) \
+                if await self._is_batch_run(pipeline_message) else None
             extraction_tasks = [self._prepare_extraction(
                 strategy_id=strategy_id,
                 filename=file["filename"],
                 mimetype=file["mimetype"],
                 path=file["bucket_path"],
-                schema=pipeline_message.extraction_schema)
-                for file in pipeline_message.file_paths]
+                schema=pipeline_message.extraction_schema,
+                timeline=timeline,
+                page_index=self._page_index(str(pipeline_message.id)),
+                batch_member=run_batch.member() if run_batch is not None else None)
+                for file, timeline in zip(pipeline_message.file_paths, timelines)]
 
             step_data_results: List[StepData] = await asyncio.gather(*extraction_tasks)
             if any(step_data is None for step_data in step_data_results):
@@ -46,60 +111,392 @@ class MessageProcessor:
             instances = [
                 item for entry in step_data_results for row in entry["event"]["rows"] for item in row]
 
-            response = await self.client.storage.from_(self.outputs_bucket_name).upload(
-                path=f"results/{pipeline_message.id}.json",
-                file=json.dumps(
-                    {"instances": instances}).encode('utf-8'),
-                file_options={"cache-control": "3600", "upsert": "false"}
-            )
+            await self._write_outputs(run_id=str(pipeline_message.id),
+                                      instances=instances)
+
+            await self.client.from_(self.pipeline_runs_table_name).update({
+                "status": "completed",
+                "messages": self._timeline_messages(
+                    [file["filename"] for file in pipeline_message.file_paths],
+                    [timeline.timeline() for timeline in timelines],
+                    [step_data["context"].get("metrics", {}) for step_data in step_data_results])
+            }).eq("id", str(pipeline_message.id)).execute()
+
+            return {"instances": instances}
+        except Exception as e:
+
+            await self.client.from_(self.pipeline_runs_table_name).update({
+                "status": "failed",
+                "error_message": str(e),
+                "messages": self._timeline_messages(
+                    [file["filename"] for file in pipeline_message.file_paths],
+                    [timeline.timeline() for timeline in timelines])
+            }).eq("id", str(pipeline_message.id)).execute()
+            raise
+
+    async def fan_out(self, pipeline_message: PipelineRunResponse) -> Dict[str, Any]:
+        """
+        splits a run into per-file work items that any worker can take
+        """
+        file_count = len(pipeline_message.file_paths)
+        await self.client.from_(self.pipeline_runs_table_name).update({"status": "processing"}).eq("id", str(pipeline_message.id)).execute()
+        await self.publisher.publish([
+            FileWorkItem(run=pipeline_message,
+                         file_index=file_index,
+                         file_count=file_count).to_message()
+            for file_index in range(file_count)])
+        return {"fanned_out": file_count}
+
+    async def process_file_item(self, item: FileWorkItem) -> Optional[FileResult]:
+        """
+        extracts one file of a fanned out run and persists its result, the
+        worker finishing the last file aggregates the run
+
+        pdfs longer than `shard_pages` are split further into page-range work items
+        """
+        file = item.run.file_paths[item.file_index]
+        file_bytes: Optional[bytes] = None
+        if self.shard_pages is not None and file["mimetype"] == "application/pdf":
+            try:
+                file_bytes = await self._download_file(path=file["bucket_path"])
+                page_ranges = route_file_to_shards(mimetype=file["mimetype"],
+                                                   file_bytes=file_bytes,
+                                                   shard_pages=self.shard_pages)
+                if page_ranges:
+                    await self.publisher.publish([
+                        PageShardWorkItem(run=item.run,
+                                          file_index=item.file_index,
+                                          file_count=item.file_count,
+                                          page_range=page_range,
+                                          shard_index=shard_index,
+                                          shard_count=len(page_ranges)).to_message()
+                        for shard_index, page_range in enumerate(page_ranges)])
+                    return None
+            except Exception as e:
+                # a file that can't be downloaded, read or sharded still gets
+                # its result, or the run would never aggregate
+                result = self._file_result(item)
+                result["status"] = "failed"
+                result["error"] = str(e)
+                await self._persist_file_result(item=item, result=result)
+                return result
+
+        result = await self._extract_file_result(item=item, file_bytes=file_bytes)
+        await self._persist_file_result(item=item, result=result)
+        return result
+
+    async def process_shard_item(self, item: PageShardWorkItem) -> FileResult:
+        """
+        extracts one page range of a pdf, the worker finishing the last shard
+        merges the shards in page order into the file's result
+        """
+        result = await self._extract_file_result(item=item,
+                                                 page_range=item.page_range)
+        run_id = str(item.run.id)
+        shards_path = self._shards_path(run_id, item.file_index)
+        await self.client.storage.from_(self.outputs_bucket_name).upload(
+            path=f"{shards_path}/{item.shard_index}.json",
+            file=json.dumps(result).encode('utf-8'),
+            file_options={"cache-control": "3600", "upsert": "true"}
+        )
+        if await self._count_results(shards_path, item.shard_count) < item.shard_count:
+            return result
+
+        shard_results: List[FileResult] = await asyncio.gather(*[
+            self._download_result(f"{shards_path}/{shard_index}.json")
+            for shard_index in range(item.shard_count)])
+        failed = [shard for shard in shard_results if shard["status"] == "failed"]
+        merged: FileResult = {
+            "file_index": item.file_index,
+            "filename": result["filename"],
+            "status": "failed" if failed else "completed",
+            "instances": [
+                instance for shard in shard_results for instance in shard["instances"]],
+            "error": "; ".join(shard["error"] for shard in failed) or None,
+            "timeline": [
+                metrics for shard in shard_results for metrics in shard.get("timeline", [])],
+            "metrics": self._sum_metrics([shard.get("metrics", {}) for shard in shard_results])
+        }
+        await self._persist_file_result(item=item, result=merged)
+        return result
+
+    async def aggregate(self, run_id: str, file_count: int) -> Optional[PipelineStatus]:
+        """
+        builds the json/csv output from every per-file result and closes the run
+
+        safe to call more than once, only the call that moves the run out of
+        `processing` records the output
+        """
+        results: List[FileResult] = await asyncio.gather(*[
+            self._download_result(f"{self._parts_path(run_id)}/{file_index}.json")
+            for file_index in range(file_count)])
+        instances = [
+            instance for result in results for instance in result["instances"]]
+        failed = [result for result in results if result["status"] == "failed"]
+        if len(failed) == len(results):
+            status = PipelineStatus.FAILED
+        elif failed:
+            status = PipelineStatus.INCOMPLETE
+        else:
+            status = PipelineStatus.COMPLETED
+
+        if status != PipelineStatus.FAILED:
+            uri = await self._write_outputs(run_id=run_id,
+                                            instances=instances,
+                                            record=False)
+
+        update = {
+            "status": status,
+            "messages": self._timeline_messages(
+                [result["filename"] for result in results],
+                [result.get("timeline", []) for result in results],
+                [result.get("metrics", {}) for result in results])
+        }
+        if failed:
+            update["error_message"] = "; ".join(
+                f"{result['filename']}: {result['error']}" for result in failed)
+        claimed = await self.client.from_(self.pipeline_runs_table_name).update(update).eq("id", run_id).eq("status", PipelineStatus.PROCESSING).execute()
+        if len(claimed.data) == 0:
+            # another worker already closed this run
+            return None
+        if status != PipelineStatus.FAILED:
+            await self.client.from_(self.outputs_table_name).insert({
+                "pipeline_id": run_id,
+                "uri": uri
+            }).execute()
+        return status
+
+    async def _write_outputs(self,
+                             run_id: str,
+                             instances: List[Dict[str, Any]],
+                             record: bool = True) -> str:
+        """
+        uploads the json and csv outputs, returns the json uri
+        """
+        response = await self.client.storage.from_(self.outputs_bucket_name).upload(
+            path=f"results/{run_id}.json",
+            file=json.dumps(
+                {"instances": instances}).encode('utf-8'),
+            file_options={"cache-control": "3600",
+                          "upsert": "false" if record else "true"}
+        )
 
+        if record:
             await self.client.from_(self.outputs_table_name).insert({
-                "pipeline_id": str(pipeline_message.id),
+                "pipeline_id": run_id,
                 "uri": response.full_path
             }).execute()
 
-            await self.client.from_(self.pipeline_runs_table_name).update({"status": "completed"}).eq("id", str(pipeline_message.id)).execute()
+        # write to csv
+        csv_string = self.dicts_to_csv_bytes(instances)
 
-            # write to csv
-            csv_string = self.dicts_to_csv_bytes(instances)
+        await self.client.storage.from_(self.outputs_bucket_name).upload(
+            path=f"csv/{run_id}.csv",
+            file=csv_string.encode('utf-8'),
+            file_options={"cache-control": "3600",
+                          "upsert": "false" if record else "true"}
+        )
+        return response.full_path
 
-            response = await self.client.storage.from_(self.outputs_bucket_name).upload(
-                path=f"csv/{pipeline_message.id}.csv",
-                file=csv_string.encode('utf-8'),
-                file_options={"cache-control": "3600",
-                              "upsert": "false"}
-            )
+    def _should_fan_out(self, pipeline_message: PipelineRunResponse) -> bool:
+        return (self.publisher is not None
+                and self.fan_out_min_files is not None
+                and len(pipeline_message.file_paths) >= self.fan_out_min_files)
 
-            return {"instances": instances}
+    def _timeline_messages(self,
+                           filenames: List[str],
+                           timelines: List[List[StepMetrics]],
+                           metrics: Optional[List[Dict[str, float]]] = None) -> Dict[str, Any]:
+        """
+        per-step metrics and recorded counters of every file, stored in the
+        run's messages column
+        """
+        metrics = metrics or [{} for _ in filenames]
+        return {
+            "timeline": [{"filename": filename, "steps": steps, "metrics": counters}
+                         for filename, steps, counters in zip(filenames, timelines, metrics)]
+        }
+
+    def _sum_metrics(self, metrics: List[Dict[str, float]]) -> Dict[str, float]:
+        total: Dict[str, float] = {}
+        for counters in metrics:
+            for name, value in counters.items():
+                total[name] = total.get(name, 0) + value
+        return total
+
+    def _page_index(self, run_id: str) -> Optional[PageIndex]:
+        return run_page_index(run_id) if self.filter_pages else None
+
+    def _parts_path(self, run_id: str) -> str:
+        return f"parts/{run_id}"
+
+    def _shards_path(self, run_id: str, file_index: int) -> str:
+        return f"shards/{run_id}/{file_index}"
+
+    def _file_result(self, item: FileWorkItem) -> FileResult:
+        """empty completed result of a work item's file"""
+        return {
+            "file_index": item.file_index,
+            "filename": item.run.file_paths[item.file_index]["filename"],
+            "status": "completed",
+            "instances": [],
+            "error": None,
+            "timeline": [],
+            "metrics": {}
+        }
+
+    async def _extract_file_result(self,
+                                   item: FileWorkItem,
+                                   page_range: Optional[PageRange] = None,
+                                   file_bytes: Optional[bytes] = None) -> FileResult:
+        """
+        runs the pipeline for a work item, capturing failure in the result
+        """
+        file = item.run.file_paths[item.file_index]
+        result = self._file_result(item)
+        timeline = TimelineHook()
+        try:
+            step_data = await self._prepare_extraction(
+                strategy_id=str(item.run.strategy_id),
+                filename=file["filename"],
+                mimetype=file["mimetype"],
+                path=file["bucket_path"],
+                schema=item.run.extraction_schema,
+                page_range=page_range,
+                file_bytes=file_bytes,
+                timeline=timeline,
+                page_index=self._page_index(str(item.run.id)))
+            result["instances"] = [
+                instance for row in step_data["event"]["rows"] for instance in row]
+            result["metrics"] = step_data["context"].get("metrics", {})
         except Exception as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+        result["timeline"] = timeline.timeline()
+        return result
 
-            await self.client.from_(self.pipeline_runs_table_name).update({"status": "failed"}).eq("id", str(pipeline_message.id)).execute()
-        finally:
-            await self.client.postgrest.aclose()
+    async def _persist_file_result(self, item: FileWorkItem, result: FileResult) -> None:
+        """
+        stores a file's result and aggregates the run once every file is in
+        """
+        run_id = str(item.run.id)
+        # upsert so a redelivered work item overwrites rather than fails
+        await self.client.storage.from_(self.outputs_bucket_name).upload(
+            path=f"{self._parts_path(run_id)}/{item.file_index}.json",
+            file=json.dumps(result).encode('utf-8'),
+            file_options={"cache-control": "3600", "upsert": "true"}
+        )
+        if await self._count_results(self._parts_path(run_id), item.file_count) >= item.file_count:
+            await self.aggregate(run_id=run_id, file_count=item.file_count)
+
+    async def _count_results(self, path: str, expected: int) -> int:
+        files = await self.client.storage.from_(self.outputs_bucket_name).list(
+            path, {"limit": expected + 1})
+        return len(files)
+
+    async def _download_result(self, path: str) -> FileResult:
+        response = await self.client.storage.from_(self.outputs_bucket_name).download(path)
+        return json.loads(response)
 
     async def _prepare_extraction(self,
                                   strategy_id: str,
                                   filename: str,
                                   mimetype: str,
                                   path: str,
-                                  schema: Dict[str, Any]
+                                  schema: Dict[str, Any],
+                                  page_range: Optional[PageRange] = None,
+                                  file_bytes: Optional[bytes] = None,
+                                  timeline: Optional[TimelineHook] = None,
+                                  page_index: Optional[PageIndex] = None,
+                                  batch_member: Optional[RunBatchMember] = None
                                   ) -> StepData:
-        strategy = await self._get_strategy(strategy_id=strategy_id)
-        file_bytes: bytes = await self._download_file(path=path)
-        config: SchemaConfiguration = schema
-        step_data = {
-            "event": {
-                "filename": filename,
-                "mimetype": mimetype,
-                "file_bytes": file_bytes
-            },
-            "context": {
-                "extraction_config": config
+        # pages this file claimed in the run's index but never extracted are
+        # released when it finishes, so other files do not wait on them, and
+        # a file failing before extraction leaves its run's batch
+        page_claims = PageClaims(page_index) if page_index is not None else None
+        try:
+            strategy = await self._get_strategy(strategy_id=strategy_id)
+            if file_bytes is None:
+                file_bytes = await self._download_file(path=path)
+            config: SchemaConfiguration = schema
+            pipeline: Coroutine[Any, Any, StepData] = route_files_to_pipeline(
+                strategy=strategy, mimetype=mimetype)
+
+            if page_range is not None:
+                page_ranges = [page_range]
+            elif batch_member is not None:
+                # shards would split the file's pages over several members
+                page_ranges = []
+            else:
+                page_ranges = route_file_to_shards(mimetype=mimetype,
+                                                   file_bytes=file_bytes,
+                                                   shard_pages=self.shard_pages)
+            if not page_ranges:
+                return await pipeline(self._step_data(filename=filename,
+                                                      mimetype=mimetype,
+                                                      file_bytes=file_bytes,
+                                                      config=config,
+                                                      timeline=timeline,
+                                                      page_claims=page_claims,
+                                                      batch_member=batch_member))
+
+            # shards run concurrently, rows are merged back in page order
+            shards: List[StepData] = await asyncio.gather(*[
+                pipeline(self._step_data(filename=filename,
+                                         mimetype=mimetype,
+                                         file_bytes=file_bytes,
+                                         config=config,
+                                         page_range=shard_range,
+                                         timeline=timeline,
+                                         page_claims=page_claims))
+                for shard_range in page_ranges])
+            return {
+                "event": {
+                    "rows": [row for shard in shards for row in shard["event"]["rows"]]
+                },
+                "context": {
+                    **shards[0]["context"],
+                    "metrics": self._sum_metrics([shard["context"].get("metrics", {})
+                                                  for shard in shards])
+                }
             }
+        finally:
+            if page_claims is not None:
+                page_claims.release()
+            if batch_member is not None:
+                batch_member.release()
+
+    def _step_data(self,
+                   filename: str,
+                   mimetype: str,
+                   file_bytes: bytes,
+                   config: SchemaConfiguration,
+                   page_range: Optional[PageRange] = None,
+                   timeline: Optional[TimelineHook] = None,
+                   page_claims: Optional[PageClaims] = None,
+                   batch_member: Optional[RunBatchMember] = None) -> StepData:
+        event = {
+            "filename": filename,
+            "mimetype": mimetype,
+            "file_bytes": file_bytes
+        }
+        if page_range is not None:
+            event["page_range"] = page_range
+        context = {
+            "extraction_config": config
+        }
+        if timeline is not None:
+            context["pipeline_hooks"] = [timeline]
+        if page_claims is not None:
+            # this file's handle on the run's page index, see PageFilterStep
+            context["page_claims"] = page_claims
+        if batch_member is not None:
+            # this file's handle on the run's batch, see OpenAIBatchExtractor
+            context["run_batch"] = batch_member
+        return {
+            "event": event,
+            "context": context
         }
-        pipeline: Coroutine[Any, Any, StepData] = route_files_to_pipeline(
-            strategy=strategy, mimetype=mimetype)
-        return await pipeline(step_data)
 
     async def _download_file(self, path: str) -> bytes:
         """
@@ -108,6 +505,17 @@ class MessageProcessor:
         response = await self.client.storage.from_(self.bucket_name).download(path)
         return response
 
+    async def _is_batch_run(self, pipeline_message: PipelineRunResponse) -> bool:
+        """
+        whether a run extracts through the batch api, an unknown strategy
+        is left to fail in `process_message`
+        """
+        try:
+            strategy = await self._get_strategy(strategy_id=str(pipeline_message.strategy_id))
+        except ValueError:
+            return False
+        return strategy == ExtractionStrategies.FILE_IMAGE_OPENAI_BATCH
+
     async def _get_strategy(self, strategy_id: str) -> str:
         """
         get strategy for pipeline run
@@ -2,27 +2,130 @@
 file pipeline router
 """
 import ast
-from typing import Any, Coroutine
+import logging
+from functools import lru_cache
+from typing import Any, Coroutine, List, Optional
+from pdf2image import pdfinfo_from_bytes
 from pipeline.model.StrategyModel import ExtractionStrategies
+from pipeline.model.environ.Environ import get_environ
+from pipeline.model.WorkItemModel import PageRange
 from openai import AsyncClient
 from pipeline.extractor.text.ocr_extractor import OCRExtractor
-from pipeline import Pipeline
+from pipeline import DAGPipeline, Pipeline
+from pipeline.extractor.reconcile_step import ReconcileRowsStep
+from pipeline.extractor.progressive_step import ProgressiveImageExtractor
 from pipeline.base.pipeline_step import StepData
 from pipeline.extractor.openai_extractor import OpenAIExtractor, OpenAIImageExtractor
+from pipeline.extractor.batch_api import OpenAIBatchExtractor
 from pipeline.image.pdf_to_jpg_step import PDFToJPGStep
+from pipeline.image.image_optimizer_step import ImageOptimizerStep
 from pipeline.file.gotenberg_step import GotenbergPipelineStep
+from pipeline.file.text_layer_step import MergeTextLayerRowsStep, TextLayerStep
+from pipeline.router.page_router import page_routed_pipeline
+from pipeline.router.vision_branch import add_vision_rows
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache
+def _warn_progressive_precedence() -> None:
+    """logs once per process the settings `PROGRESSIVE_DPIS` takes precedence over"""
+    environ = get_environ()
+    ignored = [name for name, enabled in (
+        ("FILTER_PAGES", environ.filter_pages),
+        ("OPTIMIZE_IMAGES", environ.optimize_images),
+        ("STREAMING_PIPELINES", environ.streaming_pipelines),
+        ("LLM_BATCH_MAX_TOKENS", environ.llm_batch_max_tokens is not None)) if enabled]
+    if ignored:
+        logger.warning(f"Ignoring {', '.join(ignored)} for progressively rendered pages, "
+                       "PROGRESSIVE_DPIS takes precedence")
+
+
+def progressive_extractor(ocr: bool = False) -> ProgressiveImageExtractor:
+    """
+    step rendering pages at `PROGRESSIVE_DPIS`, which takes precedence over
+    page filtering, image optimization, streaming and page batching
+    """
+    _warn_progressive_precedence()
+    return ProgressiveImageExtractor(dpis=get_environ().progressive_dpis, ocr=ocr)
+
+
+def text_layer_pipeline(min_chars: int, convert: bool = False) -> DAGPipeline:
+    """
+    pages with a usable text layer go straight to the text extractor, only
+    the remaining pages are rendered and sent to the vision model, the rows
+    are merged back in page order
+    """
+    pipeline = DAGPipeline()
+    source = DAGPipeline.INPUT
+    if convert:
+        pipeline.add_step("pdf", GotenbergPipelineStep())
+        source = "pdf"
+    pipeline.add_step("layer", TextLayerStep(min_chars=min_chars), inputs=[source])
+    pipeline.add_step("text_rows", OpenAIExtractor(), inputs=["layer"])
+    if get_environ().progressive_dpis:
+        pipeline.add_step("image_rows",
+                          progressive_extractor(),
+                          inputs=["layer"])
+        pipeline.add_step("rows", MergeTextLayerRowsStep(),
+                          inputs=["layer", "text_rows", "image_rows"])
+        return pipeline
+    pipeline.add_step("images", PDFToJPGStep(), inputs=["layer"])
+    add_vision_rows(pipeline, images="images", rows="image_rows")
+    pipeline.add_step("rows", MergeTextLayerRowsStep(),
+                      inputs=["layer", "text_rows", "image_rows"])
+    return pipeline
+
+
+def filtered_image_pipeline(convert: bool = False) -> DAGPipeline:
+    """
+    renders every page, then skips blank and duplicate pages before the
+    vision model
+    """
+    pipeline = DAGPipeline()
+    source = DAGPipeline.INPUT
+    if convert:
+        pipeline.add_step("pdf", GotenbergPipelineStep())
+        source = "pdf"
+    pipeline.add_step("images", PDFToJPGStep(), inputs=[source])
+    add_vision_rows(pipeline, images="images", rows="rows")
+    return pipeline
+
+
+def batch_image_pipeline(convert: bool = False) -> DAGPipeline:
+    """
+    renders every page and extracts them all in one batch api batch
+    """
+    pipeline = DAGPipeline()
+    source = DAGPipeline.INPUT
+    if convert:
+        pipeline.add_step("pdf", GotenbergPipelineStep())
+        source = "pdf"
+    pipeline.add_step("images", PDFToJPGStep(), inputs=[source])
+    add_vision_rows(pipeline, images="images", rows="rows", extractor=OpenAIBatchExtractor)
+    return pipeline
 
 
 async def pdf_file_to_jpeg_to_image_to_row_openai(input_step: StepData) -> StepData:
     """
     converts a file to extracted fields
     """
-    pipeline = Pipeline()
+    if get_environ().text_layer_min_chars is not None:
+        return await text_layer_pipeline(get_environ().text_layer_min_chars).execute(data=input_step)
+    if get_environ().progressive_dpis:
+        pipeline = Pipeline()
+        pipeline.add_step(progressive_extractor())
+        return await pipeline.execute(data=input_step)
+    if get_environ().filter_pages:
+        return await filtered_image_pipeline().execute(data=input_step)
+    pipeline = Pipeline(streaming=get_environ().streaming_pipelines)
     # file_step = GotenbergPipelineStep()
     file_to_images_step = PDFToJPGStep()
     images_to_fields_step = OpenAIImageExtractor()
     # pipeline.add_step(step=file_step)
     pipeline.add_step(step=file_to_images_step)
+    if get_environ().optimize_images:
+        pipeline.add_step(ImageOptimizerStep())
     pipeline.add_step(images_to_fields_step)
     return await pipeline.execute(data=input_step)
 
@@ -31,21 +134,38 @@ async def file_to_pdf_to_jpeg_to_image_to_row_openai(input_step: StepData) -> St
     """
     converts a file to extracted fields
     """
-    pipeline = Pipeline()
+    if get_environ().text_layer_min_chars is not None:
+        return await text_layer_pipeline(get_environ().text_layer_min_chars,
+                                         convert=True).execute(data=input_step)
+    if get_environ().progressive_dpis:
+        pipeline = Pipeline()
+        pipeline.add_step(GotenbergPipelineStep())
+        pipeline.add_step(progressive_extractor())
+        return await pipeline.execute(data=input_step)
+    if get_environ().filter_pages:
+        return await filtered_image_pipeline(convert=True).execute(data=input_step)
+    pipeline = Pipeline(streaming=get_environ().streaming_pipelines)
     file_step = GotenbergPipelineStep()
     file_to_images_step = PDFToJPGStep()
     images_to_fields_step = OpenAIImageExtractor()
     pipeline.add_step(step=file_step)
     pipeline.add_step(step=file_to_images_step)
+    if get_environ().optimize_images:
+        pipeline.add_step(ImageOptimizerStep())
     pipeline.add_step(images_to_fields_step)
     return await pipeline.execute(data=input_step)
 
 
 async def file_to_pdf_to_jpeg_to_text_to_row_openai(input_step: StepData) -> StepData:
-    pipeline = Pipeline()
+    if get_environ().progressive_dpis:
+        pipeline = Pipeline()
+        pipeline.add_step(GotenbergPipelineStep())
+        pipeline.add_step(progressive_extractor(ocr=True))
+        return await pipeline.execute(data=input_step)
+    pipeline = Pipeline(streaming=get_environ().streaming_pipelines)
     file_step = GotenbergPipelineStep()
     file_to_images_step = PDFToJPGStep()
-    images_to_text = OCRExtractor()
+    images_to_text = OCRExtractor(layout=get_environ().ocr_layout)
     texts_to_field_step = OpenAIExtractor()
     pipeline.add_step(step=file_step)
     pipeline.add_step(step=file_to_images_step)
@@ -54,14 +174,84 @@ async def file_to_pdf_to_jpeg_to_text_to_row_openai(input_step: StepData) -> Ste
     return await pipeline.execute(data=input_step)
 
 
+async def file_to_pdf_to_jpeg_to_text_and_image_to_row_openai(input_step: StepData) -> StepData:
+    """
+    extracts the same rasterized pages from both their ocr text and their
+    images in parallel, then keeps the more complete rows per page
+    """
+    pipeline = DAGPipeline()
+    pipeline.add_step("pdf", GotenbergPipelineStep())
+    pipeline.add_step("images", PDFToJPGStep(), inputs=["pdf"])
+    pipeline.add_step("texts", OCRExtractor(layout=get_environ().ocr_layout), inputs=["images"])
+    pipeline.add_step("text_rows", OpenAIExtractor(), inputs=["texts"])
+    pipeline.add_step("image_rows", OpenAIImageExtractor(), inputs=["images"])
+    pipeline.add_step("rows", ReconcileRowsStep(primary="image_rows"),
+                      inputs=["image_rows", "text_rows"])
+    return await pipeline.execute(data=input_step)
+
+
+async def pdf_file_to_jpeg_to_text_and_image_to_row_openai(input_step: StepData) -> StepData:
+    """
+    same as above for pdfs, which skip gotenberg
+    """
+    pipeline = DAGPipeline()
+    pipeline.add_step("images", PDFToJPGStep())
+    pipeline.add_step("texts", OCRExtractor(layout=get_environ().ocr_layout), inputs=["images"])
+    pipeline.add_step("text_rows", OpenAIExtractor(), inputs=["texts"])
+    pipeline.add_step("image_rows", OpenAIImageExtractor(), inputs=["images"])
+    pipeline.add_step("rows", ReconcileRowsStep(primary="image_rows"),
+                      inputs=["image_rows", "text_rows"])
+    return await pipeline.execute(data=input_step)
+
+
+async def pdf_file_to_routed_pages_to_row_openai(input_step: StepData) -> StepData:
+    """
+    extracts each page by text, ocr or vision, whichever is cheapest for it
+    """
+    return await page_routed_pipeline().execute(data=input_step)
+
+
+async def file_to_pdf_to_routed_pages_to_row_openai(input_step: StepData) -> StepData:
+    """
+    same as above for files converted to pdf by gotenberg
+    """
+    return await page_routed_pipeline(convert=True).execute(data=input_step)
+
+
+async def pdf_file_to_jpeg_to_image_to_row_openai_batch(input_step: StepData) -> StepData:
+    """
+    extracts every page of a pdf through the batch api
+    """
+    return await batch_image_pipeline().execute(data=input_step)
+
+
+async def file_to_pdf_to_jpeg_to_image_to_row_openai_batch(input_step: StepData) -> StepData:
+    """
+    same as above for files converted to pdf by gotenberg
+    """
+    return await batch_image_pipeline(convert=True).execute(data=input_step)
+
+
+async def file_to_pdf_to_jpeg_to_text_to_row_openai_batch(input_step: StepData) -> StepData:
+    """
+    ocr text of every page extracted through the batch api
+    """
+    pipeline = Pipeline()
+    pipeline.add_step(GotenbergPipelineStep())
+    pipeline.add_step(PDFToJPGStep())
+    pipeline.add_step(OCRExtractor(layout=get_environ().ocr_layout))
+    pipeline.add_step(OpenAIBatchExtractor())
+    return await pipeline.execute(data=input_step)
+
+
 async def file_to_pdf_to_jpeg_to_text_to_row_ollama(input_step: StepData) -> StepData:
     """
     pipeline for ollama
     """
-    pipeline = Pipeline()
+    pipeline = Pipeline(streaming=get_environ().streaming_pipelines)
     file_step = GotenbergPipelineStep()
     file_to_images_step = PDFToJPGStep()
-    images_to_text = OCRExtractor()
+    images_to_text = OCRExtractor(layout=get_environ().ocr_layout)
     texts_to_field_step = OpenAIExtractor(
         # see https://ollama.com/blog/openai-compatibility
         # TODO: work on parsing this into actual json
@@ -97,6 +287,27 @@ strategy_map = {
             "office": file_to_pdf_to_jpeg_to_image_to_row_openai
         }
     },
+    ExtractionStrategies.FILE_IMAGE_TEXT_OPENAI: {
+        "image": file_to_pdf_to_jpeg_to_text_and_image_to_row_openai,
+        "document": {
+            "pdf": pdf_file_to_jpeg_to_text_and_image_to_row_openai,
+            "office": file_to_pdf_to_jpeg_to_text_and_image_to_row_openai
+        }
+    },
+    ExtractionStrategies.FILE_ADAPTIVE_OPENAI: {
+        "image": file_to_pdf_to_routed_pages_to_row_openai,
+        "document": {
+            "pdf": pdf_file_to_routed_pages_to_row_openai,
+            "office": file_to_pdf_to_routed_pages_to_row_openai
+        }
+    },
+    ExtractionStrategies.FILE_IMAGE_OPENAI_BATCH: {
+        "image": file_to_pdf_to_jpeg_to_text_to_row_openai_batch,
+        "document": {
+            "pdf": pdf_file_to_jpeg_to_image_to_row_openai_batch,
+            "office": file_to_pdf_to_jpeg_to_image_to_row_openai_batch
+        }
+    },
     # TODO: to implement other pdf pipelines
     # ExtractionStrategies.FILE_TEXT_OPENAI: {
     #     "image": file_to_pdf_to_jpeg_to_text_to_row_openai,
@@ -269,3 +480,29 @@ def route_files_to_pipeline(strategy: ExtractionStrategies, mimetype: str) -> Co
     else:
         raise NotImplementedError(f"""strategy for file of {
                                   mimetype} is not implemented""")
+
+
+def plan_page_shards(page_count: int, shard_pages: int) -> List[PageRange]:
+    """
+    splits pages 1..page_count into consecutive ranges of at most shard_pages
+    """
+    if shard_pages < 1:
+        raise ValueError("shard_pages must be at least 1")
+    return [
+        {"first_page": first_page,
+         "last_page": min(first_page + shard_pages - 1, page_count)}
+        for first_page in range(1, page_count + 1, shard_pages)
+    ]
+
+
+def route_file_to_shards(mimetype: str, file_bytes: bytes, shard_pages: Optional[int]) -> List[PageRange]:
+    """
+    returns the page ranges a pdf is extracted in, empty when the file
+    should go through its pipeline whole
+    """
+    if shard_pages is None or mimetype != "application/pdf":
+        return []
+    page_count = pdfinfo_from_bytes(file_bytes)["Pages"]
+    if page_count <= shard_pages:
+        return []
+    return plan_page_shards(page_count=page_count, shard_pages=shard_pages)
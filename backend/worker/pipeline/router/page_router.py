@@ -0,0 +1,269 @@
+"""
+per-page router, cheap pdf features decide how each page is extracted
+"""
+from enum import StrEnum
+from typing import Dict, List, Optional, TypedDict
+import pymupdf
+from pipeline.base import DAGPipeline, JoinStep, PipelineStep
+from pipeline.extractor.openai_extractor import OpenAIExtractor
+from pipeline.extractor.text.ocr_extractor import OCRExtractor
+from pipeline.extractor.vision_tokens import estimate_vision_tokens
+from pipeline.file.gotenberg_step import GotenbergPipelineStep
+from pipeline.image.pdf_to_jpg_step import PDFToJPGStep
+from pipeline.model.environ.Environ import get_environ
+from pipeline.model.StepDataModel import StepData
+from pipeline.model.WorkItemModel import PageRange
+from pipeline.router.vision_branch import add_vision_rows
+from pipeline.runtime.executor import ExecutionMode
+
+# resolution pdf2image renders pages at by default
+RENDER_DPI = 200
+POINTS_PER_INCH = 72
+# thinner rectangles are ruling lines rather than boxes
+RULE_THICKNESS = 2
+
+
+class PageRoute(StrEnum):
+    """
+    extraction path of a page, cheapest first
+    """
+    # text layer straight to a text model
+    TEXT = "text"
+    # rendered, ocr'd, then a text model
+    OCR = "ocr"
+    # rendered and sent to a vision model
+    VISION = "vision"
+
+
+class PageFeatures(TypedDict):
+    """
+    cheap features of a pdf page, read without rendering it
+    """
+    page_number: int
+    # text layer, dropped once the page is routed
+    text: str
+    # non-whitespace characters in the text layer
+    text_chars: int
+    # share of the page covered by embedded images
+    image_coverage: float
+    # horizontal and vertical vector lines, tables are drawn with them
+    ruling_lines: int
+    # tokens the rendered page would cost a vision model
+    vision_tokens: int
+
+
+def _ruling_lines(page: pymupdf.Page) -> int:
+    lines = 0
+    for drawing in page.get_drawings():
+        for item in drawing["items"]:
+            if item[0] == "l":
+                start, end = item[1], item[2]
+                if abs(start.x - end.x) < 1 or abs(start.y - end.y) < 1:
+                    lines += 1
+            elif item[0] == "re":
+                rect = item[1]
+                # a thin rectangle is one rule, a box (e.g. a cell) is four
+                lines += 1 if min(rect.width, rect.height) < RULE_THICKNESS else 4
+    return lines
+
+
+def _image_coverage(page: pymupdf.Page) -> float:
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    covered = sum(abs(pymupdf.Rect(image["bbox"]) & page.rect)
+                  for image in page.get_image_info())
+    return min(1.0, covered / page_area)
+
+
+def page_features(pdf_bytes: bytes,
+                  first_page: Optional[int] = None,
+                  last_page: Optional[int] = None) -> List[PageFeatures]:
+    """
+    reads the features of a page range, module level so it can run in the
+    shared process pool
+
+    the text of every page is returned alongside, so text routed pages need
+    no second pass over the pdf
+    """
+    features: List[PageFeatures] = []
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as document:
+        first_page = first_page or 1
+        last_page = last_page or document.page_count
+        for page_number in range(first_page, last_page + 1):
+            page = document[page_number - 1]
+            text = page.get_text()
+            scale = RENDER_DPI / POINTS_PER_INCH
+            features.append({
+                "page_number": page_number,
+                "text": text,
+                "text_chars": sum(1 for character in text if not character.isspace()),
+                "image_coverage": _image_coverage(page),
+                "ruling_lines": _ruling_lines(page),
+                "vision_tokens": estimate_vision_tokens(round(page.rect.width * scale),
+                                                        round(page.rect.height * scale))
+            })
+    return features
+
+
+def choose_route(features: PageFeatures,
+                 min_text_chars: int,
+                 min_table_lines: int,
+                 min_scan_coverage: float,
+                 min_ocr_vision_tokens: int = 600) -> PageRoute:
+    """
+    cheapest path that still reads the page well, scans too small to cost
+    `min_ocr_vision_tokens` as an image go to the vision model, their ocr
+    text and a second model call would cost about as much
+    """
+    if features["ruling_lines"] >= min_table_lines:
+        # tables lose their structure as plain text
+        return PageRoute.VISION
+    if features["text_chars"] >= min_text_chars:
+        return PageRoute.TEXT
+    if features["image_coverage"] >= min_scan_coverage and \
+            features["vision_tokens"] >= min_ocr_vision_tokens:
+        # a scan, ocr reads it for a fraction of the vision tokens
+        return PageRoute.OCR
+    # little text and no scan (e.g. charts or drawings), or a small scan
+    return PageRoute.VISION
+
+
+class PageRouterStep(PipelineStep):
+    """
+    routes every page of a pdf to text, ocr or vision extraction
+
+    keeps the incoming event and adds `routes` (page numbers per route),
+    `features` (per page), and `texts` / `text_pages` for text routed pages
+    """
+    # parsing the pdf is cpu-bound
+    execution_mode = ExecutionMode.PROCESS
+
+    def __init__(self,
+                 min_text_chars: int = 200,
+                 min_table_lines: int = 12,
+                 min_scan_coverage: float = 0.5,
+                 min_ocr_vision_tokens: int = 600) -> None:
+        """
+        Args:
+            min_text_chars: Text layer characters a page needs to be extracted from its text
+            min_table_lines: Ruling lines from which a page is treated as a table
+            min_scan_coverage: Image coverage from which a page is treated as a scan
+            min_ocr_vision_tokens: Vision tokens from which a scan is cheaper
+                through ocr, the default sends scans of at most two 512px
+                tiles (e.g. receipts and labels) to the vision model
+        """
+        self.min_text_chars = min_text_chars
+        self.min_table_lines = min_table_lines
+        self.min_scan_coverage = min_scan_coverage
+        self.min_ocr_vision_tokens = min_ocr_vision_tokens
+
+    async def process(self, data: StepData) -> StepData:
+        page_range: PageRange = data["event"].get("page_range") or {}
+        pages = await self.offload(page_features,
+                                   data["event"]["file_bytes"],
+                                   page_range.get("first_page"),
+                                   page_range.get("last_page"))
+        routes: Dict[PageRoute, List[int]] = {route: [] for route in PageRoute}
+        texts: List[str] = []
+        for page in pages:
+            route = choose_route(page,
+                                 min_text_chars=self.min_text_chars,
+                                 min_table_lines=self.min_table_lines,
+                                 min_scan_coverage=self.min_scan_coverage,
+                                 min_ocr_vision_tokens=self.min_ocr_vision_tokens)
+            routes[route].append(page["page_number"])
+            if route == PageRoute.TEXT:
+                texts.append(page["text"])
+        return {
+            "event": {
+                **data["event"],
+                "routes": routes,
+                "features": [{key: value for key, value in page.items() if key != "text"}
+                             for page in pages],
+                "texts": texts,
+                "text_pages": routes[PageRoute.TEXT]
+            },
+            "context": data["context"]
+        }
+
+
+class SelectRoutePagesStep(PipelineStep):
+    """
+    narrows a routed document to one route's pages, read by `PDFToJPGStep`
+    """
+
+    def __init__(self, route: PageRoute) -> None:
+        self.route = route
+
+    async def process(self, data: StepData) -> StepData:
+        return {
+            "event": {
+                "file_bytes": data["event"]["file_bytes"],
+                "pages": data["event"]["routes"][self.route]
+            },
+            "context": data["context"]
+        }
+
+
+class MergeRoutedRowsStep(JoinStep):
+    """
+    merges the rows of every route back into page order
+    """
+
+    def __init__(self, router: str, rows: Dict[PageRoute, str]) -> None:
+        """
+        Args:
+            router: Input holding the `PageRouterStep` output
+            rows: Input holding the rows of each route's pages, in page order
+        """
+        self.router = router
+        self.rows = rows
+
+    async def join(self, inputs: Dict[str, StepData]) -> StepData:
+        routes = inputs[self.router]["event"]["routes"]
+        rows_by_page = {}
+        for route, input_name in self.rows.items():
+            rows_by_page.update(zip(routes[route], inputs[input_name]["event"]["rows"]))
+        return {
+            "event": {
+                "rows": [rows_by_page[page_number] for page_number in sorted(rows_by_page)]
+            },
+            "context": inputs[self.router]["context"]
+        }
+
+
+def page_routed_pipeline(convert: bool = False, **thresholds) -> DAGPipeline:
+    """
+    routes each page of a pdf, or of a document converted to pdf, to the
+    cheapest adequate extraction, the three routes run concurrently
+
+    Args:
+        convert: Convert the file to pdf with gotenberg first
+        thresholds: Passed on to `PageRouterStep`
+    """
+    pipeline = DAGPipeline()
+    source = DAGPipeline.INPUT
+    if convert:
+        pipeline.add_step("pdf", GotenbergPipelineStep())
+        source = "pdf"
+    pipeline.add_step("route", PageRouterStep(**thresholds), inputs=[source])
+    pipeline.add_step("text_rows", OpenAIExtractor(), inputs=["route"])
+
+    pipeline.add_step("ocr_pages", SelectRoutePagesStep(PageRoute.OCR), inputs=["route"])
+    pipeline.add_step("ocr_images", PDFToJPGStep(), inputs=["ocr_pages"])
+    pipeline.add_step("ocr_texts", OCRExtractor(layout=get_environ().ocr_layout), inputs=["ocr_images"])
+    pipeline.add_step("ocr_rows", OpenAIExtractor(), inputs=["ocr_texts"])
+
+    pipeline.add_step("vision_pages", SelectRoutePagesStep(PageRoute.VISION), inputs=["route"])
+    pipeline.add_step("vision_images", PDFToJPGStep(), inputs=["vision_pages"])
+    add_vision_rows(pipeline, images="vision_images", rows="vision_rows", prefix="vision_")
+
+    pipeline.add_step("rows",
+                      MergeRoutedRowsStep(router="route", rows={
+                          PageRoute.TEXT: "text_rows",
+                          PageRoute.OCR: "ocr_rows",
+                          PageRoute.VISION: "vision_rows"
+                      }),
+                      inputs=["route", "text_rows", "ocr_rows", "vision_rows"])
+    return pipeline
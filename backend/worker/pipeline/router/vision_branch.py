@@ -0,0 +1,42 @@
+"""
+vision branch shared by the dag pipelines, rendered pages to rows
+"""
+from typing import Callable
+from pipeline.base import DAGPipeline
+from pipeline.base.pipeline_step import PipelineStep
+from pipeline.extractor.openai_extractor import OpenAIImageExtractor
+from pipeline.image.image_optimizer_step import ImageOptimizerStep
+from pipeline.image.page_filter_step import PageFilterStep, RestoreFilteredRowsStep
+from pipeline.model.environ.Environ import get_environ
+
+
+def add_vision_rows(pipeline: DAGPipeline,
+                    images: str,
+                    rows: str,
+                    prefix: str = "",
+                    extractor: Callable[[], PipelineStep] = OpenAIImageExtractor) -> None:
+    """
+    adds the steps turning the rendered pages of input `images` into rows,
+    ending in a step named `rows`, optimizing and filtering pages when enabled
+
+    Args:
+        pipeline: Pipeline the steps are added to
+        images: Step whose output holds the rendered pages
+        rows: Name of the step holding the rows, one list per page
+        prefix: Prepended to the names of intermediate steps, keeps several
+            branches in one pipeline apart
+        extractor: Creates the step extracting rows from page images
+    """
+    if get_environ().optimize_images:
+        pipeline.add_step(f"{prefix}optimized_images", ImageOptimizerStep(), inputs=[images])
+        images = f"{prefix}optimized_images"
+    if not get_environ().filter_pages:
+        pipeline.add_step(rows, extractor(), inputs=[images])
+        return
+    pipeline.add_step(f"{prefix}filter", PageFilterStep(), inputs=[images])
+    pipeline.add_step(f"{prefix}filtered_rows", extractor(), inputs=[f"{prefix}filter"])
+    pipeline.add_step(rows,
+                      RestoreFilteredRowsStep(pages=f"{prefix}filter",
+                                              rows=f"{prefix}filtered_rows",
+                                              extractor=extractor()),
+                      inputs=[f"{prefix}filter", f"{prefix}filtered_rows"])
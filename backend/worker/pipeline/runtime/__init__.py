@@ -0,0 +1,32 @@
+"""exports runtime"""
+from .runtime import WorkerRuntime
+from .clients import (
+    shared_http_client,
+    shared_openai_client,
+    shared_supabase_client,
+    shared_queue_client,
+    aclose_shared_clients,
+)
+from .executor import (
+    ExecutionMode,
+    on_shutdown,
+    run_blocking,
+    shared_process_pool,
+    shared_thread_pool,
+    shutdown_executors,
+)
+
+__all__ = (
+    "WorkerRuntime",
+    "shared_http_client",
+    "shared_openai_client",
+    "shared_supabase_client",
+    "shared_queue_client",
+    "aclose_shared_clients",
+    "ExecutionMode",
+    "on_shutdown",
+    "run_blocking",
+    "shared_process_pool",
+    "shared_thread_pool",
+    "shutdown_executors",
+)
@@ -0,0 +1,112 @@
+"""
+process-wide clients shared by every message the worker handles
+
+clients are created lazily on first use and must only be used from the
+worker runtime's event loop, since httpx connection pools are bound to the
+loop they were first used on
+"""
+import asyncio
+from typing import Optional
+from httpx import AsyncClient as HttpClient, AsyncHTTPTransport, Limits
+from openai import AsyncClient as OpenAIClient, DefaultAsyncHttpxClient
+from supabase import AsyncClient as SupabaseClient, AsyncClientOptions, create_async_client
+from pipeline.model.environ.Environ import Environ
+
+_http_client: Optional[HttpClient] = None
+_openai_client: Optional[OpenAIClient] = None
+_supabase_client: Optional[SupabaseClient] = None
+_queue_client: Optional[SupabaseClient] = None
+_supabase_lock = asyncio.Lock()
+
+
+def _limits(environ: Environ) -> Limits:
+    return Limits(
+        max_connections=environ.http_max_connections,
+        max_keepalive_connections=environ.http_max_keepalive_connections
+    )
+
+
+def shared_http_client() -> HttpClient:
+    """
+    pooled httpx client for plain http calls (e.g. gotenberg)
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        environ = Environ()
+        _http_client = HttpClient(
+            transport=AsyncHTTPTransport(
+                retries=5,
+                limits=_limits(environ)
+            )
+        )
+    return _http_client
+
+
+def shared_openai_client() -> OpenAIClient:
+    """
+    pooled openai client, reads credentials from the environment
+    """
+    global _openai_client
+    if _openai_client is None or _openai_client.is_closed():
+        environ = Environ()
+        # retries are made by tool_call_openai_model, through the rate limiter
+        _openai_client = OpenAIClient(
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(limits=_limits(environ))
+        )
+    return _openai_client
+
+
+async def shared_supabase_client() -> SupabaseClient:
+    """
+    pooled supabase client, postgrest and storage connections are kept alive
+    across messages
+    """
+    global _supabase_client
+    async with _supabase_lock:
+        if _supabase_client is None:
+            environ = Environ()
+            _supabase_client = await create_async_client(
+                supabase_url=environ.supabase_url,
+                supabase_key=environ.supabase_key
+            )
+    return _supabase_client
+
+
+async def shared_queue_client() -> SupabaseClient:
+    """
+    supabase client bound to the pgmq schema
+
+    kept apart from `shared_supabase_client` because `AsyncClient.schema`
+    switches the schema of the client it is called on, which would leak into
+    every other message sharing that client
+    """
+    global _queue_client
+    async with _supabase_lock:
+        if _queue_client is None:
+            environ = Environ()
+            _queue_client = await create_async_client(
+                supabase_url=environ.supabase_url,
+                supabase_key=environ.supabase_key,
+                options=AsyncClientOptions(schema="pgmq")
+            )
+    return _queue_client
+
+
+async def aclose_shared_clients() -> None:
+    """
+    closes every shared client, called once when the worker shuts down
+    """
+    global _http_client, _openai_client, _supabase_client, _queue_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+    if _supabase_client is not None:
+        await _supabase_client.postgrest.aclose()
+        _supabase_client = None
+    if _queue_client is not None:
+        await _queue_client.postgrest.aclose()
+        _queue_client = None
@@ -0,0 +1,113 @@
+"""
+process-wide executors for blocking pipeline work
+
+cpu-bound work (rasterization, jpeg encoding) goes to a process pool so it
+neither holds the gil nor stalls the runtime loop, blocking calls that
+release the gil (tesseract subprocesses, file i/o) go to a thread pool
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from enum import StrEnum
+from functools import partial
+from typing import Any, Callable, List, Optional, TypeVar
+from pipeline.model.environ.Environ import get_environ
+
+T = TypeVar("T")
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_pools_lock = threading.Lock()
+# shutdowns of pools owned by other modules, e.g. the tesseract engines
+_shutdown_callbacks: List[Callable[[], None]] = []
+
+
+class ExecutionMode(StrEnum):
+    """
+    where a step's blocking work runs
+    """
+    # on the event loop, for steps that only await i/o
+    ASYNC = "async"
+    # shared thread pool, for work releasing the gil
+    THREAD = "thread"
+    # shared process pool, for cpu-bound python work
+    PROCESS = "process"
+
+
+def cpu_worker_count() -> int:
+    """
+    processes in the shared pool, `CPU_WORKERS` or the number of cores
+    """
+    return get_environ().cpu_workers or os.cpu_count() or 1
+
+
+def shared_process_pool() -> ProcessPoolExecutor:
+    """
+    process pool sized by `cpu_worker_count`
+    """
+    global _process_pool
+    with _pools_lock:
+        if _process_pool is None:
+            # forkserver, forking a process that runs the runtime thread
+            # can deadlock the children on locks held mid-fork
+            _process_pool = ProcessPoolExecutor(
+                max_workers=cpu_worker_count(),
+                mp_context=multiprocessing.get_context("forkserver"))
+        return _process_pool
+
+
+def shared_thread_pool() -> ThreadPoolExecutor:
+    """
+    thread pool sized by `THREAD_WORKERS`
+    """
+    global _thread_pool
+    with _pools_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(
+                max_workers=get_environ().thread_workers,
+                thread_name_prefix="pipeline-blocking")
+        return _thread_pool
+
+
+def executor_for(mode: ExecutionMode) -> Optional[Executor]:
+    """shared executor for a mode, `None` for work run on the loop"""
+    if mode == ExecutionMode.PROCESS:
+        return shared_process_pool()
+    if mode == ExecutionMode.THREAD:
+        return shared_thread_pool()
+    return None
+
+
+async def run_blocking(mode: ExecutionMode, fn: Callable[..., T], *args: Any) -> T:
+    """
+    runs `fn(*args)` on the executor for `mode`, in process mode `fn` and
+    its arguments must be picklable, e.g. module level functions
+    """
+    executor = executor_for(mode)
+    if executor is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args))
+
+
+def on_shutdown(callback: Callable[[], None]) -> None:
+    """registers a pool shutdown to run with `shutdown_executors`"""
+    with _pools_lock:
+        if callback not in _shutdown_callbacks:
+            _shutdown_callbacks.append(callback)
+
+
+def shutdown_executors() -> None:
+    """waits for queued work and shuts the shared pools down"""
+    global _process_pool, _thread_pool
+    with _pools_lock:
+        callbacks = list(_shutdown_callbacks)
+    for callback in callbacks:
+        callback()
+    with _pools_lock:
+        for pool in (_process_pool, _thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+        _process_pool = None
+        _thread_pool = None
@@ -0,0 +1,70 @@
+"""
+long-lived asyncio runtime for the worker
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Optional, TypeVar
+from pipeline.runtime.clients import aclose_shared_clients
+from pipeline.runtime.executor import shutdown_executors
+
+T = TypeVar("T")
+
+
+class WorkerRuntime:
+    """
+    runs one event loop on a background thread for the lifetime of the
+    worker, so blocking consumers can hand coroutines to it without paying
+    for a new loop (and new client connections) on every message
+    """
+
+    def __init__(self) -> None:
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "WorkerRuntime":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def start(self) -> "WorkerRuntime":
+        """starts the event loop thread"""
+        if self._thread is not None:
+            return self
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run_loop,
+            name="worker-runtime",
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> Future[T]:
+        """schedules a coroutine on the runtime loop"""
+        if self.loop is None:
+            raise RuntimeError("runtime has not been started")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        """runs a coroutine on the runtime loop and blocks for its result"""
+        return self.submit(coro).result()
+
+    def stop(self) -> None:
+        """closes shared clients and executors and stops the event loop thread"""
+        if self._thread is None:
+            return
+        try:
+            self.run(aclose_shared_clients())
+            shutdown_executors()
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self._thread = None
+            self.loop = None
@@ -0,0 +1,223 @@
+"""
+local stand-in for the openai files and batch api, to run the batch api
+strategies offline
+
+every chat completion request, in a batch or not, is answered with a call
+to its tool holding one instance with a placeholder for each field, and
+batches complete `--complete-after` seconds after they are created
+
+usage (from backend/worker):
+    python -m tools.fake_batch_server --port 8089 --complete-after 5
+
+then start the worker with OPENAI_BASE_URL=http://localhost:8089/v1 and any
+OPENAI_API_KEY, `--fail-every 3` fails every third request of a batch to
+exercise the synchronous fallback
+"""
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+# placeholder value of each json schema type
+PLACEHOLDERS = {"string": "sample", "number": 0, "integer": 0, "boolean": False, "array": []}
+
+
+def tool_call_completion(body: Dict[str, Any]) -> Dict[str, Any]:
+    """chat completion calling the request's tool with placeholder arguments"""
+    function = body["tools"][0]["function"]
+    items = function["parameters"]["properties"]["instances"]["items"]["properties"]
+    instance = {name: PLACEHOLDERS.get(field.get("type"), None) for name, field in items.items()}
+    if "source_page" in instance:
+        instance["source_page"] = 1
+    return {
+        "id": "chatcmpl-stand-in",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stand-in"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "tool_calls",
+            "message": {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": "call-stand-in",
+                    "type": "function",
+                    "function": {"name": function["name"], "arguments": json.dumps({"instances": [instance]})}
+                }]
+            }
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+
+def _multipart_file(content_type: str, body: bytes) -> Tuple[str, bytes, Dict[str, str]]:
+    """filename, content and other fields of a multipart upload"""
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    filename, content, fields = "upload", b"", {}
+    for part in message.iter_parts():
+        if part.get_filename():
+            filename, content = part.get_filename(), part.get_payload(decode=True)
+        else:
+            fields[part.get_param("name", header="content-disposition")] = \
+                part.get_payload(decode=True).decode()
+    return filename, content, fields
+
+
+class FakeBatchServer(ThreadingHTTPServer):
+    """
+    http server holding the uploaded files and batches in memory
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], complete_after: float = 0.0,
+                 fail_every: Optional[int] = None) -> None:
+        super().__init__(address, FakeBatchHandler)
+        self.complete_after = complete_after
+        self.fail_every = fail_every
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}-{next(self._ids)}"
+
+    def add_file(self, filename: str, content: bytes, purpose: str) -> Dict[str, Any]:
+        file = {"id": self.new_id("file"), "object": "file", "bytes": len(content),
+                "created_at": int(time.time()), "filename": filename, "purpose": purpose,
+                "status": "processed"}
+        self.files[file["id"]] = {**file, "content": content}
+        return file
+
+    def refresh(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        """completes a batch whose time has come, answering its requests"""
+        if batch["status"] != "in_progress" or time.time() - batch["created_at"] < self.complete_after:
+            return batch
+        outputs: List[str] = []
+        errors: List[str] = []
+        lines = self.files[batch["input_file_id"]]["content"].decode().splitlines()
+        for number, line in enumerate(filter(str.strip, lines), start=1):
+            request = json.loads(line)
+            if self.fail_every and number % self.fail_every == 0:
+                errors.append(json.dumps({
+                    "id": self.new_id("batch_req"), "custom_id": request["custom_id"], "response": None,
+                    "error": {"code": "server_error", "message": "stand-in failure"}}))
+                continue
+            outputs.append(json.dumps({
+                "id": self.new_id("batch_req"), "custom_id": request["custom_id"], "error": None,
+                "response": {"status_code": 200, "request_id": self.new_id("req"),
+                             "body": tool_call_completion(request["body"])}}))
+        for key, output in (("output_file_id", outputs), ("error_file_id", errors)):
+            if output:
+                content = ("\n".join(output) + "\n").encode()
+                batch[key] = self.add_file(f"{batch['id']}_{key}.jsonl", content, "batch_output")["id"]
+        batch.update(status="completed", completed_at=int(time.time()),
+                     request_counts={"total": len(outputs) + len(errors),
+                                     "completed": len(outputs), "failed": len(errors)})
+        return batch
+
+
+class FakeBatchHandler(BaseHTTPRequestHandler):
+    """
+    routes the files, batches and chat completions endpoints
+    """
+    protocol_version = "HTTP/1.1"
+    server: FakeBatchServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _reply(self, body: Any, status: int = 200, content_type: str = "application/json") -> None:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self) -> None:
+        self._reply({"error": {"message": f"no route for {self.path}"}}, status=404)
+
+    def do_GET(self) -> None:
+        path, _, query = self.path.partition("?")
+        params = {name: values[0] for name, values in parse_qs(query).items()}
+        with self.server.lock:
+            if match := re.fullmatch(r"/v1/files/([\w-]+)/content", path):
+                file = self.server.files.get(match[1])
+                return self._reply(file["content"], content_type="application/jsonl") if file \
+                    else self._not_found()
+            if match := re.fullmatch(r"/v1/batches/([\w-]+)", path):
+                batch = self.server.batches.get(match[1])
+                return self._reply(self.server.refresh(batch)) if batch else self._not_found()
+            if path == "/v1/batches":
+                # newest first, a page of `limit` after the `after` batch
+                ids = list(reversed(self.server.batches))
+                start = ids.index(params["after"]) + 1 if params.get("after") in ids else 0
+                limit = int(params.get("limit", 20))
+                batches = [self.server.refresh(self.server.batches[id])
+                           for id in ids[start:start + limit]]
+                return self._reply({"object": "list", "data": batches,
+                                    "has_more": start + limit < len(ids),
+                                    "first_id": batches[0]["id"] if batches else None,
+                                    "last_id": batches[-1]["id"] if batches else None})
+        self._not_found()
+
+    def do_POST(self) -> None:
+        path = self.path.split("?")[0]
+        body = self._body()
+        with self.server.lock:
+            if path == "/v1/files":
+                filename, content, fields = _multipart_file(self.headers["Content-Type"], body)
+                return self._reply(self.server.add_file(filename, content, fields.get("purpose", "batch")))
+            if path == "/v1/batches":
+                request = json.loads(body)
+                batch = {"id": self.server.new_id("batch"), "object": "batch",
+                         "endpoint": request["endpoint"], "input_file_id": request["input_file_id"],
+                         "completion_window": request["completion_window"], "status": "in_progress",
+                         "created_at": int(time.time()), "metadata": request.get("metadata"),
+                         "output_file_id": None, "error_file_id": None}
+                self.server.batches[batch["id"]] = batch
+                return self._reply(batch)
+            if match := re.fullmatch(r"/v1/batches/([\w-]+)/cancel", path):
+                batch = self.server.batches.get(match[1])
+                if not batch:
+                    return self._not_found()
+                if batch["status"] == "in_progress":
+                    batch["status"] = "cancelled"
+                return self._reply(batch)
+        if path == "/v1/chat/completions":
+            return self._reply(tool_call_completion(json.loads(body)))
+        self._not_found()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--complete-after", type=float, default=5.0,
+                        help="seconds before a batch completes")
+    parser.add_argument("--fail-every", type=int, default=None,
+                        help="fail every nth request of a batch")
+    args = parser.parse_args()
+    server = FakeBatchServer(("127.0.0.1", args.port), args.complete_after, args.fail_every)
+    print(f"fake batch api on http://127.0.0.1:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,27 @@ const defaultStrategies: Strategy[] = [
     description:
       "Strategy for extracting structure from pdf using OpenAI GPT-4o",
   },
+  {
+    id: "c52e55ae-ca09-405a-89fe-2dd250193366",
+    strategy: "file_image_text_openai",
+    name: "OpenAI image and text extraction",
+    description:
+      "Strategy for extracting structure from both page images and their OCR text using OpenAI, keeping the fuller rows of each page",
+  },
+  {
+    id: "c8bd9394-1da8-4614-bae7-58fac08bae7e",
+    strategy: "file_adaptive_openai",
+    name: "OpenAI adaptive extraction",
+    description:
+      "Strategy routing each page to text, OCR or image extraction using OpenAI, whichever is cheapest for the page",
+  },
+  {
+    id: "95e76832-be5c-403b-8a19-8aac6b8d2b1d",
+    strategy: "file_image_openai_batch",
+    name: "OpenAI batch image extraction",
+    description:
+      "Strategy for extracting page images through the OpenAI Batch API, cheaper but finishing within a day, for bulk runs",
+  },
 ];
 
 const modelIconMap: { [key: string]: JSX.Element } = {